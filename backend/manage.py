@@ -0,0 +1,88 @@
+"""Comandos de mantenimiento de la tienda: python manage.py --help"""
+import asyncio
+import json
+from pathlib import Path
+
+import typer
+
+from server import (
+    db, client, asegurar_indices, verificar_indices, deduplicar_pedidos, importar_productos, compactador_carritos,
+    reconciliar_estadisticas
+)
+
+cli = typer.Typer(help="Tareas de mantenimiento de la API de Fundas de Patines")
+
+
+def _ejecutar(coro):
+    try:
+        return asyncio.run(coro)
+    finally:
+        client.close()
+
+
+@cli.command()
+def indices(check: bool = typer.Option(False, "--check", help="Solo verificar: índices faltantes y planes COLLSCAN")):
+    """Crear los índices declarados o verificar su estado"""
+    if not check:
+        try:
+            creados = _ejecutar(asegurar_indices(db))
+        except RuntimeError as e:
+            typer.echo(str(e), err=True)
+            raise typer.Exit(code=1)
+        typer.echo(json.dumps(creados, indent=2))
+        return
+    
+    informe = _ejecutar(verificar_indices(db))
+    typer.echo(json.dumps(informe, indent=2, default=str))
+    if informe["indices_faltantes"] or any(p["collscan"] for p in informe["planes"]):
+        raise typer.Exit(code=1)
+
+
+
+@cli.command("pedidos-duplicados")
+def pedidos_duplicados(archivar: bool = typer.Option(False, "--archivar", help="Mover los sobrantes a pedidos_duplicados")):
+    """Listar (o archivar) pedidos repetidos del mismo carrito antes de crear carrito_id_unico"""
+    informe = _ejecutar(deduplicar_pedidos(db, archivar))
+    typer.echo(json.dumps(informe, indent=2, default=str))
+    if informe["sobrantes"] and not archivar:
+        raise typer.Exit(code=1)
+
+
+@cli.command()
+def estadisticas(
+    completo: bool = typer.Option(False, "--completo", help="Reconstruir todo el histórico de pedidos"),
+    dias: int = typer.Option(90, help="Días recientes a reconstruir si no se pide el histórico completo"),
+):
+    """Recalcular contadores y buckets diarios de ventas desde los pedidos"""
+    contadores = _ejecutar(reconciliar_estadisticas(None if completo else dias))
+    typer.echo(json.dumps(contadores, indent=2, default=str))
+
+
+@cli.command("compactar-carritos")
+def compactar_carritos(archivar: bool = typer.Option(False, "--archivar", help="Copiar a carritos_archivo antes de borrar")):
+    """Archivar o borrar carritos abandonados anteriores a la caducidad automática"""
+    resumen = _ejecutar(compactador_carritos.compactar(archivar))
+    typer.echo(json.dumps(resumen, indent=2, default=str))
+
+
+async def _lineas_archivo(ruta: Path):
+    with ruta.open(encoding="utf-8") as archivo:
+        for linea in archivo:
+            yield linea.rstrip("\r\n")
+
+
+@cli.command()
+def importar(
+    archivo: Path = typer.Argument(..., exists=True, dir_okay=False, help="Fichero NDJSON o CSV"),
+    formato: str = typer.Option(None, help="ndjson o csv (por defecto, según la extensión)"),
+):
+    """Importar productos en bloque desde un fichero"""
+    formato = formato or ("csv" if archivo.suffix.lower() == ".csv" else "ndjson")
+    resumen = _ejecutar(importar_productos(_lineas_archivo(archivo), formato))
+    typer.echo(json.dumps(resumen, indent=2, ensure_ascii=False))
+    if resumen["total_errores"]:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,26 +1,204 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo import monitoring
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Optional, Dict, Any, AsyncIterator
 import uuid
-from datetime import datetime, timedelta
+import time
+import random
+import types
+import json
+import base64
+import csv
+import codecs
+import io
+import hashlib
+import math
+import socket
+import gzip
+from email.utils import format_datetime, parsedate_to_datetime
+from collections import OrderedDict, deque
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 import bcrypt
 import jwt
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson es opcional
+    orjson = None
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli es opcional
+    brotli = None
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# MÉTRICAS E INSTRUMENTACIÓN
+# Un middleware mide latencia, códigos de estado y peticiones en curso por ruta, y un
+# CommandListener de pymongo atribuye cada comando de Mongo a la petición actual a
+# través de un contextvar (Motor copia el contexto al hilo que ejecuta el comando).
+METRICAS_CABECERA_DEBUG = os.environ.get('METRICAS_CABECERA_DEBUG', 'false').lower() == 'true'
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class ConsultasPeticion:
+    """Comandos de Mongo emitidos durante una petición"""
+    __slots__ = ("comandos", "segundos")
+
+    def __init__(self):
+        self.comandos = 0
+        self.segundos = 0.0
+
+peticion_actual: contextvars.ContextVar[Optional[ConsultasPeticion]] = contextvars.ContextVar("peticion_actual", default=None)
+
+class Histograma:
+    """Histograma acumulativo con los buckets de Prometheus"""
+
+    def __init__(self, buckets=METRICAS_BUCKETS):
+        self.buckets = buckets
+        self.cuentas = [0] * (len(buckets) + 1)
+        self.suma = 0.0
+
+    def observar(self, valor: float):
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.cuentas[i] += 1
+                break
+        else:
+            self.cuentas[-1] += 1
+        self.suma += valor
+
+    def lineas(self, nombre: str, etiquetas: str) -> List[str]:
+        salida, acumulado = [], 0
+        for limite, cuenta in zip(self.buckets, self.cuentas):
+            acumulado += cuenta
+            salida.append(f'{nombre}_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+        acumulado += self.cuentas[-1]
+        salida.append(f'{nombre}_bucket{{{etiquetas},le="+Inf"}} {acumulado}')
+        salida.append(f'{nombre}_sum{{{etiquetas}}} {self.suma:.6f}')
+        salida.append(f'{nombre}_count{{{etiquetas}}} {acumulado}')
+        return salida
+
+def _etiqueta(valor: Any) -> str:
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricasServicio:
+    """Registro en memoria de métricas HTTP y de Mongo, exportable en formato Prometheus"""
+
+    def __init__(self):
+        # Los comandos de Mongo se observan desde los hilos de Motor
+        self._lock = threading.Lock()
+        self.en_curso = 0
+        self.latencias: Dict[tuple, Histograma] = {}
+        self.respuestas: Dict[tuple, int] = {}
+        self.comandos_por_ruta: Dict[tuple, Histograma] = {}
+        self.comandos: Dict[tuple, List[float]] = {}
+
+    def observar_peticion(self, metodo: str, ruta: str, estado: int, segundos: float, consultas: ConsultasPeticion):
+        with self._lock:
+            self.latencias.setdefault((metodo, ruta), Histograma()).observar(segundos)
+            clave = (metodo, ruta, estado)
+            self.respuestas[clave] = self.respuestas.get(clave, 0) + 1
+            self.comandos_por_ruta.setdefault((metodo, ruta), Histograma((0, 1, 2, 5, 10, 20, 50, 100))).observar(consultas.comandos)
+
+    def observar_comando(self, comando: str, coleccion: str, segundos: float, fallido: bool):
+        with self._lock:
+            acumulado = self.comandos.setdefault((comando, coleccion, fallido), [0, 0.0])
+            acumulado[0] += 1
+            acumulado[1] += segundos
+
+    def prometheus(self) -> str:
+        """Exposición en el formato de texto 0.0.4 de Prometheus"""
+        with self._lock:
+            lineas = [
+                "# HELP http_peticiones_en_curso Peticiones HTTP en curso",
+                "# TYPE http_peticiones_en_curso gauge",
+                f"http_peticiones_en_curso {self.en_curso}",
+                "# HELP http_peticion_segundos Latencia de las peticiones HTTP por ruta",
+                "# TYPE http_peticion_segundos histogram",
+            ]
+            for (metodo, ruta), histograma in sorted(self.latencias.items()):
+                lineas.extend(histograma.lineas("http_peticion_segundos", f'metodo="{metodo}",ruta="{_etiqueta(ruta)}"'))
+            lineas += ["# HELP http_respuestas_total Respuestas HTTP por ruta y código de estado",
+                       "# TYPE http_respuestas_total counter"]
+            for (metodo, ruta, estado), total in sorted(self.respuestas.items()):
+                lineas.append(f'http_respuestas_total{{metodo="{metodo}",ruta="{_etiqueta(ruta)}",estado="{estado}"}} {total}')
+            lineas += ["# HELP mongo_comandos_por_peticion Comandos de Mongo emitidos por cada petición",
+                       "# TYPE mongo_comandos_por_peticion histogram"]
+            for (metodo, ruta), histograma in sorted(self.comandos_por_ruta.items()):
+                lineas.extend(histograma.lineas("mongo_comandos_por_peticion", f'metodo="{metodo}",ruta="{_etiqueta(ruta)}"'))
+            lineas += ["# HELP mongo_comandos_total Comandos de Mongo por tipo y colección",
+                       "# TYPE mongo_comandos_total counter"]
+            for (comando, coleccion, fallido), (total, _) in sorted(self.comandos.items()):
+                lineas.append(f'mongo_comandos_total{{comando="{comando}",coleccion="{_etiqueta(coleccion)}",fallido="{str(fallido).lower()}"}} {total}')
+            lineas += ["# HELP mongo_comandos_segundos_total Tiempo acumulado en comandos de Mongo",
+                       "# TYPE mongo_comandos_segundos_total counter"]
+            for (comando, coleccion, fallido), (_, segundos) in sorted(self.comandos.items()):
+                lineas.append(f'mongo_comandos_segundos_total{{comando="{comando}",coleccion="{_etiqueta(coleccion)}",fallido="{str(fallido).lower()}"}} {segundos:.6f}')
+        return "\n".join(lineas) + "\n"
+
+metricas = MetricasServicio()
+
+class MonitorComandosMongo(monitoring.CommandListener):
+    """Atribuye cada comando de Mongo a la petición en curso y lo acumula en las métricas"""
+
+    def __init__(self):
+        # request_id del driver -> colección, para etiquetar al terminar el comando
+        self._colecciones: Dict[int, str] = {}
+
+    def started(self, event):
+        coleccion = event.command.get(event.command_name)
+        self._colecciones[event.request_id] = coleccion if isinstance(coleccion, str) else ""
+
+    def _terminar(self, event, fallido: bool):
+        segundos = event.duration_micros / 1_000_000
+        coleccion = self._colecciones.pop(event.request_id, "")
+        consultas = peticion_actual.get()
+        if consultas is not None:
+            consultas.comandos += 1
+            consultas.segundos += segundos
+        metricas.observar_comando(event.command_name, coleccion, segundos, fallido)
+
+    def succeeded(self, event):
+        self._terminar(event, False)
+
+    def failed(self, event):
+        self._terminar(event, True)
+
+monitor_mongo = MonitorComandosMongo()
+
 # MongoDB connection
+# El pool es por proceso: con varios workers, MONGO_MAX_POOL_SIZE se multiplica por
+# el número de workers (servir.py lo reparte a partir de un total). Las opciones no
+# definidas conservan los valores por defecto de pymongo.
+OPCIONES_POOL_MONGO = {
+    "maxPoolSize": 'MONGO_MAX_POOL_SIZE',
+    "minPoolSize": 'MONGO_MIN_POOL_SIZE',
+    "maxIdleTimeMS": 'MONGO_MAX_IDLE_TIME_MS',
+    "waitQueueTimeoutMS": 'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+    "serverSelectionTimeoutMS": 'MONGO_SERVER_SELECTION_TIMEOUT_MS',
+    "connectTimeoutMS": 'MONGO_CONNECT_TIMEOUT_MS',
+    "socketTimeoutMS": 'MONGO_SOCKET_TIMEOUT_MS',
+}
+opciones_pool = {opcion: int(os.environ[variable]) for opcion, variable in OPCIONES_POOL_MONGO.items() if os.environ.get(variable)}
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[monitor_mongo], **opciones_pool)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -36,6 +214,211 @@ JWT_ALGORITHM = "HS256"
 
 # Stripe configuration
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY')
+PAGOS_BACKEND = os.environ.get('PAGOS_BACKEND', 'stripe')  # "stripe" o "falso"
+PAGOS_TIMEOUT = float(os.environ.get('PAGOS_TIMEOUT', '10'))
+PAGOS_REINTENTOS = int(os.environ.get('PAGOS_REINTENTOS', '2'))
+PAGOS_CONCURRENCIA = int(os.environ.get('PAGOS_CONCURRENCIA', '20'))
+# Caducidad de las sesiones de checkout (Stripe admite entre 30 min y 24 h)
+PAGOS_SESION_TTL = max(int(os.environ.get('PAGOS_SESION_TTL', '1800')), 1800)
+# URL pública del webhook; sin ella se deriva del Host de cada petición
+PAGOS_WEBHOOK_URL = os.environ.get('PAGOS_WEBHOOK_URL', '')
+# Clientes de Stripe distintos (uno por URL de webhook) que se conservan como máximo
+PAGOS_CHECKOUTS_MAX = int(os.environ.get('PAGOS_CHECKOUTS_MAX', '8'))
+
+# ÍNDICES DE MONGODB
+# Especificación declarativa por colección. Se aplica de forma idempotente al
+# arrancar (CREAR_INDICES=true) o con `python manage.py indices`.
+INDICES: Dict[str, List[IndexModel]] = {
+    "productos": [
+        IndexModel([("id", ASCENDING)], name="id_unico", unique=True),
+        # Paginación por clave (keyset): un índice por campo de orden, con y sin categoría
+        IndexModel([("activo", ASCENDING), ("categoria", ASCENDING), ("fecha_creacion", ASCENDING), ("id", ASCENDING)], name="activo_categoria_fecha"),
+        IndexModel([("activo", ASCENDING), ("categoria", ASCENDING), ("precio", ASCENDING), ("id", ASCENDING)], name="activo_categoria_precio"),
+        IndexModel([("activo", ASCENDING), ("categoria", ASCENDING), ("nombre", ASCENDING), ("id", ASCENDING)], name="activo_categoria_nombre"),
+        IndexModel([("activo", ASCENDING), ("fecha_creacion", ASCENDING), ("id", ASCENDING)], name="activo_fecha"),
+        IndexModel([("activo", ASCENDING), ("precio", ASCENDING), ("id", ASCENDING)], name="activo_precio"),
+        IndexModel([("activo", ASCENDING), ("nombre", ASCENDING), ("id", ASCENDING)], name="activo_nombre"),
+        # Filtros de atributos (multikey para tallas y colores), uno por campo de orden.
+        # Con varios filtros de igualdad basta uno como prefijo: el resto se evalúa al
+        # leer el documento y el orden sigue saliendo del índice
+        *[
+            IndexModel([("activo", ASCENDING), (atributo, ASCENDING), (campo, ASCENDING), ("id", ASCENDING)], name=f"activo_{nombre}_{sufijo}")
+            for atributo, nombre in (("tallas_disponibles", "tallas"), ("colores_disponibles", "colores"), ("material", "material"))
+            for campo, sufijo in (("fecha_creacion", "fecha"), ("precio", "precio"), ("nombre", "nombre"))
+        ],
+        # Búsqueda: la versión 3 de los índices de texto ignora acentos y aplica stemming en español
+        IndexModel(
+            [("nombre", TEXT), ("descripcion", TEXT), ("material", TEXT), ("caracteristicas", TEXT)],
+            name="busqueda_texto",
+            default_language="spanish",
+            weights={"nombre": 10, "material": 5, "caracteristicas": 3, "descripcion": 1}
+        ),
+    ],
+    "usuarios": [
+        IndexModel([("id", ASCENDING)], name="id_unico", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unico", unique=True),
+        IndexModel([("fecha_registro", ASCENDING)], name="fecha_registro"),
+    ],
+    "carritos": [
+        IndexModel([("id", ASCENDING)], name="id_unico", unique=True),
+        # Los carritos sin convertir caducan; al convertirse se les quita expira_en
+        IndexModel([("expira_en", ASCENDING)], name="expira_ttl", expireAfterSeconds=0),
+        IndexModel([("fecha_creacion", ASCENDING)], name="fecha_creacion"),
+    ],
+    "pedidos": [
+        IndexModel([("id", ASCENDING)], name="id_unico", unique=True),
+        # Un pedido por carrito: los reintentos no pueden duplicar pedidos
+        IndexModel([("carrito_id", ASCENDING)], name="carrito_id_unico", unique=True),
+        IndexModel([("usuario_id", ASCENDING), ("fecha_pedido", DESCENDING)], name="usuario_fecha"),
+        IndexModel([("fecha_pedido", DESCENDING)], name="fecha_pedido"),
+    ],
+    "ventas_diarias": [
+        IndexModel([("fecha", ASCENDING)], name="fecha"),
+    ],
+    "payment_transactions": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unico", unique=True),
+        IndexModel([("carrito_id", ASCENDING)], name="carrito_id"),
+        IndexModel([("fecha_creacion", ASCENDING)], name="fecha_creacion"),
+    ],
+    "reservas_stock": [
+        IndexModel([("id", ASCENDING)], name="id_unico", unique=True),
+        # Una sola reserva vigente (activa o confirmada) por carrito
+        IndexModel([("carrito_id", ASCENDING)], name="carrito_vigente_unico", unique=True,
+                   partialFilterExpression={"vigente": True}),
+        IndexModel([("estado", ASCENDING), ("expira_en", ASCENDING)], name="estado_expira"),
+    ],
+    "stock_fragmentos": [
+        IndexModel([("producto_id", ASCENDING), ("fragmento", ASCENDING)], name="producto_fragmento_unico", unique=True),
+    ],
+    "idempotencia": [
+        IndexModel([("expira_en", ASCENDING)], name="expira_ttl", expireAfterSeconds=0),
+    ],
+    "limites_tasa": [
+        IndexModel([("expira_en", ASCENDING)], name="expira_ttl", expireAfterSeconds=0),
+    ],
+    "webhook_inbox": [
+        IndexModel([("estado", ASCENDING), ("proximo_intento", ASCENDING)], name="estado_proximo_intento"),
+        # Los eventos procesados se conservan para deduplicar reintentos de Stripe
+        IndexModel([("procesado_en", ASCENDING)], name="procesado_ttl",
+                   expireAfterSeconds=int(os.environ.get('WEBHOOK_RETENCION_SEGUNDOS', str(7 * 24 * 3600)))),
+    ],
+}
+
+# Forma de las consultas de cada ruta, usada por el modo de verificación para
+# detectar planes COLLSCAN con explain: (ruta, colección, filtro, orden)
+CONSULTAS_RUTAS = [
+    ("obtener_productos", "productos", {"activo": True}, [("fecha_creacion", 1), ("id", 1)]),
+    ("obtener_productos?categoria", "productos", {"activo": True, "categoria": "hockey"}, [("fecha_creacion", 1), ("id", 1)]),
+    ("obtener_productos?orden=-precio", "productos", {"activo": True}, [("precio", -1), ("id", -1)]),
+    ("obtener_productos?talla", "productos", {"activo": True, "tallas_disponibles": "M"}, [("precio", 1), ("id", 1)]),
+    ("obtener_productos?color&orden=-fecha", "productos", {"activo": True, "colores_disponibles": "rojo"}, [("fecha_creacion", -1), ("id", -1)]),
+    ("obtener_productos?material&orden=nombre", "productos", {"activo": True, "material": "neopreno"}, [("nombre", 1), ("id", 1)]),
+    ("obtener_producto", "productos", {"id": "x"}, None),
+    ("buscar_productos", "productos", {"$text": {"$search": "funda"}, "activo": True}, None),
+    ("get_current_user", "usuarios", {"id": "x"}, None),
+    ("login_usuario", "usuarios", {"email": "x@x.com"}, None),
+    ("obtener_carrito", "carritos", {"id": "x"}, None),
+    ("obtener_pedidos", "pedidos", {"usuario_id": "x"}, None),
+    ("obtener_estadisticas", "ventas_diarias", {"fecha": {"$gte": datetime(2000, 1, 1)}}, [("fecha", 1)]),
+    ("reconciliar_estadisticas", "pedidos", {"fecha_pedido": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("obtener_estado_pago", "payment_transactions", {"session_id": "x"}, None),
+]
+
+async def asegurar_indices(database) -> Dict[str, List[str]]:
+    """Crear los índices declarados en INDICES (idempotente); RuntimeError si falta alguno"""
+    creados: Dict[str, List[str]] = {}
+    fallidos: Dict[str, str] = {}
+    for coleccion, modelos in INDICES.items():
+        creados[coleccion] = []
+        # Los únicos van de uno en uno: si los datos tienen duplicados, solo falla ese
+        unicos = [m for m in modelos if m.document.get("unique")]
+        lotes = [[m] for m in unicos] + [[m for m in modelos if m not in unicos]]
+        for lote in filter(None, lotes):
+            try:
+                if len(lote) == 1:
+                    opciones = dict(lote[0].document)
+                    creados[coleccion].append(await database[coleccion].create_index(list(opciones.pop("key").items()), **opciones))
+                else:
+                    creados[coleccion].extend(await database[coleccion].create_indexes(lote))
+            except OperationFailure as e:
+                for modelo in lote:
+                    fallidos[f"{coleccion}.{modelo.document['name']}"] = str(e)
+    if fallidos:
+        for nombre, error in fallidos.items():
+            logging.getLogger(__name__).critical(f"No se pudo crear el índice {nombre}: {error}")
+        # Sin carrito_id_unico, por ejemplo, un reintento puede duplicar pedidos: no seguir en silencio
+        raise RuntimeError(
+            f"Índices sin crear: {', '.join(fallidos)}. Si hay duplicados, "
+            "revísalos con 'python manage.py pedidos-duplicados'"
+        )
+    return creados
+
+async def deduplicar_pedidos(database, archivar: bool = False) -> Dict[str, Any]:
+    """Buscar pedidos repetidos por carrito (impiden crear carrito_id_unico) y, con
+    archivar=True, mover a pedidos_duplicados todos menos uno: el pagado o el más antiguo"""
+    grupos = await database.pedidos.aggregate([
+        {"$group": {"_id": "$carrito_id", "ids": {"$push": "$id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}}
+    ]).to_list(None)
+    informe = {"carritos": len(grupos), "sobrantes": sum(g["n"] - 1 for g in grupos), "archivados": 0, "detalle": []}
+    for grupo in grupos:
+        pedidos = await database.pedidos.find({"carrito_id": grupo["_id"]}).to_list(None)
+        pedidos.sort(key=lambda p: (p.get("estado") == "pendiente", p.get("fecha_pedido") or datetime.max))
+        conservado, sobrantes = pedidos[0], pedidos[1:]
+        informe["detalle"].append({"carrito_id": grupo["_id"], "conservado": conservado["id"], "sobrantes": [p["id"] for p in sobrantes]})
+        if archivar:
+            await database.pedidos_duplicados.insert_many([{**p, "archivado": datetime.utcnow()} for p in sobrantes])
+            await database.pedidos.delete_many({"_id": {"$in": [p["_id"] for p in sobrantes]}})
+            informe["archivados"] += len(sobrantes)
+    return informe
+
+def _etapas_plan(plan: Dict[str, Any]) -> List[str]:
+    etapas = []
+    if "stage" in plan:
+        etapas.append(plan["stage"])
+    for clave in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(clave), dict):
+            etapas.extend(_etapas_plan(plan[clave]))
+    for subplan in plan.get("inputStages", []):
+        etapas.extend(_etapas_plan(subplan))
+    return etapas
+
+def _firma_indice(clave: List[tuple], pesos: Optional[Dict[str, Any]]) -> tuple:
+    """Forma comparable de la clave de un índice declarado o existente"""
+    campos_texto = {campo for campo, orden in clave if orden == "text"}
+    if campos_texto:
+        # Mongo guarda los índices de texto como _fts/_ftsx y los campos en weights
+        return ("text", frozenset((set(pesos or {}) | campos_texto) - {"_fts"}))
+    # Sin convertir a int: los valores pueden ser 1, 1.0, -1, "2dsphere"...
+    return tuple(clave)
+
+async def verificar_indices(database) -> Dict[str, Any]:
+    """Informar de índices declarados que faltan y de rutas con COLLSCAN"""
+    faltantes = []
+    for coleccion, modelos in INDICES.items():
+        existentes = await database[coleccion].index_information()
+        firmas = {_firma_indice(list(info["key"]), info.get("weights")) for info in existentes.values()}
+        for modelo in modelos:
+            doc = modelo.document
+            clave = list(doc["key"].items())
+            if _firma_indice(clave, doc.get("weights")) not in firmas:
+                faltantes.append({"coleccion": coleccion, "nombre": doc["name"], "clave": clave})
+    
+    planes = []
+    for ruta, coleccion, filtro, orden in CONSULTAS_RUTAS:
+        cursor = database[coleccion].find(filtro)
+        if orden:
+            cursor = cursor.sort(orden)
+        plan = await cursor.explain()
+        etapas = _etapas_plan(plan.get("queryPlanner", {}).get("winningPlan", {}))
+        planes.append({
+            "ruta": ruta,
+            "coleccion": coleccion,
+            "etapas": etapas,
+            "collscan": "COLLSCAN" in etapas
+        })
+    
+    return {"indices_faltantes": faltantes, "planes": planes}
 
 # Enum para categorías de patines
 class TipoPatines(str, Enum):
@@ -75,6 +458,10 @@ class Usuario(BaseModel):
     activo: bool = True
     fecha_registro: datetime = Field(default_factory=datetime.utcnow)
 
+class UsuarioAdminUpdate(BaseModel):
+    rol: Optional[RolUsuario] = None
+    activo: Optional[bool] = None
+
 class UsuarioResponse(BaseModel):
     id: str
     nombre: str
@@ -112,9 +499,35 @@ class Producto(BaseModel):
     imagen_url: Optional[str] = None
     caracteristicas: Optional[List[str]] = []
     fecha_creacion: datetime = Field(default_factory=datetime.utcnow)
+    fecha_actualizacion: Optional[datetime] = None
     activo: bool = True
 
+class ActualizacionMasiva(BaseModel):
+    # Selección: lista de ids o filtro por atributos
+    ids: Optional[List[str]] = None
+    categoria: Optional[TipoPatines] = None
+    material: Optional[str] = None
+    # Cambios
+    precio: Optional[float] = Field(None, ge=0)
+    ajuste_precio_pct: Optional[float] = Field(None, gt=-100)
+    stock: Optional[int] = Field(None, ge=0)
+    activo: Optional[bool] = None
+
+class ProductoEncontrado(Producto):
+    relevancia: float
+
+class Faceta(BaseModel):
+    valor: str
+    cantidad: int
+
+class ResultadoBusqueda(BaseModel):
+    total: int
+    resultados: List[ProductoEncontrado]
+    facetas: Dict[str, List[Faceta]]
+
 # MODELOS DE CARRITO Y PEDIDOS
+CARRITO_TTL_SEGUNDOS = int(os.environ.get('CARRITO_TTL_SEGUNDOS', str(7 * 24 * 3600)))
+
 class ItemCarrito(BaseModel):
     producto_id: str
     cantidad: int
@@ -124,13 +537,46 @@ class ItemCarrito(BaseModel):
 class CarritoCreate(BaseModel):
     items: List[ItemCarrito]
     usuario_id: Optional[str] = None
+
+class LineaCarrito(BaseModel):
+    producto_id: str
+    nombre: str
+    categoria: TipoPatines
+    talla: str
+    color: str
+    cantidad: int
+    precio_unitario: float
+    subtotal: float
+
+class CotizacionCarrito(BaseModel):
+    lineas: List[LineaCarrito]
+    total: float
+    fragmentados: List[str] = []
     
 class Carrito(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     items: List[ItemCarrito]
+    lineas: List[LineaCarrito] = []
     usuario_id: Optional[str] = None
     fecha_creacion: datetime = Field(default_factory=datetime.utcnow)
     total: float = 0.0
+    # Se incrementa en cada modificación; se expone como ETag para If-Match
+    version: int = 0
+    # Sin convertir en pedido o pago, el índice TTL lo elimina al llegar a expira_en
+    expira_en: Optional[datetime] = None
+    convertido: bool = False
+
+class OperacionLinea(str, Enum):
+    AGREGAR = "agregar"
+    CANTIDAD = "cantidad"
+    QUITAR = "quitar"
+
+class OperacionCarrito(BaseModel):
+    op: OperacionLinea
+    producto_id: str
+    talla: str
+    color: str
+    cantidad: int = 1
 
 class DatosCliente(BaseModel):
     nombre: str
@@ -148,11 +594,15 @@ class PedidoCreate(BaseModel):
 class Pedido(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     carrito_id: str
+    reserva_id: Optional[str] = None
     usuario_id: Optional[str] = None
     datos_cliente: Optional[DatosCliente] = None
     metodo_pago: str
     total: float
+    lineas: List[LineaCarrito] = []
     estado: str = "pendiente"
+    # Pagado cuando su reserva ya había expirado y el stock no alcanzaba: revisar a mano
+    incidencia_stock: bool = False
     fecha_pedido: datetime = Field(default_factory=datetime.utcnow)
 
 # MODELOS DE PAGO
@@ -171,12 +621,193 @@ class TransaccionPago(BaseModel):
     metadata: Optional[Dict[str, Any]] = {}
     fecha_creacion: datetime = Field(default_factory=datetime.utcnow)
 
+# SERVICIO DE HASHING DE CONTRASEÑAS
+# bcrypt bloquea la CPU 100-300 ms por llamada, así que se ejecuta en un pool
+# (hilos o procesos) con una cola acotada para no bloquear el event loop.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_POOL = os.environ.get('BCRYPT_POOL', 'thread')  # "thread" o "process"
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', str(os.cpu_count() or 2)))
+BCRYPT_MAX_QUEUE = int(os.environ.get('BCRYPT_MAX_QUEUE', '64'))
+
+def _bcrypt_hash(password: str, rounds: int):
+    inicio = time.time()
+    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+    return hashed, inicio
+
+def _bcrypt_check(password: str, hashed: str):
+    inicio = time.time()
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8')), inicio
+
+def bcrypt_cost(hashed: str) -> int:
+    """Extraer el factor de coste de un hash bcrypt ($2b$12$...)"""
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
+
+class ServicioHashing:
+    """Pool de hashing bcrypt con cola acotada y métricas de latencia"""
+
+    def __init__(self, rounds: int, pool: str, workers: int, max_queue: int):
+        self.rounds = rounds
+        self.pool = pool
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self.pendientes = 0
+        self.completadas = 0
+        self.rechazadas = 0
+        self.espera_total = 0.0
+        self.ejecucion_total = 0.0
+        self.latencia_max = 0.0
+
+    def iniciar(self):
+        if self._executor is None:
+            if self.pool == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+
+    def cerrar(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _ejecutar(self, fn, *args):
+        if self.pendientes >= self.workers + self.max_queue:
+            self.rechazadas += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Servicio de autenticación saturado, inténtalo de nuevo",
+                headers={"Retry-After": "1"}
+            )
+        self.iniciar()
+        enviada = time.time()
+        self.pendientes += 1
+        try:
+            resultado, inicio = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pendientes -= 1
+        terminada = time.time()
+        self.completadas += 1
+        self.espera_total += max(inicio - enviada, 0.0)
+        self.ejecucion_total += terminada - inicio
+        self.latencia_max = max(self.latencia_max, terminada - enviada)
+        return resultado
+
+    async def hash(self, password: str) -> str:
+        return await self._ejecutar(_bcrypt_hash, password, self.rounds)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._ejecutar(_bcrypt_check, password, hashed)
+
+    def necesita_rehash(self, hashed: str) -> bool:
+        return bcrypt_cost(hashed) != self.rounds
+
+    def stats(self) -> Dict[str, Any]:
+        completadas = self.completadas or 1
+        return {
+            "pool": self.pool,
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "profundidad_cola": max(self.pendientes - self.workers, 0),
+            "pendientes": self.pendientes,
+            "completadas": self.completadas,
+            "rechazadas": self.rechazadas,
+            "espera_media_ms": round(self.espera_total / completadas * 1000, 2),
+            "ejecucion_media_ms": round(self.ejecucion_total / completadas * 1000, 2),
+            "latencia_max_ms": round(self.latencia_max * 1000, 2)
+        }
+
+servicio_hashing = ServicioHashing(BCRYPT_ROUNDS, BCRYPT_POOL, BCRYPT_WORKERS, BCRYPT_MAX_QUEUE)
+
 # FUNCIONES DE UTILIDAD
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+async def hash_password(password: str) -> str:
+    return await servicio_hashing.hash(password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await servicio_hashing.verify(password, hashed)
+
+class CacheTTL:
+    """Cache LRU en memoria con caducidad por entrada y contadores de aciertos"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._datos: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def get(self, clave):
+        entrada = self._datos.get(clave)
+        if entrada is None or entrada[0] < time.monotonic():
+            if entrada is not None:
+                del self._datos[clave]
+            self.fallos += 1
+            return None
+        self._datos.move_to_end(clave)
+        self.aciertos += 1
+        return entrada[1]
+
+    def set(self, clave, valor):
+        self._datos[clave] = (time.monotonic() + self.ttl, valor)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.maxsize:
+            self._datos.popitem(last=False)
+            self.expulsiones += 1
+
+    def invalidar(self, clave):
+        self._datos.pop(clave, None)
+
+    def limpiar(self):
+        self._datos.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.aciertos + self.fallos
+        return {
+            "entradas": len(self._datos),
+            "maxsize": self.maxsize,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "expulsiones": self.expulsiones,
+            "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0
+        }
+
+# Cache de usuarios autenticados (evita un find_one por petición)
+usuarios_cache = CacheTTL(
+    maxsize=int(os.environ.get('USUARIOS_CACHE_MAXSIZE', '10000')),
+    ttl=float(os.environ.get('USUARIOS_CACHE_TTL', '60'))
+)
+
+class VersionUsuarios:
+    """Invalidación del cache de usuarios entre workers: cada cambio de rol o de estado
+    sube un contador en Mongo y cada worker lo relee como mucho cada `intervalo` segundos;
+    si cambió, vacía su cache. Un usuario desactivado pierde el acceso en ese plazo."""
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    def __init__(self, intervalo: float):
+        self.intervalo = intervalo
+        self.version: Optional[int] = None
+        self.revisado = 0.0
+        self.vaciados = 0
+
+    async def comprobar(self):
+        if time.monotonic() < self.revisado + self.intervalo:
+            return
+        # Marcar antes de leer: las peticiones simultáneas no repiten la consulta
+        self.revisado = time.monotonic()
+        documento = await db.invalidaciones.find_one({"_id": "usuarios"})
+        version = documento["version"] if documento else 0
+        if self.version is not None and version != self.version:
+            usuarios_cache.limpiar()
+            self.vaciados += 1
+        self.version = version
+
+    async def publicar(self, usuario_id: str):
+        usuarios_cache.invalidar(usuario_id)
+        await db.invalidaciones.update_one({"_id": "usuarios"}, {"$inc": {"version": 1}}, upsert=True)
+
+version_usuarios = VersionUsuarios(float(os.environ.get('USUARIOS_CACHE_REVISION', '2')))
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -197,20 +828,1880 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Token inválido")
     
-    user = await db.usuarios.find_one({"id": user_id})
-    if user is None:
-        raise HTTPException(status_code=401, detail="Usuario no encontrado")
-    return Usuario(**user)
+    await version_usuarios.comprobar()
+    usuario = usuarios_cache.get(user_id)
+    if usuario is None:
+        user = await db.usuarios.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        if user is None:
+            raise HTTPException(status_code=401, detail="Usuario no encontrado")
+        usuario = Usuario(**user)
+        usuarios_cache.set(user_id, usuario)
+    if not usuario.activo:
+        raise HTTPException(status_code=401, detail="Usuario inactivo")
+    return usuario
 
 async def get_admin_user(current_user: Usuario = Depends(get_current_user)):
     if current_user.rol != RolUsuario.ADMIN:
         raise HTTPException(status_code=403, detail="Acceso denegado. Se requieren permisos de administrador")
     return current_user
 
+# PAGINACIÓN POR CLAVE (KEYSET) DEL CATÁLOGO
+PRODUCTOS_PAGINA_DEFECTO = int(os.environ.get('PRODUCTOS_PAGINA_DEFECTO', '100'))
+PRODUCTOS_PAGINA_MAX = int(os.environ.get('PRODUCTOS_PAGINA_MAX', '200'))
+ORDENES_PRODUCTOS = {"fecha": "fecha_creacion", "precio": "precio", "nombre": "nombre"}
+# Tipo JSON del valor de cada orden dentro del cursor (la fecha viaja en ISO 8601)
+TIPOS_CURSOR = {"fecha": str, "precio": (int, float), "nombre": str}
+
+def codificar_cursor(orden: str, documento: Dict[str, Any]) -> str:
+    campo = ORDENES_PRODUCTOS[orden.lstrip('-')]
+    valor = documento[campo]
+    if isinstance(valor, datetime):
+        valor = valor.isoformat()
+    datos = json.dumps({"o": orden, "v": valor, "id": documento["id"]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(datos.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decodificar_cursor(cursor: str, orden: str) -> Dict[str, Any]:
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        if datos["o"] != orden:
+            raise ValueError("orden distinto")
+        # El cursor llega del cliente: un dict en "v" o "id" se convertiría en operadores de Mongo
+        if (not isinstance(datos["id"], str) or isinstance(datos["v"], bool)
+                or not isinstance(datos["v"], TIPOS_CURSOR[orden.lstrip('-')])):
+            raise ValueError("tipos no válidos")
+        if orden.lstrip('-') == "fecha":
+            datos["v"] = datetime.fromisoformat(datos["v"])
+        return datos
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def consulta_pagina_productos(query: Dict[str, Any], orden: str, cursor: Optional[str]):
+    """Añadir la condición keyset al filtro y devolver el orden (campo, id)"""
+    if orden.lstrip('-') not in ORDENES_PRODUCTOS:
+        raise HTTPException(status_code=400, detail="Orden no válido")
+    campo = ORDENES_PRODUCTOS[orden.lstrip('-')]
+    direccion = DESCENDING if orden.startswith('-') else ASCENDING
+    if cursor:
+        datos = decodificar_cursor(cursor, orden)
+        op = "$lt" if direccion == DESCENDING else "$gt"
+        query["$or"] = [
+            {campo: {op: datos["v"]}},
+            {campo: datos["v"], "id": {op: datos["id"]}}
+        ]
+    return [(campo, direccion), ("id", direccion)]
+
+# SERIALIZACIÓN RÁPIDA
+# Modo opcional (RESPUESTAS_RAPIDAS=true o cabecera X-Respuesta-Rapida: 1) para los
+# listados: proyecta solo los campos del modelo, confía en los documentos guardados
+# en lugar de validarlos dos veces y codifica directamente a bytes con orjson.
+RESPUESTAS_RAPIDAS = os.environ.get('RESPUESTAS_RAPIDAS', 'false').lower() == 'true'
+
+def modo_rapido(request: Request) -> bool:
+    return RESPUESTAS_RAPIDAS or request.headers.get("x-respuesta-rapida") == "1"
+
+def codificar_json(datos: Any) -> bytes:
+    """Codificar a JSON compacto (mismo formato que JSONResponse), con orjson si está instalado"""
+    if orjson is not None:
+        return orjson.dumps(datos, default=jsonable_encoder)
+    return json.dumps(jsonable_encoder(datos), ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+def campos_modelo(modelo) -> List[tuple]:
+    """(campo, valor por defecto) en el orden del modelo"""
+    return [
+        (nombre, None if campo.is_required() or campo.default_factory else campo.default)
+        for nombre, campo in modelo.model_fields.items()
+    ]
+
+def proyeccion_modelo(modelo) -> Dict[str, int]:
+    return {"_id": 0, **{nombre: 1 for nombre in modelo.model_fields}}
+
+def documentos_confiados(documentos: List[Dict[str, Any]], campos: List[tuple]) -> List[Dict[str, Any]]:
+    return [{nombre: documento.get(nombre, defecto) for nombre, defecto in campos} for documento in documentos]
+
+def respuesta_json(datos: Any) -> Response:
+    return Response(content=codificar_json(datos), media_type="application/json")
+
+CAMPOS_PRODUCTO = campos_modelo(Producto)
+PROYECCION_PRODUCTO = proyeccion_modelo(Producto)
+CAMPOS_PEDIDO = campos_modelo(Pedido)
+PROYECCION_PEDIDO = proyeccion_modelo(Pedido)
+CAMPOS_USUARIO_RESPUESTA = campos_modelo(UsuarioResponse)
+PROYECCION_USUARIO_RESPUESTA = proyeccion_modelo(UsuarioResponse)
+
+# RESPUESTAS CONDICIONALES DEL CATÁLOGO (ETag / Last-Modified)
+CATALOGO_CACHE_CONTROL = os.environ.get('CATALOGO_CACHE_CONTROL', 'public, max-age=60')
+
+class RespuestaCatalogo:
+    """Cuerpo JSON ya serializado junto con sus validadores HTTP"""
+    __slots__ = ("cuerpo", "etag", "ultima_modificacion", "siguiente")
+
+    def __init__(self, cuerpo: bytes, ultima_modificacion: Optional[datetime] = None, siguiente: Optional[str] = None):
+        self.cuerpo = cuerpo
+        self.etag = '"' + hashlib.sha256(cuerpo).hexdigest()[:32] + '"'
+        self.ultima_modificacion = ultima_modificacion.replace(microsecond=0) if ultima_modificacion else None
+        self.siguiente = siguiente
+
+def serializar_catalogo(datos: Any, ultima_modificacion: Optional[datetime] = None, siguiente: Optional[str] = None) -> RespuestaCatalogo:
+    return RespuestaCatalogo(codificar_json(datos), ultima_modificacion, siguiente)
+
+def fecha_modificacion_producto(producto: Dict[str, Any]) -> datetime:
+    return producto.get("fecha_actualizacion") or producto["fecha_creacion"]
+
+def no_modificado(request: Request, respuesta: RespuestaCatalogo, etag: Optional[str] = None) -> bool:
+    """Evaluar If-None-Match (prioritario) o If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [e.strip().removeprefix("W/") for e in if_none_match.split(",")]
+        return "*" in etags or (etag or respuesta.etag) in etags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and respuesta.ultima_modificacion:
+        try:
+            desde = parsedate_to_datetime(if_modified_since).astimezone(timezone.utc).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            return False
+        return respuesta.ultima_modificacion <= desde
+    return False
+
+def respuesta_catalogo(request: Request, respuesta: RespuestaCatalogo, headers: Optional[Dict[str, str]] = None) -> Response:
+    cabeceras = {"ETag": respuesta.etag, "Cache-Control": CATALOGO_CACHE_CONTROL}
+    if respuesta.ultima_modificacion:
+        cabeceras["Last-Modified"] = format_datetime(respuesta.ultima_modificacion.replace(tzinfo=timezone.utc), usegmt=True)
+    if headers:
+        cabeceras.update(headers)
+    if no_modificado(request, respuesta):
+        return Response(status_code=304, headers=cabeceras)
+    return Response(content=respuesta.cuerpo, media_type="application/json", headers=cabeceras)
+
+def cabeceras_paginacion(request: Request, siguiente: Optional[str]) -> Dict[str, str]:
+    if not siguiente:
+        return {}
+    return {
+        "X-Next-Cursor": siguiente,
+        "Link": f'<{request.url.include_query_params(cursor=siguiente)}>; rel="next"'
+    }
+
+# CACHE DEL CATÁLOGO
+class CacheCatalogo:
+    """Cache read-through de productos por id y de listados por categoría/consulta.
+
+    Las escrituras de administración incrementan la versión global y vacían los
+    listados; el listener opcional de change streams hace lo mismo cuando otro
+    worker modifica un producto (salvo si solo cambia su stock).
+    """
+
+    def __init__(self, maxsize_productos: int, maxsize_listados: int, ttl: float):
+        self.version = 0
+        self.ultima_escritura = datetime.utcnow()
+        self.productos = CacheTTL(maxsize_productos, ttl)
+        self.listados = CacheTTL(maxsize_listados, ttl)
+        # Señal para regenerar las instantáneas; activa al arrancar para la primera generación
+        self.cambios = asyncio.Event()
+        self.cambios.set()
+
+    def invalidar(self, producto_id: Optional[str] = None):
+        self.version += 1
+        self.ultima_escritura = datetime.utcnow()
+        self.cambios.set()
+        if producto_id:
+            self.productos.invalidar(producto_id)
+        else:
+            self.productos.limpiar()
+        self.listados.limpiar()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "productos": self.productos.stats(),
+            "listados": self.listados.stats()
+        }
+
+catalogo_cache = CacheCatalogo(
+    maxsize_productos=int(os.environ.get('CATALOGO_CACHE_PRODUCTOS', '5000')),
+    maxsize_listados=int(os.environ.get('CATALOGO_CACHE_LISTADOS', '1000')),
+    ttl=float(os.environ.get('CATALOGO_CACHE_TTL', '30'))
+)
+
+def cambio_solo_stock(cambio: Dict[str, Any]) -> bool:
+    """Update que solo toca el stock (reservas, expiraciones): no invalida el catálogo"""
+    descripcion = cambio.get("updateDescription") or {}
+    return (
+        cambio["operationType"] == "update"
+        and set(descripcion.get("updatedFields", {})) <= {"stock"}
+        and not descripcion.get("removedFields")
+    )
+
+def producto_de_cambio(cambio: Dict[str, Any]) -> Optional[str]:
+    """id del producto afectado; None si el evento no lo trae (borrados) y hay que vaciar todo"""
+    return (cambio.get("fullDocument") or {}).get("id")
+
+async def escuchar_cambios_catalogo():
+    """Invalidar en el cache los productos que cambian (requiere replica set)"""
+    espera = 1
+    while True:
+        try:
+            # documentKey solo trae el _id: updateLookup añade el documento con su id
+            async with db.productos.watch(full_document="updateLookup") as stream:
+                espera = 1
+                async for cambio in stream:
+                    # El stock de los listados puede ir hasta CATALOGO_CACHE_TTL por detrás
+                    if cambio_solo_stock(cambio):
+                        continue
+                    catalogo_cache.invalidar(producto_de_cambio(cambio))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Change stream del catálogo interrumpido: {e}")
+            # Sin notificaciones no hay garantía de coherencia: vaciar y reintentar
+            catalogo_cache.invalidar()
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 60)
+
+# INSTANTÁNEAS PRECOMPRIMIDAS DEL CATÁLOGO
+# La primera página por defecto del catálogo completo y de cada categoría es igual
+# para todos los visitantes: se genera en segundo plano tras cada cambio, se codifica
+# y se comprime (gzip y, si está instalado, brotli) una sola vez y se sirve tal cual.
+# Una instantánea de una versión anterior del catálogo nunca se sirve, y sin change
+# streams se regeneran además cada CATALOGO_CACHE_TTL para recoger cambios de otros workers.
+CATALOGO_INSTANTANEAS = os.environ.get('CATALOGO_INSTANTANEAS', 'true').lower() == 'true'
+CATALOGO_INSTANTANEAS_ESPERA = float(os.environ.get('CATALOGO_INSTANTANEAS_ESPERA', '0.5'))
+
+class InstantaneaCatalogo:
+    """Página serializada con sus variantes comprimidas"""
+    __slots__ = ("version", "creada", "respuesta", "variantes")
+
+    def __init__(self, version: int, respuesta: RespuestaCatalogo):
+        self.version = version
+        self.creada = time.monotonic()
+        self.respuesta = respuesta
+        self.variantes = {"gzip": gzip.compress(respuesta.cuerpo, compresslevel=9)}
+        if brotli is not None:
+            self.variantes["br"] = brotli.compress(respuesta.cuerpo, quality=11)
+
+def elegir_codificacion(accept_encoding: Optional[str], disponibles) -> Optional[str]:
+    """Negociar Accept-Encoding; None significa enviar el cuerpo sin comprimir"""
+    if not accept_encoding:
+        return None
+    calidades: Dict[str, float] = {}
+    for parte in accept_encoding.split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        calidad = 1.0
+        parametros = parametros.strip()
+        if parametros.startswith("q="):
+            try:
+                calidad = float(parametros[2:])
+            except ValueError:
+                calidad = 0.0
+        calidades[nombre.strip().lower()] = calidad
+    comodin = calidades.get("*", 0.0)
+    # Preferencia del servidor ante empate: brotli comprime más que gzip
+    candidatas = [(calidades.get(c, comodin), -i, c) for i, c in enumerate(("br", "gzip")) if c in disponibles]
+    calidad, _, codificacion = max(candidatas, default=(0.0, 0, None))
+    return codificacion if calidad > 0 else None
+
+class InstantaneasCatalogo:
+    """Instantáneas por categoría (None = catálogo completo), regeneradas al cambiar el catálogo"""
+
+    def __init__(self, espera: float, ttl: float):
+        self.espera = espera
+        self.ttl = ttl
+        self.instantaneas: Dict[Optional[str], InstantaneaCatalogo] = {}
+        self.regeneraciones = 0
+        self.servidas = 0
+        self.ultima_duracion = 0.0
+
+    def obtener(self, categoria: Optional[str]) -> Optional[InstantaneaCatalogo]:
+        instantanea = self.instantaneas.get(categoria)
+        if instantanea is None or instantanea.version != catalogo_cache.version:
+            return None
+        if time.monotonic() - instantanea.creada > self.ttl:
+            return None
+        self.servidas += 1
+        return instantanea
+
+    async def _generar(self, categoria: Optional[str], version: int) -> InstantaneaCatalogo:
+        query: Dict[str, Any] = {"activo": True}
+        if categoria:
+            query["categoria"] = categoria
+        sort = consulta_pagina_productos(query, "fecha", None)
+        limite = PRODUCTOS_PAGINA_DEFECTO
+        productos = await db.productos.find(query, PROYECCION_PRODUCTO).sort(sort).limit(limite + 1).to_list(limite + 1)
+        siguiente = None
+        if len(productos) > limite:
+            productos = productos[:limite]
+            siguiente = codificar_cursor("fecha", productos[-1])
+        ultima_modificacion = max([fecha_modificacion_producto(p) for p in productos] + [catalogo_cache.ultima_escritura])
+        datos = [Producto(**producto) for producto in productos]
+        respuesta = serializar_catalogo(datos, ultima_modificacion, siguiente)
+        # La compresión (sobre todo brotli nivel 11) es CPU pura: fuera del event loop
+        return await asyncio.to_thread(InstantaneaCatalogo, version, respuesta)
+
+    async def regenerar(self):
+        version = catalogo_cache.version
+        inicio = time.perf_counter()
+        categorias = [None] + [c.value for c in TipoPatines]
+        generadas = await asyncio.gather(*(self._generar(c, version) for c in categorias))
+        # Si el catálogo cambió mientras se generaban, la señal ya está activa de nuevo
+        if catalogo_cache.version != version:
+            return
+        self.instantaneas = dict(zip(categorias, generadas))
+        self.regeneraciones += 1
+        self.ultima_duracion = time.perf_counter() - inicio
+
+    async def mantener(self):
+        """Regenerar tras cada cambio, agrupando las ráfagas de escrituras"""
+        while True:
+            try:
+                await asyncio.wait_for(catalogo_cache.cambios.wait(), timeout=self.ttl / 2)
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.sleep(self.espera)
+            catalogo_cache.cambios.clear()
+            try:
+                await self.regenerar()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Error regenerando instantáneas del catálogo: {e}")
+                await asyncio.sleep(5)
+                catalogo_cache.cambios.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "instantaneas": len(self.instantaneas),
+            "vigentes": sum(1 for i in self.instantaneas.values() if i.version == catalogo_cache.version),
+            "regeneraciones": self.regeneraciones,
+            "servidas": self.servidas,
+            "ultima_duracion_ms": round(self.ultima_duracion * 1000, 2),
+            "brotli": brotli is not None
+        }
+
+instantaneas_catalogo = InstantaneasCatalogo(CATALOGO_INSTANTANEAS_ESPERA, catalogo_cache.productos.ttl)
+
+def respuesta_instantanea(request: Request, instantanea: InstantaneaCatalogo) -> Response:
+    """Servir la variante aceptada por el cliente con un ETag propio por codificación"""
+    respuesta = instantanea.respuesta
+    codificacion = elegir_codificacion(request.headers.get("accept-encoding"), instantanea.variantes)
+    etag = respuesta.etag if codificacion is None else f'{respuesta.etag[:-1]}-{codificacion}"'
+    cabeceras = {"ETag": etag, "Cache-Control": CATALOGO_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    cabeceras["Last-Modified"] = format_datetime(respuesta.ultima_modificacion.replace(tzinfo=timezone.utc), usegmt=True)
+    cabeceras.update(cabeceras_paginacion(request, respuesta.siguiente))
+    if no_modificado(request, respuesta, etag):
+        return Response(status_code=304, headers=cabeceras)
+    if codificacion is None:
+        return Response(content=respuesta.cuerpo, media_type="application/json", headers=cabeceras)
+    cabeceras["Content-Encoding"] = codificacion
+    return Response(content=instantanea.variantes[codificacion], media_type="application/json", headers=cabeceras)
+
+# Tareas en segundo plano lanzadas al arrancar y canceladas al apagar
+tareas_fondo: List[asyncio.Task] = []
+
+# ESTADÍSTICAS PRE-AGREGADAS
+# Contadores globales en `estadisticas` y un documento por día en `ventas_diarias`
+# ({_id: "YYYY-MM-DD", total, pedidos, por_categoria, por_metodo_pago}), mantenidos
+# con $inc en cada escritura y corregidos periódicamente por reconciliar_estadisticas.
+# El documento "cobertura" guarda desde qué día los buckets son completos: la primera
+# reconciliación reconstruye todo el histórico y las siguientes solo los últimos días.
+ESTADISTICAS_RECONCILIACION_SEGUNDOS = int(os.environ.get('ESTADISTICAS_RECONCILIACION_SEGUNDOS', '3600'))
+ESTADISTICAS_RECONCILIACION_DIAS = int(os.environ.get('ESTADISTICAS_RECONCILIACION_DIAS', '90'))
+
+def _clave_estadistica(valor: str) -> str:
+    # Los nombres de campo de Mongo no admiten "." ni "$" iniciales
+    return str(getattr(valor, "value", valor)).replace(".", "_").lstrip("$") or "desconocido"
+
+async def incrementar_contadores(**deltas: int):
+    await db.estadisticas.update_one({"_id": "contadores"}, {"$inc": deltas}, upsert=True)
+
+async def registrar_venta(pedido: Pedido):
+    """Sumar un pedido a su bucket diario"""
+    dia = pedido.fecha_pedido.replace(hour=0, minute=0, second=0, microsecond=0)
+    incrementos: Dict[str, Any] = {
+        "total": pedido.total,
+        "pedidos": 1,
+        f"por_metodo_pago.{_clave_estadistica(pedido.metodo_pago)}": pedido.total
+    }
+    for linea in pedido.lineas:
+        clave = f"por_categoria.{_clave_estadistica(linea.categoria.value)}"
+        incrementos[clave] = incrementos.get(clave, 0) + linea.subtotal
+    await db.ventas_diarias.update_one(
+        {"_id": dia.strftime("%Y-%m-%d")},
+        {"$inc": incrementos, "$setOnInsert": {"fecha": dia}},
+        upsert=True
+    )
+    await incrementar_contadores(pedidos=1)
+
+ESTADISTICAS_INICIO_HISTORICO = datetime(1970, 1, 1)
+
+async def reconciliar_estadisticas(dias: Optional[int] = ESTADISTICAS_RECONCILIACION_DIAS):
+    """Recalcular contadores y buckets diarios desde las colecciones origen (dias=None: todo)"""
+    contadores = {
+        "productos_activos": await db.productos.count_documents({"activo": True}),
+        "usuarios_activos": await db.usuarios.count_documents({"activo": True}),
+        "pedidos": await db.pedidos.count_documents({})
+    }
+    await db.estadisticas.replace_one({"_id": "contadores"}, contadores, upsert=True)
+    
+    hoy = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    inicio = ESTADISTICAS_INICIO_HISTORICO if dias is None else hoy - timedelta(days=dias)
+    formato_dia = {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha_pedido"}}
+    buckets: Dict[str, Dict[str, Any]] = {}
+    
+    por_metodo = db.pedidos.aggregate([
+        {"$match": {"fecha_pedido": {"$gte": inicio}}},
+        {"$group": {"_id": {"dia": formato_dia, "metodo": "$metodo_pago"}, "total": {"$sum": "$total"}, "pedidos": {"$sum": 1}}}
+    ])
+    async for fila in por_metodo:
+        dia = fila["_id"]["dia"]
+        bucket = buckets.setdefault(dia, {"fecha": datetime.strptime(dia, "%Y-%m-%d"), "total": 0, "pedidos": 0, "por_categoria": {}, "por_metodo_pago": {}})
+        bucket["total"] += fila["total"]
+        bucket["pedidos"] += fila["pedidos"]
+        metodo = _clave_estadistica(fila["_id"]["metodo"])
+        bucket["por_metodo_pago"][metodo] = bucket["por_metodo_pago"].get(metodo, 0) + fila["total"]
+    
+    por_categoria = db.pedidos.aggregate([
+        {"$match": {"fecha_pedido": {"$gte": inicio}}},
+        {"$unwind": "$lineas"},
+        {"$group": {"_id": {"dia": formato_dia, "categoria": "$lineas.categoria"}, "total": {"$sum": "$lineas.subtotal"}}}
+    ])
+    async for fila in por_categoria:
+        bucket = buckets.get(fila["_id"]["dia"])
+        if bucket is not None:
+            bucket["por_categoria"][_clave_estadistica(fila["_id"]["categoria"])] = fila["total"]
+    
+    operaciones = [ReplaceOne({"_id": dia}, bucket, upsert=True) for dia, bucket in buckets.items()]
+    if operaciones:
+        await db.ventas_diarias.bulk_write(operaciones, ordered=False)
+    # Días del periodo sin pedidos: eliminar buckets que hayan quedado con deriva
+    await db.ventas_diarias.delete_many({"fecha": {"$gte": inicio}, "_id": {"$nin": list(buckets)}})
+    await db.estadisticas.update_one({"_id": "cobertura"}, {"$min": {"desde": inicio}}, upsert=True)
+    return contadores
+
+async def cobertura_estadisticas() -> Optional[datetime]:
+    """Primer día con buckets completos; None si nunca se han reconstruido"""
+    cobertura = await db.estadisticas.find_one({"_id": "cobertura"})
+    return cobertura["desde"] if cobertura else None
+
+async def reconciliar_estadisticas_periodicamente():
+    while True:
+        try:
+            # Con varios workers la reconciliación la hace uno solo por intervalo
+            if await adquirir_bloqueo("reconciliar_estadisticas", bloqueo_por_intervalo(ESTADISTICAS_RECONCILIACION_SEGUNDOS)):
+                # Hasta completar una reconstrucción de todo el histórico, hacerla en cada vuelta
+                desde = await cobertura_estadisticas()
+                completa = desde is not None and desde <= ESTADISTICAS_INICIO_HISTORICO
+                await reconciliar_estadisticas(ESTADISTICAS_RECONCILIACION_DIAS if completa else None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Error reconciliando estadísticas: {e}")
+        await asyncio.sleep(ESTADISTICAS_RECONCILIACION_SEGUNDOS)
+
+# CLIENTE DE PAGOS
+class StripeCheckoutFalso:
+    """Pasarela local sin red para desarrollo y benchmarks (PAGOS_BACKEND=falso)"""
+    latencia = float(os.environ.get('PAGOS_FALSO_LATENCIA', '0.05'))
+    # Compartido entre instancias: la sesión se crea y se consulta con checkouts distintos
+    sesiones: Dict[str, float] = {}
+
+    def __init__(self, api_key: Optional[str], webhook_url: str = ""):
+        self.webhook_url = webhook_url
+
+    async def create_checkout_session(self, checkout_request: CheckoutSessionRequest) -> CheckoutSessionResponse:
+        await asyncio.sleep(self.latencia)
+        session_id = f"cs_falso_{uuid.uuid4().hex}"
+        self.sesiones[session_id] = checkout_request.amount
+        return CheckoutSessionResponse(url=f"https://checkout.stripe.test/{session_id}", session_id=session_id)
+
+    async def get_checkout_status(self, session_id: str) -> CheckoutStatusResponse:
+        await asyncio.sleep(self.latencia)
+        return CheckoutStatusResponse(
+            status="complete",
+            payment_status="paid",
+            amount_total=int(round(self.sesiones.get(session_id, 0) * 100)),
+            currency="eur",
+            metadata={}
+        )
+
+    async def handle_webhook(self, body: bytes, signature: Optional[str]):
+        # Formato simplificado de evento de Stripe, sin verificación de firma
+        evento = json.loads(body)
+        sesion = evento["data"]["object"]
+        return types.SimpleNamespace(
+            event_type=evento["type"],
+            event_id=evento["id"],
+            session_id=sesion["id"],
+            payment_status=sesion.get("payment_status", "unpaid"),
+            metadata=sesion.get("metadata", {})
+        )
+
+def _configurar_transporte_stripe(timeout: float, conexiones: int):
+    """Sesión HTTP keep-alive compartida para el SDK de Stripe, si está instalado"""
+    try:
+        import stripe
+        import requests
+        from requests.adapters import HTTPAdapter
+        clase_cliente = getattr(stripe, "RequestsClient", None) or stripe.http_client.RequestsClient
+    except (ImportError, AttributeError):
+        return None
+    sesion = requests.Session()
+    sesion.mount("https://", HTTPAdapter(pool_connections=conexiones, pool_maxsize=conexiones))
+    stripe.default_http_client = clase_cliente(timeout=timeout, session=sesion)
+    # Los reintentos los gestiona ClientePagos
+    stripe.max_network_retries = 0
+    return sesion
+
+class ClientePagos:
+    """Cliente de pagos de ámbito de aplicación: transporte compartido,
+    timeout por llamada, reintentos acotados con jitter y límite de concurrencia"""
+
+    def __init__(self, api_key: Optional[str], fabrica=StripeCheckout, timeout: float = PAGOS_TIMEOUT,
+                 reintentos: int = PAGOS_REINTENTOS, concurrencia: int = PAGOS_CONCURRENCIA):
+        self.api_key = api_key
+        self.fabrica = fabrica
+        self.timeout = timeout
+        self.reintentos = reintentos
+        self.concurrencia = concurrencia
+        self._semaforo = asyncio.Semaphore(concurrencia)
+        # Sin PAGOS_WEBHOOK_URL la URL sale de la cabecera Host: LRU acotado
+        self._checkouts = CacheTTL(PAGOS_CHECKOUTS_MAX, 24 * 3600)
+        self._sesion_http = _configurar_transporte_stripe(timeout, concurrencia) if fabrica is StripeCheckout else None
+        self.llamadas = 0
+        self.errores = 0
+        self.reintentos_hechos = 0
+        self.timeouts = 0
+        self.en_curso = 0
+
+    def _checkout(self, webhook_url: str = ""):
+        webhook_url = PAGOS_WEBHOOK_URL or webhook_url
+        checkout = self._checkouts.get(webhook_url)
+        if checkout is None:
+            checkout = self.fabrica(api_key=self.api_key, webhook_url=webhook_url)
+            self._checkouts.set(webhook_url, checkout)
+        return checkout
+
+    async def _llamar(self, fn, *args, reintentables=(Exception,)):
+        intento = 0
+        while True:
+            self.llamadas += 1
+            try:
+                async with self._semaforo:
+                    self.en_curso += 1
+                    try:
+                        return await asyncio.wait_for(fn(*args), self.timeout)
+                    finally:
+                        self.en_curso -= 1
+            except asyncio.TimeoutError as e:
+                self.timeouts += 1
+                error = e
+            except reintentables as e:
+                error = e
+            except Exception:
+                self.errores += 1
+                raise
+            if intento >= self.reintentos or not isinstance(error, reintentables):
+                self.errores += 1
+                raise error
+            intento += 1
+            self.reintentos_hechos += 1
+            await asyncio.sleep(min(0.2 * 2 ** intento, 2.0) * random.uniform(0.5, 1.5))
+
+    async def crear_sesion(self, checkout_request: CheckoutSessionRequest, webhook_url: str):
+        # Solo se reintentan errores de conexión: un timeout podría haber creado ya la sesión
+        return await self._llamar(
+            self._checkout(webhook_url).create_checkout_session, checkout_request,
+            reintentables=(ConnectionError,)
+        )
+
+    async def estado_sesion(self, session_id: str):
+        return await self._llamar(self._checkout().get_checkout_status, session_id)
+
+    async def procesar_webhook(self, body: bytes, signature: Optional[str]):
+        return await self._checkout().handle_webhook(body, signature)
+
+    def cerrar(self):
+        self._checkouts.limpiar()
+        if self._sesion_http is not None:
+            self._sesion_http.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "falso" if self.fabrica is StripeCheckoutFalso else "stripe",
+            "llamadas": self.llamadas,
+            "errores": self.errores,
+            "reintentos": self.reintentos_hechos,
+            "timeouts": self.timeouts,
+            "en_curso": self.en_curso,
+            "concurrencia_max": self.concurrencia
+        }
+
+cliente_pagos: Optional[ClientePagos] = None
+
+def obtener_cliente_pagos() -> ClientePagos:
+    global cliente_pagos
+    if cliente_pagos is None:
+        if PAGOS_BACKEND == "falso":
+            cliente_pagos = ClientePagos(STRIPE_API_KEY, fabrica=StripeCheckoutFalso)
+        else:
+            if not STRIPE_API_KEY:
+                raise HTTPException(status_code=500, detail="Stripe no configurado")
+            cliente_pagos = ClientePagos(STRIPE_API_KEY)
+    return cliente_pagos
+
+def opciones_caducidad_sesion() -> Dict[str, Any]:
+    """expires_at de la sesión de checkout, si la versión de la librería lo admite"""
+    if "expires_at" not in getattr(CheckoutSessionRequest, "model_fields", {}):
+        return {}
+    return {"expires_at": int((datetime.now(timezone.utc) + timedelta(seconds=PAGOS_SESION_TTL)).timestamp())}
+
+# RESERVAS DE STOCK
+# Cada reserva descuenta stock con updates condicionales ({"stock": {"$gte": n}}),
+# una por producto y en paralelo, sin leer-modificar-escribir. Si el pago no la
+# confirma antes de INVENTARIO_RESERVA_TTL segundos, el barrido la expira y
+# devuelve el stock. Los checkouts de Stripe la alargan hasta que caduca la sesión y
+# los pedidos con otros métodos de pago la confirman al crearse; si un pago llega
+# con la reserva ya expirada, confirmar intenta reservar de nuevo. Los productos muy disputados pueden repartir su stock en
+# fragmentos (stock_fragmentos) para que las reservas no compitan por un documento.
+INVENTARIO_RESERVA_TTL = int(os.environ.get('INVENTARIO_RESERVA_TTL', '900'))
+INVENTARIO_BARRIDO_SEGUNDOS = int(os.environ.get('INVENTARIO_BARRIDO_SEGUNDOS', '30'))
+# Métodos cuyo pago confirma un webhook o la consulta de estado; el resto retiene el
+# stock desde que se crea el pedido
+METODOS_PAGO_PASARELA = {m.strip() for m in os.environ.get('METODOS_PAGO_PASARELA', 'stripe').split(',')}
+
+class InventarioReservas:
+    def __init__(self):
+        self.reservas = 0
+        self.rechazadas = 0
+        self.confirmadas = 0
+        self.expiradas = 0
+        self.rereservadas = 0
+        self.sin_stock_al_confirmar = 0
+
+    async def _descontar_fragmentos(self, producto_id: str, cantidad: int) -> bool:
+        fragmentos = await db.stock_fragmentos.find(
+            {"producto_id": producto_id, "stock": {"$gt": 0}}, {"_id": 0, "fragmento": 1, "stock": 1}
+        ).to_list(None)
+        random.shuffle(fragmentos)
+        # Primero un fragmento que cubra toda la cantidad; si no, sumar parciales
+        for fragmento in fragmentos:
+            if fragmento["stock"] >= cantidad:
+                resultado = await db.stock_fragmentos.update_one(
+                    {"producto_id": producto_id, "fragmento": fragmento["fragmento"], "stock": {"$gte": cantidad}},
+                    {"$inc": {"stock": -cantidad}}
+                )
+                if resultado.modified_count:
+                    return True
+        tomado = []
+        restante = cantidad
+        for fragmento in fragmentos:
+            parte = min(restante, fragmento["stock"])
+            resultado = await db.stock_fragmentos.update_one(
+                {"producto_id": producto_id, "fragmento": fragmento["fragmento"], "stock": {"$gte": parte}},
+                {"$inc": {"stock": -parte}}
+            )
+            if resultado.modified_count:
+                tomado.append((fragmento["fragmento"], parte))
+                restante -= parte
+                if restante == 0:
+                    return True
+        for numero, parte in tomado:
+            await db.stock_fragmentos.update_one({"producto_id": producto_id, "fragmento": numero}, {"$inc": {"stock": parte}})
+        return False
+
+    async def _descontar(self, producto_id: str, cantidad: int, fragmentado: bool) -> bool:
+        if fragmentado:
+            return await self._descontar_fragmentos(producto_id, cantidad)
+        resultado = await db.productos.update_one(
+            {"id": producto_id, "stock": {"$gte": cantidad}},
+            {"$inc": {"stock": -cantidad}}
+        )
+        return resultado.modified_count == 1
+
+    async def _devolver(self, producto_id: str, cantidad: int, fragmentado: bool):
+        if fragmentado:
+            await db.stock_fragmentos.update_one(
+                {"producto_id": producto_id, "fragmento": random.randrange(await self._num_fragmentos(producto_id))},
+                {"$inc": {"stock": cantidad}}
+            )
+        else:
+            await db.productos.update_one({"id": producto_id}, {"$inc": {"stock": cantidad}})
+
+    async def _num_fragmentos(self, producto_id: str) -> int:
+        return max(await db.stock_fragmentos.count_documents({"producto_id": producto_id}), 1)
+
+    async def reservar(self, carrito_id: str, cotizacion: CotizacionCarrito, fragmentados: set,
+                       ttl: int = INVENTARIO_RESERVA_TTL) -> str:
+        """Reservar el stock de todas las líneas del carrito (idempotente por carrito)"""
+        expira_en = datetime.utcnow() + timedelta(seconds=ttl)
+        existente = await db.reservas_stock.find_one({"carrito_id": carrito_id, "vigente": True}, {"_id": 0, "id": 1})
+        if existente:
+            # Un checkout sobre la reserva de un pedido la alarga hasta el fin de la sesión
+            await db.reservas_stock.update_one({"id": existente["id"], "estado": "activa"}, {"$max": {"expira_en": expira_en}})
+            return existente["id"]
+        
+        cantidades: Dict[str, int] = {}
+        for linea in cotizacion.lineas:
+            cantidades[linea.producto_id] = cantidades.get(linea.producto_id, 0) + linea.cantidad
+        productos = list(cantidades)
+        resultados = await asyncio.gather(*(
+            self._descontar(pid, cantidades[pid], pid in fragmentados) for pid in productos
+        ))
+        
+        if not all(resultados):
+            await asyncio.gather(*(
+                self._devolver(pid, cantidades[pid], pid in fragmentados)
+                for pid, ok in zip(productos, resultados) if ok
+            ))
+            self.rechazadas += 1
+            nombres = {l.producto_id: l.nombre for l in cotizacion.lineas}
+            agotados = [nombres[pid] for pid, ok in zip(productos, resultados) if not ok]
+            raise HTTPException(status_code=409, detail=f"Stock insuficiente para {', '.join(agotados)}")
+        
+        reserva = {
+            "id": str(uuid.uuid4()),
+            "carrito_id": carrito_id,
+            "lineas": [{"producto_id": l.producto_id, "talla": l.talla, "color": l.color, "cantidad": l.cantidad} for l in cotizacion.lineas],
+            "cantidades": cantidades,
+            "fragmentados": [pid for pid in productos if pid in fragmentados],
+            "estado": "activa",
+            "vigente": True,
+            "fecha_creacion": datetime.utcnow(),
+            "expira_en": expira_en
+        }
+        try:
+            await db.reservas_stock.insert_one(reserva)
+        except DuplicateKeyError:
+            # Otra petición reservó el mismo carrito a la vez: deshacer la nuestra
+            await asyncio.gather(*(self._devolver(pid, n, pid in fragmentados) for pid, n in cantidades.items()))
+            existente = await db.reservas_stock.find_one({"carrito_id": carrito_id, "vigente": True}, {"_id": 0, "id": 1})
+            return existente["id"]
+        self.reservas += 1
+        return reserva["id"]
+
+    async def confirmar(self, carrito_id: str) -> bool:
+        """Confirmar la reserva del carrito; False si el stock ya no se puede retener"""
+        resultado = await db.reservas_stock.update_many(
+            {"carrito_id": carrito_id, "estado": "activa"},
+            {"$set": {"estado": "confirmada"}, "$unset": {"expira_en": ""}}
+        )
+        self.confirmadas += resultado.modified_count
+        if resultado.modified_count:
+            return True
+        if await db.reservas_stock.find_one({"carrito_id": carrito_id, "estado": "confirmada"}, {"_id": 1}):
+            return True
+        # El pago llegó después de que el barrido devolviera el stock: volver a reservarlo
+        anterior = await db.reservas_stock.find_one(
+            {"carrito_id": carrito_id, "estado": {"$in": ["expirada", "liberada"]}},
+            sort=[("fecha_creacion", DESCENDING)]
+        )
+        if anterior is None:
+            return False
+        return await self._reservar_de_nuevo(anterior)
+
+    async def _reservar_de_nuevo(self, anterior: Dict[str, Any]) -> bool:
+        fragmentados = set(anterior.get("fragmentados", []))
+        cantidades = anterior["cantidades"]
+        productos = list(cantidades)
+        resultados = await asyncio.gather(*(self._descontar(pid, cantidades[pid], pid in fragmentados) for pid in productos))
+        if not all(resultados):
+            await asyncio.gather(*(
+                self._devolver(pid, cantidades[pid], pid in fragmentados)
+                for pid, ok in zip(productos, resultados) if ok
+            ))
+            self.sin_stock_al_confirmar += 1
+            return False
+        reserva = {
+            **{k: v for k, v in anterior.items() if k not in ("_id", "expira_en")},
+            "id": str(uuid.uuid4()),
+            "estado": "confirmada",
+            "vigente": True,
+            "fecha_creacion": datetime.utcnow()
+        }
+        try:
+            await db.reservas_stock.insert_one(reserva)
+        except DuplicateKeyError:
+            # Otro evento del mismo pago ya la volvió a reservar
+            await asyncio.gather(*(self._devolver(pid, n, pid in fragmentados) for pid, n in cantidades.items()))
+            return True
+        await db.pedidos.update_many({"carrito_id": anterior["carrito_id"]}, {"$set": {"reserva_id": reserva["id"]}})
+        self.rereservadas += 1
+        return True
+
+    async def _liberar(self, filtro: Dict[str, Any], estado: str) -> bool:
+        # Reclamar la reserva primero garantiza que el stock se devuelve una sola vez
+        reserva = await db.reservas_stock.find_one_and_update(
+            {**filtro, "estado": "activa"},
+            {"$set": {"estado": estado}, "$unset": {"vigente": ""}}
+        )
+        if reserva is None:
+            return False
+        fragmentados = set(reserva.get("fragmentados", []))
+        await asyncio.gather(*(
+            self._devolver(pid, n, pid in fragmentados) for pid, n in reserva["cantidades"].items()
+        ))
+        return True
+
+    async def liberar(self, reserva_id: str) -> bool:
+        return await self._liberar({"id": reserva_id}, "liberada")
+
+    async def expirar_vencidas(self) -> int:
+        expiradas = 0
+        while await self._liberar({"expira_en": {"$lt": datetime.utcnow()}}, "expirada"):
+            expiradas += 1
+        self.expiradas += expiradas
+        return expiradas
+
+    async def repartir_fragmentos(self, producto_id: str, stock: int, fragmentos: int):
+        await db.stock_fragmentos.delete_many({"producto_id": producto_id})
+        base, resto = divmod(stock, fragmentos)
+        await db.stock_fragmentos.insert_many([
+            {"producto_id": producto_id, "fragmento": i, "stock": base + (1 if i < resto else 0)}
+            for i in range(fragmentos)
+        ])
+
+    async def sincronizar_stock_fragmentado(self):
+        """Reflejar en productos.stock la suma de los fragmentos (solo informativo)"""
+        totales = db.stock_fragmentos.aggregate([{"$group": {"_id": "$producto_id", "stock": {"$sum": "$stock"}}}])
+        async for total in totales:
+            await db.productos.update_one({"id": total["_id"], "stock_fragmentado": True}, {"$set": {"stock": total["stock"]}})
+
+    async def barrer_periodicamente(self):
+        while True:
+            try:
+                await self.expirar_vencidas()
+                await self.sincronizar_stock_fragmentado()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Error expirando reservas de stock: {e}")
+            await asyncio.sleep(INVENTARIO_BARRIDO_SEGUNDOS)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "reservas": self.reservas,
+            "rechazadas": self.rechazadas,
+            "confirmadas": self.confirmadas,
+            "expiradas": self.expiradas,
+            "rereservadas": self.rereservadas,
+            "sin_stock_al_confirmar": self.sin_stock_al_confirmar
+        }
+
+inventario = InventarioReservas()
+
+# BANDEJA DE ENTRADA DE WEBHOOKS
+# El webhook solo verifica y guarda el evento (con su id como _id único) y responde;
+# un pool de workers en segundo plano aplica las transiciones de forma idempotente.
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '2'))
+WEBHOOK_LOTE = int(os.environ.get('WEBHOOK_LOTE', '50'))
+WEBHOOK_MAX_INTENTOS = int(os.environ.get('WEBHOOK_MAX_INTENTOS', '8'))
+WEBHOOK_INTERVALO = float(os.environ.get('WEBHOOK_INTERVALO', '1'))
+WEBHOOK_BLOQUEO_SEGUNDOS = int(os.environ.get('WEBHOOK_BLOQUEO_SEGUNDOS', '60'))
+
+async def actualizar_estado_transaccion(session_id: str, payment_status: str, cambios: Dict[str, Any]) -> bool:
+    """Guardar un nuevo estado de pago y, si queda pagado, confirmar reserva y pedidos"""
+    # Un pago confirmado no retrocede aunque llegue después un estado antiguo
+    transaccion = await db.payment_transactions.find_one_and_update(
+        {"session_id": session_id, "payment_status": {"$ne": "paid"}},
+        {"$set": {"payment_status": payment_status, **cambios}},
+        projection={"_id": 0, "carrito_id": 1}
+    )
+    estados_pago.invalidar(session_id)
+    if transaccion is None:
+        return False
+    if payment_status == "paid":
+        if not await inventario.confirmar(transaccion["carrito_id"]):
+            logging.getLogger(__name__).error(f"Pago {session_id} confirmado sin stock retenido para el carrito {transaccion['carrito_id']}")
+            await db.pedidos.update_many({"carrito_id": transaccion["carrito_id"]}, {"$set": {"incidencia_stock": True}})
+        pendientes = await db.pedidos.find(
+            {"carrito_id": transaccion["carrito_id"], "estado": "pendiente"}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        await db.pedidos.update_many(
+            {"carrito_id": transaccion["carrito_id"], "estado": "pendiente"},
+            {"$set": {"estado": "pagado"}}
+        )
+        if not EVENTOS_CHANGE_STREAM:
+            for pedido in pendientes:
+                centro_eventos.publicar(f"pedido:{pedido['id']}")
+    if not EVENTOS_CHANGE_STREAM:
+        centro_eventos.publicar(f"pago:{session_id}")
+    return True
+
+async def aplicar_evento_pago(evento: Dict[str, Any]):
+    """Aplicar un evento de pago; repetirlo no cambia el resultado"""
+    cambios = {"evento_id": evento["_id"]}
+    if evento["payment_status"] == "paid":
+        # Una sesión pagada está completa aunque el último estado consultado fuese "open"
+        cambios["status"] = "complete"
+    await actualizar_estado_transaccion(evento["session_id"], evento["payment_status"], cambios)
+
+class ProcesadorWebhooks:
+    """Workers que drenan webhook_inbox por lotes con reintentos y backoff"""
+
+    def __init__(self, workers: int, lote: int):
+        self.workers = workers
+        self.lote = lote
+        self._despertar = asyncio.Event()
+        self.recibidos = 0
+        self.duplicados = 0
+        self.procesados = 0
+        self.reintentos = 0
+        self.fallidos = 0
+        self.lag_segundos = 0.0
+        self._ventana: deque = deque()
+
+    def notificar(self):
+        self._despertar.set()
+
+    async def _reclamar(self) -> List[Dict[str, Any]]:
+        ahora = datetime.utcnow()
+        filtro = {"$or": [
+            {"estado": "pendiente", "proximo_intento": {"$lte": ahora}},
+            # Eventos de un worker que murió a mitad de proceso
+            {"estado": "procesando", "bloqueado_hasta": {"$lt": ahora}}
+        ]}
+        reclamados = []
+        for _ in range(self.lote):
+            evento = await db.webhook_inbox.find_one_and_update(
+                filtro,
+                {"$set": {"estado": "procesando", "bloqueado_hasta": ahora + timedelta(seconds=WEBHOOK_BLOQUEO_SEGUNDOS)}},
+                sort=[("proximo_intento", ASCENDING)]
+            )
+            if evento is None:
+                break
+            reclamados.append(evento)
+        return reclamados
+
+    async def _procesar_lote(self, eventos: List[Dict[str, Any]]):
+        ahora = datetime.utcnow()
+        hechos = []
+        for evento in eventos:
+            self.lag_segundos = (ahora - evento["recibido"]).total_seconds()
+            try:
+                await aplicar_evento_pago(evento)
+                hechos.append(evento["_id"])
+            except Exception as e:
+                intentos = evento.get("intentos", 0) + 1
+                agotado = intentos >= WEBHOOK_MAX_INTENTOS
+                espera = min(2 ** intentos, 3600) * random.uniform(0.8, 1.2)
+                await db.webhook_inbox.update_one(
+                    {"_id": evento["_id"]},
+                    {"$set": {
+                        "estado": "fallido" if agotado else "pendiente",
+                        "intentos": intentos,
+                        "proximo_intento": ahora + timedelta(seconds=espera),
+                        "error": str(e)
+                    }}
+                )
+                if agotado:
+                    self.fallidos += 1
+                    logging.getLogger(__name__).error(f"Webhook {evento['_id']} descartado tras {intentos} intentos: {e}")
+                else:
+                    self.reintentos += 1
+        if hechos:
+            await db.webhook_inbox.update_many(
+                {"_id": {"$in": hechos}},
+                {"$set": {"estado": "procesado", "procesado_en": datetime.utcnow()}, "$unset": {"bloqueado_hasta": ""}}
+            )
+            self.procesados += len(hechos)
+            instante = time.monotonic()
+            self._ventana.extend([instante] * len(hechos))
+
+    async def _worker(self):
+        while True:
+            try:
+                eventos = await self._reclamar()
+                if eventos:
+                    await self._procesar_lote(eventos)
+                    continue
+                self.lag_segundos = 0.0
+                self._despertar.clear()
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), WEBHOOK_INTERVALO)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Error en el procesador de webhooks: {e}")
+                await asyncio.sleep(WEBHOOK_INTERVALO)
+
+    def iniciar(self) -> List[asyncio.Task]:
+        return [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stats(self) -> Dict[str, Any]:
+        limite = time.monotonic() - 60
+        while self._ventana and self._ventana[0] < limite:
+            self._ventana.popleft()
+        return {
+            "workers": self.workers,
+            "recibidos": self.recibidos,
+            "duplicados": self.duplicados,
+            "procesados": self.procesados,
+            "reintentos": self.reintentos,
+            "fallidos": self.fallidos,
+            "lag_segundos": round(self.lag_segundos, 3),
+            "procesados_por_segundo": round(len(self._ventana) / 60, 3)
+        }
+
+procesador_webhooks = ProcesadorWebhooks(WEBHOOK_WORKERS, WEBHOOK_LOTE)
+
+# ESTADO DE PAGOS
+# La página de éxito consulta el estado repetidamente. Los estados finales se sirven
+# desde payment_transactions (y después desde memoria) sin llamar a Stripe; los
+# pendientes se refrescan como mucho una vez por intervalo, que crece con cada consulta
+# sin cambios, y las consultas simultáneas de una misma sesión comparten una llamada.
+PAGOS_ESTADO_INTERVALO_MIN = float(os.environ.get('PAGOS_ESTADO_INTERVALO_MIN', '1'))
+PAGOS_ESTADO_INTERVALO_MAX = float(os.environ.get('PAGOS_ESTADO_INTERVALO_MAX', '30'))
+
+def estado_pago_final(status: Optional[str], payment_status: str) -> bool:
+    return payment_status == "paid" or status == "expired"
+
+class EstadoPagos:
+    """Cache de estados de sesión con consultas agrupadas y refresco con backoff"""
+
+    def __init__(self, maxsize: int, intervalo_min: float, intervalo_max: float):
+        self.intervalo_min = intervalo_min
+        self.intervalo_max = intervalo_max
+        self.cache = CacheTTL(maxsize, ttl=3600)
+        self._en_vuelo: Dict[str, asyncio.Future] = {}
+        self.consultas_stripe = 0
+        self.agrupadas = 0
+        self.escrituras = 0
+
+    def invalidar(self, session_id: str):
+        self.cache.invalidar(session_id)
+
+    async def obtener(self, session_id: str) -> Dict[str, Any]:
+        entrada = self.cache.get(session_id)
+        if entrada is not None and (entrada["final"] or time.monotonic() < entrada["valido_hasta"]):
+            return entrada["respuesta"]
+        tarea = self._en_vuelo.get(session_id)
+        if tarea is None:
+            tarea = asyncio.ensure_future(self._refrescar(session_id, entrada))
+            self._en_vuelo[session_id] = tarea
+            tarea.add_done_callback(lambda _: self._en_vuelo.pop(session_id, None))
+        else:
+            self.agrupadas += 1
+        # shield: si un cliente se desconecta, la consulta sigue para los demás
+        return await asyncio.shield(tarea)
+
+    async def _refrescar(self, session_id: str, entrada: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        transaccion = await db.payment_transactions.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "status": 1, "payment_status": 1, "amount": 1, "amount_total": 1, "currency": 1}
+        )
+        if transaccion is None:
+            raise HTTPException(status_code=404, detail="Transacción no encontrada")
+        
+        if estado_pago_final(transaccion.get("status"), transaccion["payment_status"]):
+            # Pagos confirmados por webhook: sin status ni amount_total de Stripe guardados
+            respuesta = {
+                "status": transaccion.get("status") or "complete",
+                "payment_status": transaccion["payment_status"],
+                "amount_total": transaccion.get("amount_total", int(round(transaccion["amount"] * 100))),
+                "currency": transaccion["currency"]
+            }
+            self.cache.set(session_id, {"respuesta": respuesta, "final": True, "valido_hasta": 0, "intervalo": 0})
+            return respuesta
+        
+        self.consultas_stripe += 1
+        status_response = await obtener_cliente_pagos().estado_sesion(session_id)
+        respuesta = {
+            "status": status_response.status,
+            "payment_status": status_response.payment_status,
+            "amount_total": status_response.amount_total,
+            "currency": status_response.currency
+        }
+        
+        # Escribir solo si el estado cambió
+        cambiado = (status_response.status, status_response.payment_status) != (transaccion.get("status"), transaccion["payment_status"])
+        if cambiado:
+            self.escrituras += 1
+            aplicado = await actualizar_estado_transaccion(
+                session_id, status_response.payment_status,
+                {"status": status_response.status, "amount_total": status_response.amount_total}
+            )
+            if not aplicado:
+                # Otro proceso lo marcó como pagado entretanto: la próxima consulta lo leerá
+                return respuesta
+        
+        intervalo = self.intervalo_min
+        if entrada is not None and not cambiado:
+            intervalo = min(entrada["intervalo"] * 2, self.intervalo_max)
+        self.cache.set(session_id, {
+            "respuesta": respuesta,
+            "final": estado_pago_final(status_response.status, status_response.payment_status),
+            "valido_hasta": time.monotonic() + intervalo,
+            "intervalo": intervalo
+        })
+        return respuesta
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cache": self.cache.stats(),
+            "en_vuelo": len(self._en_vuelo),
+            "consultas_stripe": self.consultas_stripe,
+            "agrupadas": self.agrupadas,
+            "escrituras": self.escrituras
+        }
+
+estados_pago = EstadoPagos(
+    maxsize=int(os.environ.get('PAGOS_ESTADO_CACHE', '10000')),
+    intervalo_min=PAGOS_ESTADO_INTERVALO_MIN,
+    intervalo_max=PAGOS_ESTADO_INTERVALO_MAX
+)
+
+# EVENTOS EN TIEMPO REAL (SSE)
+# El navegador espera el pago o sigue un pedido con Server-Sent Events en lugar de
+# sondear. Las escrituras publican avisos por tema ("pago:<session_id>",
+# "pedido:<id>") en un hub en memoria y cada conexión, al recibir el suyo, lee el
+# estado actual y lo envía si cambió. Con varios workers, el change stream opcional
+# (EVENTOS_CHANGE_STREAM=true) publica también los cambios hechos por otros procesos;
+# sin él, cada conexión revisa el estado cada EVENTOS_REVISION_SEGUNDOS.
+EVENTOS_LATIDO_SEGUNDOS = float(os.environ.get('EVENTOS_LATIDO_SEGUNDOS', '15'))
+EVENTOS_REVISION_SEGUNDOS = float(os.environ.get('EVENTOS_REVISION_SEGUNDOS', '30'))
+EVENTOS_MAX_CONEXIONES = int(os.environ.get('EVENTOS_MAX_CONEXIONES', '10000'))
+EVENTOS_CHANGE_STREAM = os.environ.get('EVENTOS_CHANGE_STREAM', 'false').lower() == 'true'
+
+class CentroEventos:
+    """Pub/sub en proceso: un asyncio.Event por conexión suscrita a un tema"""
+
+    def __init__(self, max_conexiones: int):
+        self.max_conexiones = max_conexiones
+        self._temas: Dict[str, set] = {}
+        self.conexiones = 0
+        self.publicados = 0
+        self.entregados = 0
+        self.rechazadas = 0
+
+    def suscribir(self, tema: str) -> asyncio.Event:
+        if self.conexiones >= self.max_conexiones:
+            self.rechazadas += 1
+            raise HTTPException(status_code=503, detail="Demasiadas conexiones de eventos, consulta el estado directamente")
+        aviso = asyncio.Event()
+        self._temas.setdefault(tema, set()).add(aviso)
+        self.conexiones += 1
+        return aviso
+
+    def cancelar(self, tema: str, aviso: asyncio.Event):
+        avisos = self._temas.get(tema)
+        if avisos is not None and aviso in avisos:
+            avisos.discard(aviso)
+            self.conexiones -= 1
+            if not avisos:
+                del self._temas[tema]
+
+    def publicar(self, tema: str):
+        # Los avisos no llevan datos: varios seguidos se funden en una sola lectura
+        self.publicados += 1
+        for aviso in self._temas.get(tema, ()):
+            aviso.set()
+            self.entregados += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conexiones": self.conexiones,
+            "temas": len(self._temas),
+            "publicados": self.publicados,
+            "entregados": self.entregados,
+            "rechazadas": self.rechazadas
+        }
+
+centro_eventos = CentroEventos(EVENTOS_MAX_CONEXIONES)
+
+def formato_sse(evento: str, datos: Any) -> bytes:
+    return b"event: " + evento.encode() + b"\ndata: " + codificar_json(datos) + b"\n\n"
+
+async def flujo_eventos(tema: str, aviso: asyncio.Event, evento: str, ultimo, estado_actual, es_final) -> AsyncIterator[bytes]:
+    """Enviar el estado inicial y cada cambio posterior, con latidos mientras no hay cambios"""
+    try:
+        yield b"retry: 3000\n\n"
+        yield formato_sse(evento, ultimo)
+        if es_final(ultimo):
+            return
+        proxima_revision = time.monotonic() + EVENTOS_REVISION_SEGUNDOS
+        while True:
+            try:
+                await asyncio.wait_for(aviso.wait(), timeout=EVENTOS_LATIDO_SEGUNDOS)
+                aviso.clear()
+                avisado = True
+            except asyncio.TimeoutError:
+                avisado = False
+            if avisado or (not EVENTOS_CHANGE_STREAM and time.monotonic() >= proxima_revision):
+                proxima_revision = time.monotonic() + EVENTOS_REVISION_SEGUNDOS
+                estado = await estado_actual()
+                if estado != ultimo:
+                    ultimo = estado
+                    yield formato_sse(evento, estado)
+                    if es_final(estado):
+                        return
+                    continue
+            # Comentario SSE: mantiene viva la conexión a través de proxies
+            yield b": latido\n\n"
+    finally:
+        centro_eventos.cancelar(tema, aviso)
+
+async def estado_pedido(pedido_id: str) -> Dict[str, Any]:
+    pedido = await db.pedidos.find_one({"id": pedido_id}, {"_id": 0, "id": 1, "estado": 1})
+    if pedido is None:
+        raise HTTPException(status_code=404, detail="Pedido no encontrado")
+    return pedido
+
+async def respuesta_eventos(tema: str, evento: str, estado_actual, es_final) -> StreamingResponse:
+    """Suscribir y leer el estado inicial antes de responder: 503 y 404 llegan como tales"""
+    # Suscribir antes de leer: un cambio entre ambos pasos deja el aviso puesto
+    aviso = centro_eventos.suscribir(tema)
+    try:
+        inicial = await estado_actual()
+    except BaseException:
+        centro_eventos.cancelar(tema, aviso)
+        raise
+    return StreamingResponse(
+        flujo_eventos(tema, aviso, evento, inicial, estado_actual, es_final),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: nginx no debe acumular el flujo
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Si el flujo no llega a empezar, su finally no corre: cancelar también al terminar
+        background=BackgroundTask(centro_eventos.cancelar, tema, aviso)
+    )
+
+async def escuchar_cambios_estados():
+    """Publicar cambios de pagos y pedidos hechos por cualquier worker (requiere replica set)"""
+    pipeline = [{"$match": {
+        "operationType": {"$in": ["update", "replace"]},
+        "ns.coll": {"$in": ["payment_transactions", "pedidos"]}
+    }}]
+    espera = 1
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="updateLookup") as stream:
+                espera = 1
+                async for cambio in stream:
+                    documento = cambio.get("fullDocument") or {}
+                    if cambio["ns"]["coll"] == "payment_transactions" and documento.get("session_id"):
+                        estados_pago.invalidar(documento["session_id"])
+                        centro_eventos.publicar(f"pago:{documento['session_id']}")
+                    elif cambio["ns"]["coll"] == "pedidos" and documento.get("id"):
+                        centro_eventos.publicar(f"pedido:{documento['id']}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Change stream de eventos interrumpido: {e}")
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 60)
+
+# CICLO DE VIDA DE LOS CARRITOS
+# Los carritos nuevos llevan expira_en y el índice TTL los borra si nadie los
+# convierte; pedidos y checkouts les quitan el campo. Los carritos creados antes de
+# esta política no tienen expira_en: la compactación los revisa por lotes, con pausas
+# entre lotes, y archiva o borra los abandonados que ningún pedido ni pago referencia.
+CARRITOS_COMPACTACION_SEGUNDOS = int(os.environ.get('CARRITOS_COMPACTACION_SEGUNDOS', '3600'))
+CARRITOS_COMPACTACION_LOTE = int(os.environ.get('CARRITOS_COMPACTACION_LOTE', '500'))
+CARRITOS_COMPACTACION_PAUSA = float(os.environ.get('CARRITOS_COMPACTACION_PAUSA', '0.5'))
+CARRITOS_ARCHIVAR = os.environ.get('CARRITOS_ARCHIVAR', 'false').lower() == 'true'
+
+async def marcar_carrito_convertido(carrito_id: str):
+    """Excluir el carrito de la caducidad y de la compactación"""
+    # Subir la versión hace fallar las modificaciones que leyeron el carrito antes
+    await db.carritos.update_one(
+        {"id": carrito_id}, {"$set": {"convertido": True}, "$unset": {"expira_en": ""}, "$inc": {"version": 1}}
+    )
+
+async def tamano_coleccion(nombre: str) -> Dict[str, Any]:
+    """Documentos y bytes de datos e índices de una colección"""
+    try:
+        stats = await db[nombre].aggregate([{"$collStats": {"storageStats": {}}}]).to_list(1)
+        almacenamiento = stats[0]["storageStats"]
+        return {
+            "documentos": almacenamiento.get("count", 0),
+            "bytes_datos": almacenamiento.get("size", 0),
+            "bytes_almacenamiento": almacenamiento.get("storageSize", 0),
+            "bytes_indices": almacenamiento.get("totalIndexSize", 0)
+        }
+    except Exception:
+        # Servidores sin $collStats: al menos el número de documentos
+        return {"documentos": await db[nombre].estimated_document_count()}
+
+class CompactadorCarritos:
+    """Archivado o borrado por lotes de carritos abandonados sin caducidad"""
+
+    def __init__(self):
+        self.ultima_ejecucion: Optional[Dict[str, Any]] = None
+        self.ejecuciones = 0
+
+    async def compactar(self, archivar: bool = CARRITOS_ARCHIVAR) -> Dict[str, Any]:
+        inicio = time.perf_counter()
+        antes = await tamano_coleccion("carritos")
+        limite = datetime.utcnow() - timedelta(seconds=CARRITO_TTL_SEGUNDOS)
+        eliminados = archivados = exentos = 0
+        ultimo_id = None
+        while True:
+            # Recorrido por _id para que los exentos marcados no vuelvan a leerse
+            query: Dict[str, Any] = {"expira_en": None, "convertido": {"$ne": True}, "fecha_creacion": {"$lt": limite}}
+            if ultimo_id is not None:
+                query["_id"] = {"$gt": ultimo_id}
+            lote = await db.carritos.find(query).sort("_id", ASCENDING).limit(CARRITOS_COMPACTACION_LOTE).to_list(CARRITOS_COMPACTACION_LOTE)
+            if not lote:
+                break
+            ultimo_id = lote[-1]["_id"]
+            ids = [c["id"] for c in lote]
+            referenciados = set(await db.pedidos.distinct("carrito_id", {"carrito_id": {"$in": ids}}))
+            referenciados |= set(await db.payment_transactions.distinct("carrito_id", {"carrito_id": {"$in": ids}}))
+            if referenciados:
+                await db.carritos.update_many(
+                    {"id": {"$in": list(referenciados)}},
+                    {"$set": {"convertido": True}, "$unset": {"expira_en": ""}}
+                )
+                exentos += len(referenciados)
+            abandonados = [c for c in lote if c["id"] not in referenciados]
+            if abandonados:
+                if archivar:
+                    operaciones = [ReplaceOne({"_id": c["_id"]}, c, upsert=True) for c in abandonados]
+                    await db.carritos_archivo.bulk_write(operaciones, ordered=False)
+                    archivados += len(abandonados)
+                # Repetir la condición: un carrito modificado entretanto ya tiene expira_en
+                resultado = await db.carritos.delete_many({"_id": {"$in": [c["_id"] for c in abandonados]}, "expira_en": None, "convertido": {"$ne": True}})
+                eliminados += resultado.deleted_count
+            # Ceder capacidad de escritura al tráfico normal entre lotes
+            await asyncio.sleep(CARRITOS_COMPACTACION_PAUSA)
+        
+        self.ejecuciones += 1
+        self.ultima_ejecucion = {
+            "fecha": datetime.utcnow(),
+            "antes": antes,
+            "despues": await tamano_coleccion("carritos"),
+            "eliminados": eliminados,
+            "archivados": archivados,
+            "exentos": exentos,
+            "duracion_s": round(time.perf_counter() - inicio, 2)
+        }
+        return self.ultima_ejecucion
+
+    async def compactar_periodicamente(self):
+        while True:
+            try:
+                # Con varios workers compacta uno solo por intervalo
+                if await adquirir_bloqueo("compactar_carritos", bloqueo_por_intervalo(CARRITOS_COMPACTACION_SEGUNDOS)):
+                    await self.compactar()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Error compactando carritos: {e}")
+            await asyncio.sleep(CARRITOS_COMPACTACION_SEGUNDOS)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ejecuciones": self.ejecuciones, "ultima_ejecucion": self.ultima_ejecucion}
+
+compactador_carritos = CompactadorCarritos()
+
+# IMPORTACIÓN Y ACTUALIZACIÓN MASIVA DE PRODUCTOS
+IMPORTACION_LOTE = int(os.environ.get('IMPORTACION_LOTE', '500'))
+IMPORTACION_MAX_ERRORES = int(os.environ.get('IMPORTACION_MAX_ERRORES', '1000'))
+CAMPOS_LISTA_CSV = ("tallas_disponibles", "colores_disponibles", "caracteristicas")
+
+async def lineas_de_bytes(trozos: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Partir un stream de bytes en líneas de texto sin cargarlo entero"""
+    # Un carácter multibyte puede quedar partido entre dos trozos
+    decodificador = codecs.getincrementaldecoder("utf-8")()
+    pendiente = ""
+    async for trozo in trozos:
+        pendiente += decodificador.decode(trozo) if isinstance(trozo, bytes) else trozo
+        *lineas, pendiente = pendiente.split("\n")
+        for linea in lineas:
+            yield linea.rstrip("\r")
+    pendiente += decodificador.decode(b"", final=True)
+    if pendiente:
+        yield pendiente.rstrip("\r")
+
+async def _filas_importacion(lineas: AsyncIterator[str], formato: str) -> AsyncIterator[Any]:
+    """Producir (numero_fila, dict | Exception); en CSV cada registro ocupa una línea
+    y los campos de lista se separan con "|" """
+    cabecera = None
+    numero = 0
+    async for linea in lineas:
+        if not linea.strip():
+            continue
+        if formato == "csv":
+            valores = next(csv.reader([linea]))
+            if cabecera is None:
+                cabecera = [v.strip() for v in valores]
+                continue
+            numero += 1
+            fila = {c: v for c, v in zip(cabecera, valores) if v != ""}
+            for campo in CAMPOS_LISTA_CSV:
+                if campo in fila:
+                    fila[campo] = [v.strip() for v in fila[campo].split("|") if v.strip()]
+            yield numero, fila
+        else:
+            numero += 1
+            try:
+                yield numero, json.loads(linea)
+            except ValueError as e:
+                yield numero, e
+
+async def _escribir_lote_importacion(operaciones: List[UpdateOne], filas: List[int], resumen: Dict[str, Any]):
+    try:
+        resultado = await db.productos.bulk_write(operaciones, ordered=False)
+        detalles = resultado.bulk_api_result
+    except BulkWriteError as e:
+        detalles = e.details
+        for error in detalles.get("writeErrors", []):
+            _registrar_error_importacion(resumen, filas[error["index"]], error.get("errmsg", "Error de escritura"))
+    resumen["insertadas"] += detalles.get("nUpserted", 0)
+    resumen["actualizadas"] += detalles.get("nModified", 0)
+
+def _registrar_error_importacion(resumen: Dict[str, Any], fila: int, error: str):
+    resumen["total_errores"] += 1
+    if len(resumen["errores"]) < IMPORTACION_MAX_ERRORES:
+        resumen["errores"].append({"fila": fila, "error": error})
+
+async def importar_productos(lineas: AsyncIterator[str], formato: str) -> Dict[str, Any]:
+    """Validar filas contra ProductoCreate y escribirlas por lotes con upserts no ordenados.
+
+    Las filas con `id` actualizan ese producto; el resto se insertan con un id nuevo.
+    Los errores se informan por fila sin abortar la importación.
+    """
+    resumen = {"procesadas": 0, "insertadas": 0, "actualizadas": 0, "total_errores": 0, "errores": []}
+    operaciones: List[UpdateOne] = []
+    filas: List[int] = []
+    async for numero, fila in _filas_importacion(lineas, formato):
+        resumen["procesadas"] += 1
+        if isinstance(fila, Exception):
+            _registrar_error_importacion(resumen, numero, f"JSON no válido: {fila}")
+            continue
+        try:
+            producto = ProductoCreate(**fila)
+        except ValidationError as e:
+            detalle = "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+            _registrar_error_importacion(resumen, numero, detalle)
+            continue
+        except TypeError:
+            _registrar_error_importacion(resumen, numero, "La fila debe ser un objeto JSON")
+            continue
+        ahora = datetime.utcnow()
+        producto_id = str(fila.get("id") or uuid.uuid4())
+        operaciones.append(UpdateOne(
+            {"id": producto_id},
+            {
+                "$set": {**producto.dict(), "fecha_actualizacion": ahora},
+                "$setOnInsert": {"id": producto_id, "fecha_creacion": ahora, "activo": True}
+            },
+            upsert=True
+        ))
+        filas.append(numero)
+        if len(operaciones) >= IMPORTACION_LOTE:
+            await _escribir_lote_importacion(operaciones, filas, resumen)
+            operaciones, filas = [], []
+    if operaciones:
+        await _escribir_lote_importacion(operaciones, filas, resumen)
+    
+    catalogo_cache.invalidar()
+    await recontar_productos_activos()
+    return resumen
+
+async def recontar_productos_activos():
+    total = await db.productos.count_documents({"activo": True})
+    await db.estadisticas.update_one({"_id": "contadores"}, {"$set": {"productos_activos": total}}, upsert=True)
+
+# COTIZACIÓN DE CARRITOS
+PROYECCION_COTIZACION = {
+    "_id": 0, "id": 1, "nombre": 1, "categoria": 1, "precio": 1,
+    "tallas_disponibles": 1, "colores_disponibles": 1, "stock": 1, "activo": 1, "stock_fragmentado": 1
+}
+
+async def cotizar_items(items: List[ItemCarrito], validar_stock: bool = True) -> CotizacionCarrito:
+    """Calcular precios por línea con una sola consulta $in y validar talla, color y stock"""
+    ids = list({item.producto_id for item in items})
+    productos = {}
+    if ids:
+        documentos = await db.productos.find({"id": {"$in": ids}}, PROYECCION_COTIZACION).to_list(len(ids))
+        productos = {p["id"]: p for p in documentos}
+    
+    errores = []
+    cantidades: Dict[str, int] = {}
+    lineas = []
+    for item in items:
+        producto = productos.get(item.producto_id)
+        if not producto or not producto.get("activo", True):
+            errores.append(f"Producto no encontrado: {item.producto_id}")
+            continue
+        if item.cantidad <= 0:
+            errores.append(f"Cantidad no válida para {producto['nombre']}")
+            continue
+        if item.talla not in producto["tallas_disponibles"]:
+            errores.append(f"Talla {item.talla} no disponible para {producto['nombre']}")
+        if item.color not in producto["colores_disponibles"]:
+            errores.append(f"Color {item.color} no disponible para {producto['nombre']}")
+        cantidades[item.producto_id] = cantidades.get(item.producto_id, 0) + item.cantidad
+        lineas.append(LineaCarrito(
+            producto_id=item.producto_id,
+            nombre=producto["nombre"],
+            categoria=producto["categoria"],
+            talla=item.talla,
+            color=item.color,
+            cantidad=item.cantidad,
+            precio_unitario=producto["precio"],
+            subtotal=round(producto["precio"] * item.cantidad, 2)
+        ))
+    
+    for producto_id, cantidad in cantidades.items():
+        producto = productos[producto_id]
+        # Con stock fragmentado la comprobación real la hace la reserva
+        if validar_stock and not producto.get("stock_fragmentado") and cantidad > producto["stock"]:
+            errores.append(f"Stock insuficiente para {producto['nombre']} (disponible: {producto['stock']})")
+    
+    if errores:
+        raise HTTPException(status_code=400, detail="; ".join(errores))
+    
+    return CotizacionCarrito(
+        lineas=lineas,
+        total=round(sum(l.subtotal for l in lineas), 2),
+        fragmentados=[pid for pid in cantidades if productos[pid].get("stock_fragmentado")]
+    )
+
+# MODIFICACIÓN INCREMENTAL DE CARRITOS
+# Cada operación toca una sola línea: se cotiza solo ese producto y se aplica con
+# $push/$pull/$set sobre la línea y el total, condicionada a la versión leída
+# (concurrencia optimista). Con If-Match el cliente fija la versión esperada y un
+# conflicto devuelve 412; sin él, el servidor reintenta sobre la versión nueva.
+CARRITO_REINTENTOS = int(os.environ.get('CARRITO_REINTENTOS', '3'))
+
+def _clave_linea(linea: Dict[str, Any]) -> tuple:
+    return (linea["producto_id"], linea["talla"], linea["color"])
+
+def etag_carrito(version: int) -> str:
+    return f'"{version}"'
+
+def version_if_match(request: Request) -> Optional[int]:
+    """Versión de carrito exigida por If-Match, o None si no se envía"""
+    if_match = request.headers.get("if-match")
+    if if_match is None or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=412, detail="If-Match no corresponde a ninguna versión del carrito")
+
+def filtro_version(version: int) -> Any:
+    # Los carritos anteriores al control de versiones no tienen el campo
+    return version if version else {"$in": [0, None]}
+
+async def preparar_operacion_carrito(carrito: Dict[str, Any], operacion: OperacionCarrito) -> tuple:
+    """Calcular el update atómico de una operación y el carrito resultante"""
+    items = carrito["items"]
+    lineas = carrito.get("lineas", [])
+    clave = (operacion.producto_id, operacion.talla, operacion.color)
+    posicion = next((i for i, item in enumerate(items) if _clave_linea(item) == clave), None)
+    
+    if operacion.op == OperacionLinea.QUITAR or (operacion.op == OperacionLinea.CANTIDAD and operacion.cantidad == 0):
+        if posicion is None:
+            raise HTTPException(status_code=404, detail="Línea no encontrada en el carrito")
+        patron = {"producto_id": operacion.producto_id, "talla": operacion.talla, "color": operacion.color}
+        nuevos_items = items[:posicion] + items[posicion + 1:]
+        if len(lineas) != len(items):
+            # Carrito antiguo: sin líneas no hay subtotal que restar, recotizar lo que queda
+            cotizacion = await cotizar_items([ItemCarrito(**i) for i in nuevos_items], validar_stock=False)
+            nuevas_lineas = [l.dict() for l in cotizacion.lineas]
+            update = {"$set": {"items": nuevos_items, "lineas": nuevas_lineas, "total": cotizacion.total}, "$inc": {"version": 1}}
+            return update, {**carrito, "items": nuevos_items, "lineas": nuevas_lineas, "total": cotizacion.total}
+        nuevas_lineas = [l for l in lineas if _clave_linea(l) != clave]
+        total = round(carrito["total"] - sum(l["subtotal"] for l in lineas if _clave_linea(l) == clave), 2)
+        update = {"$pull": {"items": patron, "lineas": patron}, "$set": {"total": total}, "$inc": {"version": 1}}
+        return update, {**carrito, "items": nuevos_items, "lineas": nuevas_lineas, "total": total}
+    
+    if operacion.cantidad <= 0:
+        raise HTTPException(status_code=400, detail="La cantidad debe ser positiva")
+    cantidad = operacion.cantidad
+    if posicion is not None and operacion.op == OperacionLinea.AGREGAR:
+        cantidad += items[posicion]["cantidad"]
+    item = ItemCarrito(producto_id=operacion.producto_id, talla=operacion.talla, color=operacion.color, cantidad=cantidad)
+    # Las demás líneas del mismo producto cuentan para la comprobación de stock
+    mismo_producto = [ItemCarrito(**i) for i in items if i["producto_id"] == operacion.producto_id and _clave_linea(i) != clave]
+    linea = (await cotizar_items(mismo_producto + [item])).lineas[-1].dict()
+    
+    nuevos_items, nuevas_lineas = list(items), list(lineas)
+    if posicion is None:
+        total = round(carrito["total"] + linea["subtotal"], 2)
+        update = {"$push": {"items": item.dict(), "lineas": linea}, "$set": {"total": total}, "$inc": {"version": 1}}
+        nuevos_items.append(item.dict())
+        nuevas_lineas.append(linea)
+    elif len(lineas) == len(items) and _clave_linea(lineas[posicion]) == clave:
+        total = round(carrito["total"] + linea["subtotal"] - lineas[posicion]["subtotal"], 2)
+        # La versión garantiza que la posición leída sigue siendo la misma línea
+        update = {"$set": {f"items.{posicion}.cantidad": cantidad, f"lineas.{posicion}": linea, "total": total}, "$inc": {"version": 1}}
+        nuevos_items[posicion] = item.dict()
+        nuevas_lineas[posicion] = linea
+    else:
+        # Carrito antiguo sin líneas paralelas a los items: recotizar entero una vez
+        nuevos_items[posicion] = item.dict()
+        cotizacion = await cotizar_items([ItemCarrito(**i) for i in nuevos_items])
+        nuevas_lineas = [l.dict() for l in cotizacion.lineas]
+        total = cotizacion.total
+        update = {"$set": {"items": nuevos_items, "lineas": nuevas_lineas, "total": total}, "$inc": {"version": 1}}
+    return update, {**carrito, "items": nuevos_items, "lineas": nuevas_lineas, "total": total}
+
+# CLAVES DE IDEMPOTENCIA
+# POST /pedidos y /pagos/checkout aceptan Idempotency-Key. La primera petición con una
+# clave reserva un documento en `idempotencia` (_id único) y guarda allí la respuesta;
+# los reintentos la reciben tal cual. Los duplicados simultáneos esperan a la primera:
+# en el mismo worker comparten la tarea y entre workers sondean el documento. Solo se
+# guardan las respuestas correctas; si la operación falla, la clave queda libre.
+IDEMPOTENCIA_TTL_SEGUNDOS = int(os.environ.get('IDEMPOTENCIA_TTL_SEGUNDOS', str(24 * 3600)))
+IDEMPOTENCIA_ESPERA_SEGUNDOS = float(os.environ.get('IDEMPOTENCIA_ESPERA_SEGUNDOS', '30'))
+IDEMPOTENCIA_BLOQUEO_SEGUNDOS = float(os.environ.get('IDEMPOTENCIA_BLOQUEO_SEGUNDOS', '60'))
+
+class ServicioIdempotencia:
+    """Respuestas guardadas por Idempotency-Key con cache en memoria y peticiones agrupadas"""
+
+    def __init__(self, maxsize: int, ttl_memoria: float):
+        self.cache = CacheTTL(maxsize, ttl_memoria)
+        self._en_vuelo: Dict[str, asyncio.Future] = {}
+        self.ejecutadas = 0
+        self.repetidas = 0
+        self.esperas = 0
+        self.conflictos = 0
+
+    async def ejecutar(self, request: Request, ruta: str, datos: BaseModel, operacion):
+        """Ejecutar la operación una sola vez por clave; sin cabecera, ejecutarla sin más"""
+        clave = request.headers.get("idempotency-key")
+        if clave is None:
+            return await operacion()
+        if not clave or len(clave) > 255:
+            raise HTTPException(status_code=400, detail="Idempotency-Key no válida")
+        clave_id = f"{ruta}:{clave}"
+        huella = hashlib.sha256(codificar_json(datos.dict())).hexdigest()
+        
+        guardada = self.cache.get(clave_id)
+        repetida = guardada is not None
+        if guardada is None:
+            tarea = self._en_vuelo.get(clave_id)
+            if tarea is None:
+                tarea = asyncio.ensure_future(self._ejecutar_una_vez(clave_id, huella, operacion))
+                self._en_vuelo[clave_id] = tarea
+                tarea.add_done_callback(lambda _: self._en_vuelo.pop(clave_id, None))
+            else:
+                self.esperas += 1
+                repetida = True
+            guardada, propia = await asyncio.shield(tarea)
+            repetida = repetida or not propia
+        
+        if guardada["huella"] != huella:
+            self.conflictos += 1
+            raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otros datos")
+        headers = {}
+        if repetida:
+            self.repetidas += 1
+            headers["Idempotent-Replayed"] = "true"
+        return Response(content=guardada["cuerpo"], status_code=guardada["status_code"], media_type="application/json", headers=headers)
+
+    async def _ejecutar_una_vez(self, clave_id: str, huella: str, operacion) -> tuple:
+        guardada = await self._adquirir(clave_id, huella)
+        if guardada is not None:
+            self.cache.set(clave_id, guardada)
+            return guardada, False
+        try:
+            resultado = await operacion()
+        except BaseException:
+            await db.idempotencia.delete_one({"_id": clave_id, "estado": "en_curso"})
+            raise
+        guardada = {"huella": huella, "status_code": 200, "cuerpo": codificar_json(resultado)}
+        await db.idempotencia.update_one(
+            {"_id": clave_id},
+            {"$set": {"estado": "completada", **guardada, "completada_en": datetime.utcnow()}}
+        )
+        self.ejecutadas += 1
+        self.cache.set(clave_id, guardada)
+        return guardada, True
+
+    async def _adquirir(self, clave_id: str, huella: str) -> Optional[Dict[str, Any]]:
+        """Reservar la clave (None) o esperar y devolver la respuesta guardada por otro"""
+        limite = time.monotonic() + IDEMPOTENCIA_ESPERA_SEGUNDOS
+        espera = 0.05
+        while True:
+            ahora = datetime.utcnow()
+            try:
+                await db.idempotencia.insert_one({
+                    "_id": clave_id,
+                    "huella": huella,
+                    "estado": "en_curso",
+                    "creada": ahora,
+                    "expira_en": ahora + timedelta(seconds=IDEMPOTENCIA_TTL_SEGUNDOS)
+                })
+                return None
+            except DuplicateKeyError:
+                pass
+            documento = await db.idempotencia.find_one({"_id": clave_id})
+            if documento is not None and documento["estado"] == "completada":
+                return {"huella": documento["huella"], "status_code": documento["status_code"], "cuerpo": documento["cuerpo"]}
+            if documento is not None and documento["huella"] != huella:
+                self.conflictos += 1
+                raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otros datos")
+            # Un worker que murió con la clave reservada no debe bloquearla para siempre
+            if documento is not None and documento["creada"] < ahora - timedelta(seconds=IDEMPOTENCIA_BLOQUEO_SEGUNDOS):
+                tomada = await db.idempotencia.update_one(
+                    {"_id": clave_id, "estado": "en_curso", "creada": documento["creada"]},
+                    {"$set": {"creada": ahora}}
+                )
+                if tomada.modified_count:
+                    return None
+            if documento is None:
+                continue
+            if time.monotonic() > limite:
+                raise HTTPException(status_code=409, detail="Ya hay una petición en curso con esta Idempotency-Key")
+            self.esperas += 1
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 1.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cache": self.cache.stats(),
+            "en_vuelo": len(self._en_vuelo),
+            "ejecutadas": self.ejecutadas,
+            "repetidas": self.repetidas,
+            "esperas": self.esperas,
+            "conflictos": self.conflictos
+        }
+
+idempotencia = ServicioIdempotencia(
+    maxsize=int(os.environ.get('IDEMPOTENCIA_CACHE', '10000')),
+    ttl_memoria=float(os.environ.get('IDEMPOTENCIA_CACHE_TTL', '600'))
+)
+
+# LÍMITES DE TASA
+# Cubos de tokens por IP y por email, con límites por grupo de rutas en formato
+# "capacidad/segundos" (LIMITE_AUTH_IP=20/60: ráfaga de 20 y 20 tokens por minuto;
+# 0 desactiva). Las rutas comprueban el límite antes de tocar la BD o bcrypt. El
+# backend en memoria vale para un worker; LIMITE_TASA_BACKEND=mongo comparte los
+# cubos entre workers con un update atómico por petición.
+LIMITE_TASA_BACKEND = os.environ.get('LIMITE_TASA_BACKEND', 'memoria')  # "memoria" o "mongo"
+PROXIES_CONFIABLES = int(os.environ.get('PROXIES_CONFIABLES', '0'))
+
+def leer_limite(variable: str, defecto: str) -> Optional[tuple]:
+    """Convertir "capacidad/segundos" en (capacidad, tokens por segundo); None si está desactivado"""
+    valor = os.environ.get(variable, defecto).strip()
+    if valor in ("", "0"):
+        return None
+    capacidad, _, segundos = valor.partition("/")
+    return int(capacidad), int(capacidad) / float(segundos or 1)
+
+LIMITES_TASA: Dict[str, Dict[str, Optional[tuple]]] = {
+    "auth": {
+        "ip": leer_limite('LIMITE_AUTH_IP', '20/60'),
+        "email": leer_limite('LIMITE_AUTH_EMAIL', '5/60'),
+    },
+    "pedidos": {
+        "ip": leer_limite('LIMITE_PEDIDOS_IP', '30/60'),
+    },
+}
+
+def ip_cliente(request: Request) -> str:
+    """IP del cliente; tras N proxies de confianza, la que añadió el más externo"""
+    if PROXIES_CONFIABLES:
+        reenviadas = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+        if len(reenviadas) >= PROXIES_CONFIABLES:
+            return reenviadas[-PROXIES_CONFIABLES]
+    return request.client.host if request.client else "desconocida"
+
+class CubosMemoria:
+    """Cubos de tokens en memoria del proceso, con LRU para acotar el número de claves"""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._cubos: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    async def consumir(self, clave: str, capacidad: int, recarga: float) -> float:
+        """Consumir un token; devuelve 0 si se permite o los segundos hasta el próximo token"""
+        ahora = time.monotonic()
+        cubo = self._cubos.get(clave)
+        if cubo is None:
+            cubo = [float(capacidad), ahora]
+            self._cubos[clave] = cubo
+            if len(self._cubos) > self.maxsize:
+                self._cubos.popitem(last=False)
+        else:
+            self._cubos.move_to_end(clave)
+            cubo[0] = min(capacidad, cubo[0] + (ahora - cubo[1]) * recarga)
+            cubo[1] = ahora
+        if cubo[0] >= 1:
+            cubo[0] -= 1
+            return 0.0
+        return (1 - cubo[0]) / recarga
+
+class CubosMongo:
+    """Cubos de tokens compartidos en `limites_tasa` (update con pipeline, MongoDB 4.2+)"""
+
+    async def consumir(self, clave: str, capacidad: int, recarga: float) -> float:
+        ahora = datetime.utcnow()
+        transcurrido = {"$divide": [{"$subtract": [ahora, {"$ifNull": ["$actualizado", ahora]}]}, 1000]}
+        disponibles = {"$min": [capacidad, {"$add": [{"$ifNull": ["$tokens", capacidad]}, {"$multiply": [transcurrido, recarga]}]}]}
+        cubo = await db.limites_tasa.find_one_and_update(
+            {"_id": clave},
+            [
+                {"$set": {"tokens": disponibles, "actualizado": ahora}},
+                {"$set": {"permitido": {"$gte": ["$tokens", 1]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$permitido", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    # Un cubo que se ha llenado del todo ya no aporta información
+                    "expira_en": ahora + timedelta(seconds=capacidad / recarga)
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if cubo["permitido"]:
+            return 0.0
+        return (1 - cubo["tokens"]) / recarga
+
+class LimitadorTasa:
+    """Aplicar los límites de un grupo de rutas y contar permitidas y rechazadas"""
+
+    def __init__(self, backend, limites: Dict[str, Dict[str, Optional[tuple]]]):
+        self.backend = backend
+        self.limites = limites
+        self.permitidas = 0
+        self.rechazadas: Dict[str, int] = {}
+        self.errores_backend = 0
+
+    async def comprobar(self, grupo: str, **identidades: Optional[str]):
+        """Lanzar 429 con Retry-After si alguna identidad (ip, email...) agotó su cubo"""
+        for dimension, valor in identidades.items():
+            limite = self.limites.get(grupo, {}).get(dimension)
+            if limite is None or not valor:
+                continue
+            # Las claves no guardan emails en claro
+            clave = f"{grupo}:{dimension}:" + hashlib.sha256(valor.lower().encode()).hexdigest()[:32]
+            try:
+                espera = await self.backend.consumir(clave, *limite)
+            except Exception as e:
+                # Sin backend compartido se deja pasar: el límite no debe tumbar el login
+                self.errores_backend += 1
+                logging.getLogger(__name__).warning(f"Límite de tasa no disponible: {e}")
+                continue
+            if espera > 0:
+                etiqueta = f"{grupo}:{dimension}"
+                self.rechazadas[etiqueta] = self.rechazadas.get(etiqueta, 0) + 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Demasiadas peticiones, inténtalo más tarde",
+                    headers={"Retry-After": str(max(1, math.ceil(espera)))}
+                )
+        self.permitidas += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": LIMITE_TASA_BACKEND,
+            "permitidas": self.permitidas,
+            "rechazadas": self.rechazadas,
+            "errores_backend": self.errores_backend
+        }
+
+limitador = LimitadorTasa(CubosMongo() if LIMITE_TASA_BACKEND == "mongo" else CubosMemoria(), LIMITES_TASA)
+
 # RUTAS DE AUTENTICACIÓN
 @api_router.post("/auth/register", response_model=UsuarioResponse)
-async def registrar_usuario(usuario_data: UsuarioCreate):
+async def registrar_usuario(usuario_data: UsuarioCreate, request: Request):
     """Registrar un nuevo usuario"""
+    await limitador.comprobar("auth", ip=ip_cliente(request), email=usuario_data.email)
+    
     # Verificar si el email ya existe
     existing_user = await db.usuarios.find_one({"email": usuario_data.email})
     if existing_user:
@@ -218,7 +2709,7 @@ async def registrar_usuario(usuario_data: UsuarioCreate):
     
     # Crear usuario
     usuario_dict = usuario_data.dict()
-    hashed_password = hash_password(usuario_data.password)
+    hashed_password = await hash_password(usuario_data.password)
     
     # Crear objeto Usuario sin password
     usuario_obj = Usuario(**{k: v for k, v in usuario_dict.items() if k != 'password'})
@@ -228,18 +2719,25 @@ async def registrar_usuario(usuario_data: UsuarioCreate):
     usuario_db_dict["password"] = hashed_password
     
     await db.usuarios.insert_one(usuario_db_dict)
+    await incrementar_contadores(usuarios_activos=1)
     return UsuarioResponse(**usuario_obj.dict())
 
 @api_router.post("/auth/login")
-async def login_usuario(usuario_login: UsuarioLogin):
+async def login_usuario(usuario_login: UsuarioLogin, request: Request):
     """Iniciar sesión"""
+    await limitador.comprobar("auth", ip=ip_cliente(request), email=usuario_login.email)
     user = await db.usuarios.find_one({"email": usuario_login.email})
-    if not user or not verify_password(usuario_login.password, user["password"]):
+    if not user or not await verify_password(usuario_login.password, user["password"]):
         raise HTTPException(status_code=401, detail="Credenciales incorrectas")
     
     if not user["activo"]:
         raise HTTPException(status_code=401, detail="Usuario inactivo")
     
+    # Rehash transparente si cambió el factor de coste configurado
+    if servicio_hashing.necesita_rehash(user["password"]):
+        nuevo_hash = await hash_password(usuario_login.password)
+        await db.usuarios.update_one({"id": user["id"]}, {"$set": {"password": nuevo_hash}})
+    
     access_token = create_access_token(data={"sub": user["id"]})
     return {
         "access_token": access_token,
@@ -263,25 +2761,217 @@ async def crear_producto(producto: ProductoCreate):
     producto_dict = producto.dict()
     producto_obj = Producto(**producto_dict)
     await db.productos.insert_one(producto_obj.dict())
+    catalogo_cache.invalidar(producto_obj.id)
+    await incrementar_contadores(productos_activos=1)
     return producto_obj
 
 @api_router.get("/productos", response_model=List[Producto])
-async def obtener_productos(categoria: Optional[str] = None):
-    """Obtener todos los productos o filtrar por categoría"""
-    query = {"activo": True}
+async def obtener_productos(
+    request: Request,
+    categoria: Optional[str] = None,
+    orden: str = "fecha",
+    limite: int = Query(PRODUCTOS_PAGINA_DEFECTO, ge=1, le=PRODUCTOS_PAGINA_MAX),
+    cursor: Optional[str] = None,
+    precio_min: Optional[float] = None,
+    precio_max: Optional[float] = None,
+    talla: Optional[str] = None,
+    color: Optional[str] = None,
+    material: Optional[str] = None
+):
+    """Obtener productos paginados por cursor, con orden y filtros opcionales"""
+    query: Dict[str, Any] = {"activo": True}
     if categoria:
         query["categoria"] = categoria
+    if precio_min is not None or precio_max is not None:
+        query["precio"] = {}
+        if precio_min is not None:
+            query["precio"]["$gte"] = precio_min
+        if precio_max is not None:
+            query["precio"]["$lte"] = precio_max
+    if talla:
+        query["tallas_disponibles"] = talla
+    if color:
+        query["colores_disponibles"] = color
+    if material:
+        query["material"] = material
     
-    productos = await db.productos.find(query).to_list(100)
-    return [Producto(**producto) for producto in productos]
+    # Sin filtros ni cursor la página es una de las instantáneas precomprimidas
+    sin_filtros = precio_min is None and precio_max is None and not (talla or color or material)
+    if CATALOGO_INSTANTANEAS and sin_filtros and cursor is None and orden == "fecha" and limite == PRODUCTOS_PAGINA_DEFECTO:
+        instantanea = instantaneas_catalogo.obtener(categoria)
+        if instantanea is not None:
+            return respuesta_instantanea(request, instantanea)
+    
+    clave = (categoria, orden, limite, cursor, precio_min, precio_max, talla, color, material)
+    pagina = catalogo_cache.listados.get(clave)
+    if pagina is None:
+        version = catalogo_cache.version
+        sort = consulta_pagina_productos(query, orden, cursor)
+        productos = await db.productos.find(query, PROYECCION_PRODUCTO).sort(sort).limit(limite + 1).to_list(limite + 1)
+        
+        # El elemento extra solo indica si hay una página siguiente
+        siguiente = None
+        if len(productos) > limite:
+            productos = productos[:limite]
+            siguiente = codificar_cursor(orden, productos[-1])
+        # Un borrado no deja rastro en la página: incluir la última escritura conocida
+        ultima_modificacion = max([fecha_modificacion_producto(p) for p in productos] + [catalogo_cache.ultima_escritura])
+        if modo_rapido(request):
+            datos = documentos_confiados(productos, CAMPOS_PRODUCTO)
+        else:
+            datos = [Producto(**producto) for producto in productos]
+        pagina = serializar_catalogo(datos, ultima_modificacion, siguiente)
+        # No guardar resultados leídos antes de una invalidación concurrente
+        if catalogo_cache.version == version:
+            catalogo_cache.listados.set(clave, pagina)
+    
+    return respuesta_catalogo(request, pagina, cabeceras_paginacion(request, pagina.siguiente))
+
+BUSQUEDA_RANGOS_PRECIO = [float(x) for x in os.environ.get('BUSQUEDA_RANGOS_PRECIO', '0,20,40,60,100').split(',')]
+
+@api_router.get("/productos/buscar", response_model=ResultadoBusqueda)
+async def buscar_productos(
+    q: str = Query(..., min_length=2, max_length=100),
+    categoria: Optional[str] = None,
+    talla: Optional[str] = None,
+    color: Optional[str] = None,
+    precio_min: Optional[float] = None,
+    precio_max: Optional[float] = None,
+    limite: int = Query(PRODUCTOS_PAGINA_DEFECTO, ge=1, le=PRODUCTOS_PAGINA_MAX)
+):
+    """Buscar productos por texto con ranking de relevancia y facetas"""
+    clave = ("buscar", q, categoria, talla, color, precio_min, precio_max, limite)
+    resultado = catalogo_cache.listados.get(clave)
+    if resultado is not None:
+        return resultado
+    
+    match: Dict[str, Any] = {"$text": {"$search": q}, "activo": True}
+    if categoria:
+        match["categoria"] = categoria
+    if talla:
+        match["tallas_disponibles"] = talla
+    if color:
+        match["colores_disponibles"] = color
+    if precio_min is not None or precio_max is not None:
+        match["precio"] = {}
+        if precio_min is not None:
+            match["precio"]["$gte"] = precio_min
+        if precio_max is not None:
+            match["precio"]["$lte"] = precio_max
+    
+    # Resultados, total y facetas en un único round trip
+    version = catalogo_cache.version
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"relevancia": {"$meta": "textScore"}}},
+        {"$facet": {
+            "resultados": [{"$sort": {"relevancia": -1, "id": 1}}, {"$limit": limite}, {"$project": {"_id": 0}}],
+            "total": [{"$count": "n"}],
+            "categoria": [{"$sortByCount": "$categoria"}],
+            "tallas": [{"$unwind": "$tallas_disponibles"}, {"$sortByCount": "$tallas_disponibles"}],
+            "colores": [{"$unwind": "$colores_disponibles"}, {"$sortByCount": "$colores_disponibles"}],
+            "precio": [{"$bucket": {
+                "groupBy": "$precio",
+                "boundaries": BUSQUEDA_RANGOS_PRECIO,
+                "default": "otros",
+                "output": {"count": {"$sum": 1}}
+            }}]
+        }}
+    ]
+    documento = (await db.productos.aggregate(pipeline).to_list(1))[0]
+    
+    def etiqueta_precio(limite_inferior) -> str:
+        if limite_inferior == "otros":
+            return f"{BUSQUEDA_RANGOS_PRECIO[-1]:g}+"
+        siguiente = BUSQUEDA_RANGOS_PRECIO[BUSQUEDA_RANGOS_PRECIO.index(limite_inferior) + 1]
+        return f"{limite_inferior:g}-{siguiente:g}"
+    
+    facetas = {
+        nombre: [Faceta(valor=str(f["_id"]), cantidad=f["count"]) for f in documento[nombre]]
+        for nombre in ("categoria", "tallas", "colores")
+    }
+    facetas["precio"] = [Faceta(valor=etiqueta_precio(f["_id"]), cantidad=f["count"]) for f in documento["precio"]]
+    
+    resultado = ResultadoBusqueda(
+        total=documento["total"][0]["n"] if documento["total"] else 0,
+        resultados=[ProductoEncontrado(**p) for p in documento["resultados"]],
+        facetas=facetas
+    )
+    if catalogo_cache.version == version:
+        catalogo_cache.listados.set(clave, resultado)
+    return resultado
+
+@api_router.post("/admin/productos/importar")
+async def importar_productos_masivo(request: Request, formato: str = "ndjson", admin_user: Usuario = Depends(get_admin_user)):
+    """Importar productos desde un cuerpo NDJSON o CSV en streaming (solo administradores)"""
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato no válido (ndjson o csv)")
+    try:
+        return await importar_productos(lineas_de_bytes(request.stream()), formato)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="El cuerpo no es UTF-8 válido")
+
+@api_router.patch("/admin/productos")
+async def actualizar_productos_masivo(cambios: ActualizacionMasiva, admin_user: Usuario = Depends(get_admin_user)):
+    """Actualizar precio, stock o activo de muchos productos a la vez (solo administradores)"""
+    if cambios.precio is not None and cambios.ajuste_precio_pct is not None:
+        raise HTTPException(status_code=400, detail="Usa precio o ajuste_precio_pct, no ambos")
+    if all(getattr(cambios, c) is None for c in ("precio", "ajuste_precio_pct", "stock", "activo")):
+        raise HTTPException(status_code=400, detail="No hay cambios que aplicar")
+    
+    filtro: Dict[str, Any] = {}
+    errores = []
+    if cambios.ids is not None:
+        existentes = set(await db.productos.distinct("id", {"id": {"$in": cambios.ids}}))
+        errores = [{"id": i, "error": "Producto no encontrado"} for i in cambios.ids if i not in existentes]
+        filtro["id"] = {"$in": list(existentes)}
+    if cambios.categoria:
+        filtro["categoria"] = cambios.categoria.value
+    if cambios.material:
+        filtro["material"] = cambios.material
+    if not filtro:
+        raise HTTPException(status_code=400, detail="Indica ids o un filtro (categoria, material)")
+    
+    omitidos = 0
+    if cambios.stock is not None:
+        # El stock de productos fragmentados se gestiona en stock_fragmentos
+        omitidos = await db.productos.count_documents({**filtro, "stock_fragmentado": True})
+        filtro["stock_fragmentado"] = {"$ne": True}
+    
+    set_campos: Dict[str, Any] = {"fecha_actualizacion": datetime.utcnow()}
+    for campo in ("precio", "stock", "activo"):
+        if getattr(cambios, campo) is not None:
+            set_campos[campo] = getattr(cambios, campo)
+    if cambios.ajuste_precio_pct is not None:
+        factor = 1 + cambios.ajuste_precio_pct / 100
+        set_campos["precio"] = {"$round": [{"$multiply": ["$precio", factor]}, 2]}
+        resultado = await db.productos.update_many(filtro, [{"$set": set_campos}])
+    else:
+        resultado = await db.productos.update_many(filtro, {"$set": set_campos})
+    
+    catalogo_cache.invalidar()
+    if cambios.activo is not None:
+        await recontar_productos_activos()
+    return {
+        "coincidencias": resultado.matched_count,
+        "modificados": resultado.modified_count,
+        "omitidos_stock_fragmentado": omitidos,
+        "errores": errores
+    }
 
 @api_router.get("/productos/{producto_id}", response_model=Producto)
-async def obtener_producto(producto_id: str):
+async def obtener_producto(producto_id: str, request: Request):
     """Obtener un producto específico"""
-    producto = await db.productos.find_one({"id": producto_id})
-    if not producto:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
-    return Producto(**producto)
+    respuesta = catalogo_cache.productos.get(producto_id)
+    if respuesta is None:
+        version = catalogo_cache.version
+        producto = await db.productos.find_one({"id": producto_id}, {"_id": 0})
+        if not producto:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        respuesta = serializar_catalogo(Producto(**producto), fecha_modificacion_producto(producto))
+        if catalogo_cache.version == version:
+            catalogo_cache.productos.set(producto_id, respuesta)
+    return respuesta_catalogo(request, respuesta)
 
 @api_router.put("/productos/{producto_id}", response_model=Producto)
 async def actualizar_producto(producto_id: str, producto_actualizado: ProductoCreate, admin_user: Usuario = Depends(get_admin_user)):
@@ -290,10 +2980,15 @@ async def actualizar_producto(producto_id: str, producto_actualizado: ProductoCr
     if not producto:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     
+    cambios = producto_actualizado.dict()
+    cambios["fecha_actualizacion"] = datetime.utcnow()
     await db.productos.update_one(
         {"id": producto_id},
-        {"$set": producto_actualizado.dict()}
+        {"$set": cambios}
     )
+    if producto.get("stock_fragmentado"):
+        await inventario.repartir_fragmentos(producto_id, cambios["stock"], await inventario._num_fragmentos(producto_id))
+    catalogo_cache.invalidar(producto_id)
     
     producto_actualizado = await db.productos.find_one({"id": producto_id})
     return Producto(**producto_actualizado)
@@ -301,17 +2996,21 @@ async def actualizar_producto(producto_id: str, producto_actualizado: ProductoCr
 @api_router.delete("/productos/{producto_id}")
 async def eliminar_producto(producto_id: str, admin_user: Usuario = Depends(get_admin_user)):
     """Eliminar un producto (solo administradores)"""
-    resultado = await db.productos.update_one(
+    anterior = await db.productos.find_one_and_update(
         {"id": producto_id},
-        {"$set": {"activo": False}}
+        {"$set": {"activo": False, "fecha_actualizacion": datetime.utcnow()}},
+        projection={"_id": 0, "activo": 1}
     )
-    if resultado.matched_count == 0:
+    if anterior is None:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
+    catalogo_cache.invalidar(producto_id)
+    if anterior.get("activo", True):
+        await incrementar_contadores(productos_activos=-1)
     return {"message": "Producto eliminado correctamente"}
 
 # RUTAS PARA CARRITO
 @api_router.post("/carrito", response_model=Carrito)
-async def crear_carrito(carrito_data: CarritoCreate):
+async def crear_carrito(carrito_data: CarritoCreate, response: Response):
     """Crear un nuevo carrito"""
     try:
         # Try to get current user from token if available
@@ -322,77 +3021,142 @@ async def crear_carrito(carrito_data: CarritoCreate):
         pass  # Usuario anónimo
     
     # Calcular el total
-    total = 0.0
-    for item in carrito_data.items:
-        producto = await db.productos.find_one({"id": item.producto_id})
-        if producto:
-            total += producto["precio"] * item.cantidad
+    cotizacion = await cotizar_items(carrito_data.items)
     
     carrito_dict = carrito_data.dict()
-    carrito_dict["total"] = total
+    carrito_dict["lineas"] = cotizacion.lineas
+    carrito_dict["total"] = cotizacion.total
+    carrito_dict["expira_en"] = datetime.utcnow() + timedelta(seconds=CARRITO_TTL_SEGUNDOS)
     carrito_obj = Carrito(**carrito_dict)
     
     await db.carritos.insert_one(carrito_obj.dict())
+    response.headers["ETag"] = etag_carrito(carrito_obj.version)
     return carrito_obj
 
 @api_router.get("/carrito/{carrito_id}", response_model=Carrito)
-async def obtener_carrito(carrito_id: str):
+async def obtener_carrito(carrito_id: str, response: Response):
     """Obtener un carrito específico"""
     carrito = await db.carritos.find_one({"id": carrito_id})
     if not carrito:
         raise HTTPException(status_code=404, detail="Carrito no encontrado")
-    return Carrito(**carrito)
+    carrito_obj = Carrito(**carrito)
+    response.headers["ETag"] = etag_carrito(carrito_obj.version)
+    return carrito_obj
+
+@api_router.patch("/carrito/{carrito_id}", response_model=Carrito)
+async def modificar_carrito(carrito_id: str, operacion: OperacionCarrito, request: Request, response: Response):
+    """Agregar, cambiar la cantidad o quitar una línea del carrito"""
+    version_esperada = version_if_match(request)
+    for _ in range(CARRITO_REINTENTOS):
+        carrito = await db.carritos.find_one({"id": carrito_id}, {"_id": 0})
+        if not carrito:
+            raise HTTPException(status_code=404, detail="Carrito no encontrado")
+        if carrito.get("convertido"):
+            # El pedido y su reserva ya se calcularon con estas líneas
+            raise HTTPException(status_code=409, detail="El carrito ya se convirtió en pedido y no se puede modificar")
+        version = carrito.get("version") or 0
+        if version_esperada is not None and version != version_esperada:
+            raise HTTPException(status_code=412, detail="El carrito ha cambiado; vuelve a cargarlo")
+        update, resultado = await preparar_operacion_carrito(carrito, operacion)
+        # Un carrito en uso no caduca: cada modificación renueva el plazo
+        resultado["expira_en"] = datetime.utcnow() + timedelta(seconds=CARRITO_TTL_SEGUNDOS)
+        update.setdefault("$set", {})["expira_en"] = resultado["expira_en"]
+        actualizado = await db.carritos.update_one(
+            {"id": carrito_id, "version": filtro_version(version), "convertido": {"$ne": True}}, update
+        )
+        if actualizado.modified_count:
+            carrito_obj = Carrito(**{**resultado, "version": version + 1})
+            response.headers["ETag"] = etag_carrito(carrito_obj.version)
+            return carrito_obj
+        if version_esperada is not None:
+            raise HTTPException(status_code=412, detail="El carrito ha cambiado; vuelve a cargarlo")
+    raise HTTPException(status_code=409, detail="El carrito se está modificando desde otra sesión, inténtalo de nuevo")
 
 # RUTAS PARA PEDIDOS
 @api_router.post("/pedidos", response_model=Pedido)
-async def crear_pedido(pedido_data: PedidoCreate):
+async def crear_pedido(pedido_data: PedidoCreate, request: Request):
     """Crear un nuevo pedido"""
+    await limitador.comprobar("pedidos", ip=ip_cliente(request))
+    return await idempotencia.ejecutar(request, "pedidos", pedido_data, lambda: _crear_pedido(pedido_data))
+
+async def _crear_pedido(pedido_data: PedidoCreate) -> Pedido:
     try:
         # Try to get current user from token if available
         pass
     except:
         pass
     
+    # Un carrito ya convertido devuelve su pedido en lugar de repetir el trabajo
+    existente = await db.pedidos.find_one({"carrito_id": pedido_data.carrito_id}, {"_id": 0})
+    if existente:
+        return Pedido(**existente)
+    
     # Obtener el carrito
     carrito = await db.carritos.find_one({"id": pedido_data.carrito_id})
     if not carrito:
         raise HTTPException(status_code=404, detail="Carrito no encontrado")
     
+    # Recalcular precios actuales en lugar de confiar en el total guardado
+    cotizacion = await cotizar_items(Carrito(**carrito).items)
+    reserva_id = await inventario.reservar(pedido_data.carrito_id, cotizacion, set(cotizacion.fragmentados))
+    
     # Crear el pedido
     pedido_dict = pedido_data.dict()
-    pedido_dict["total"] = carrito["total"]
+    pedido_dict["total"] = cotizacion.total
+    pedido_dict["lineas"] = cotizacion.lineas
+    pedido_dict["reserva_id"] = reserva_id
     # For now, handle anonymous orders
     pedido_obj = Pedido(**pedido_dict)
     
-    await db.pedidos.insert_one(pedido_obj.dict())
+    try:
+        await db.pedidos.insert_one(pedido_obj.dict())
+    except DuplicateKeyError:
+        # Otra petición creó el pedido de este carrito a la vez (índice carrito_id_unico)
+        existente = await db.pedidos.find_one({"carrito_id": pedido_data.carrito_id}, {"_id": 0})
+        return Pedido(**existente)
+    await marcar_carrito_convertido(pedido_data.carrito_id)
+    if pedido_obj.metodo_pago not in METODOS_PAGO_PASARELA:
+        # Transferencia, contra reembolso...: nadie confirmará el pago por webhook
+        await inventario.confirmar(pedido_data.carrito_id)
+    await registrar_venta(pedido_obj)
     return pedido_obj
 
 @api_router.get("/pedidos", response_model=List[Pedido])
-async def obtener_pedidos(current_user: Usuario = Depends(get_current_user)):
+async def obtener_pedidos(request: Request, current_user: Usuario = Depends(get_current_user)):
     """Obtener pedidos del usuario o todos si es admin"""
-    if current_user.rol == RolUsuario.ADMIN:
-        pedidos = await db.pedidos.find().to_list(100)
-    else:
-        pedidos = await db.pedidos.find({"usuario_id": current_user.id}).to_list(100)
+    query = {} if current_user.rol == RolUsuario.ADMIN else {"usuario_id": current_user.id}
+    if modo_rapido(request):
+        pedidos = await db.pedidos.find(query, PROYECCION_PEDIDO).to_list(100)
+        return respuesta_json(documentos_confiados(pedidos, CAMPOS_PEDIDO))
     
+    pedidos = await db.pedidos.find(query).to_list(100)
     return [Pedido(**pedido) for pedido in pedidos]
 
 # RUTAS DE PAGO CON STRIPE
 @api_router.post("/pagos/checkout")
 async def crear_checkout_session(pago_data: PagoCreate, request: Request):
     """Crear sesión de checkout con Stripe"""
-    if not STRIPE_API_KEY:
-        raise HTTPException(status_code=500, detail="Stripe no configurado")
+    await limitador.comprobar("pedidos", ip=ip_cliente(request))
+    return await idempotencia.ejecutar(request, "pagos/checkout", pago_data, lambda: _crear_checkout_session(pago_data, request))
+
+async def _crear_checkout_session(pago_data: PagoCreate, request: Request) -> Dict[str, Any]:
+    pagos = obtener_cliente_pagos()
     
     # Obtener el carrito
     carrito = await db.carritos.find_one({"id": pago_data.carrito_id})
     if not carrito:
         raise HTTPException(status_code=404, detail="Carrito no encontrado")
+    # Si el pedido ya reservó el stock, productos.stock ya lo descuenta: no volver a validarlo
+    reservado = await db.reservas_stock.find_one({"carrito_id": pago_data.carrito_id, "vigente": True}, {"_id": 1})
+    cotizacion = await cotizar_items(Carrito(**carrito).items, validar_stock=reservado is None)
+    # La reserva dura al menos lo que la sesión de pago, más margen para el webhook
+    reserva_id = await inventario.reservar(
+        pago_data.carrito_id, cotizacion, set(cotizacion.fragmentados), ttl=PAGOS_SESION_TTL + 300
+    )
     
     # Configurar Stripe
     host_url = str(request.base_url).rstrip('/')
-    webhook_url = f"{host_url}/api/webhook/stripe"
-    stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
+    webhook_url = PAGOS_WEBHOOK_URL or f"{host_url}/api/webhook/stripe"
     
     # URLs de éxito y cancelación
     success_url = f"{host_url}/checkout/success?session_id={{CHECKOUT_SESSION_ID}}"
@@ -400,30 +3164,38 @@ async def crear_checkout_session(pago_data: PagoCreate, request: Request):
     
     # Crear sesión de checkout
     checkout_request = CheckoutSessionRequest(
-        amount=float(carrito["total"]),
+        amount=cotizacion.total,
         currency="eur",
         success_url=success_url,
         cancel_url=cancel_url,
         metadata={
             "carrito_id": pago_data.carrito_id,
-            "usuario_id": carrito.get("usuario_id", "anonimo")
-        }
+            "usuario_id": carrito.get("usuario_id") or "anonimo"
+        },
+        **opciones_caducidad_sesion()
     )
     
-    session = await stripe_checkout.create_checkout_session(checkout_request)
+    try:
+        session = await pagos.crear_sesion(checkout_request, webhook_url)
+    except Exception:
+        # La reserva de un pedido existente sigue siendo del pedido
+        if reservado is None:
+            await inventario.liberar(reserva_id)
+        raise
     
     # Guardar transacción
     transaccion = TransaccionPago(
         session_id=session.session_id,
         usuario_id=carrito.get("usuario_id"),
         carrito_id=pago_data.carrito_id,
-        amount=float(carrito["total"]),
+        amount=cotizacion.total,
         currency="eur",
         payment_status="pending",
         metadata={"session_url": session.url}
     )
     
     await db.payment_transactions.insert_one(transaccion.dict())
+    await marcar_carrito_convertido(pago_data.carrito_id)
     
     return {
         "checkout_url": session.url,
@@ -433,95 +3205,349 @@ async def crear_checkout_session(pago_data: PagoCreate, request: Request):
 @api_router.get("/pagos/status/{session_id}")
 async def obtener_estado_pago(session_id: str):
     """Obtener el estado de un pago"""
-    if not STRIPE_API_KEY:
-        raise HTTPException(status_code=500, detail="Stripe no configurado")
-    
-    stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url="")
-    status_response = await stripe_checkout.get_checkout_status(session_id)
-    
-    # Actualizar transacción en BD
-    await db.payment_transactions.update_one(
-        {"session_id": session_id},
-        {"$set": {"payment_status": status_response.payment_status}}
+    return await estados_pago.obtener(session_id)
+
+@api_router.get("/eventos/pagos/{session_id}")
+async def eventos_pago(session_id: str):
+    """Flujo SSE con el estado del pago; se cierra al llegar a un estado final"""
+    return await respuesta_eventos(
+        f"pago:{session_id}", "pago",
+        lambda: estados_pago.obtener(session_id),
+        lambda estado: estado_pago_final(estado["status"], estado["payment_status"])
+    )
+
+@api_router.get("/eventos/pedidos/{pedido_id}")
+async def eventos_pedido(pedido_id: str):
+    """Flujo SSE con los cambios de estado de un pedido"""
+    return await respuesta_eventos(
+        f"pedido:{pedido_id}", "pedido",
+        lambda: estado_pedido(pedido_id),
+        lambda estado: False
     )
-    
-    return {
-        "status": status_response.status,
-        "payment_status": status_response.payment_status,
-        "amount_total": status_response.amount_total,
-        "currency": status_response.currency
-    }
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
     """Webhook de Stripe"""
-    if not STRIPE_API_KEY:
-        raise HTTPException(status_code=500, detail="Stripe no configurado")
+    pagos = obtener_cliente_pagos()
     
     body = await request.body()
     signature = request.headers.get("Stripe-Signature")
     
-    stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url="")
-    
     try:
-        webhook_response = await stripe_checkout.handle_webhook(body, signature)
-        
-        # Actualizar transacción
-        await db.payment_transactions.update_one(
-            {"session_id": webhook_response.session_id},
-            {"$set": {"payment_status": webhook_response.payment_status}}
-        )
-        
-        return {"status": "success"}
+        webhook_response = await pagos.procesar_webhook(body, signature)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    
+    # Guardar en la bandeja de entrada y confirmar; el procesado es asíncrono
+    ahora = datetime.utcnow()
+    evento_id = getattr(webhook_response, "event_id", None) or hashlib.sha256(body).hexdigest()
+    try:
+        await db.webhook_inbox.insert_one({
+            "_id": evento_id,
+            "tipo": getattr(webhook_response, "event_type", None),
+            "session_id": webhook_response.session_id,
+            "payment_status": webhook_response.payment_status,
+            "metadata": getattr(webhook_response, "metadata", None) or {},
+            "cuerpo": body.decode("utf-8", errors="replace"),
+            "estado": "pendiente",
+            "intentos": 0,
+            "recibido": ahora,
+            "proximo_intento": ahora
+        })
+    except DuplicateKeyError:
+        procesador_webhooks.duplicados += 1
+        return {"status": "duplicado"}
+    
+    procesador_webhooks.recibidos += 1
+    procesador_webhooks.notificar()
+    return {"status": "success"}
 
 # RUTA PARA LAS CATEGORÍAS
+# Datos estáticos: se serializan una sola vez al importar el módulo
+CATEGORIAS_RESPUESTA = serializar_catalogo({
+    "categorias": [
+        {"value": "artisticos", "label": "Patines Artísticos"},
+        {"value": "hockey", "label": "Patines de Hockey"},
+        {"value": "velocidad", "label": "Patines de Velocidad"},
+        {"value": "recreativos", "label": "Patines Recreativos"}
+    ]
+})
+
 @api_router.get("/categorias")
-async def obtener_categorias():
+async def obtener_categorias(request: Request):
     """Obtener todas las categorías disponibles"""
-    return {
-        "categorias": [
-            {"value": "artisticos", "label": "Patines Artísticos"},
-            {"value": "hockey", "label": "Patines de Hockey"},
-            {"value": "velocidad", "label": "Patines de Velocidad"},
-            {"value": "recreativos", "label": "Patines Recreativos"}
-        ]
-    }
+    return respuesta_catalogo(request, CATEGORIAS_RESPUESTA)
 
 # RUTAS DE ADMINISTRACIÓN
 @api_router.get("/admin/usuarios", response_model=List[UsuarioResponse])
-async def obtener_usuarios(admin_user: Usuario = Depends(get_admin_user)):
+async def obtener_usuarios(request: Request, admin_user: Usuario = Depends(get_admin_user)):
     """Obtener todos los usuarios (solo administradores)"""
+    if modo_rapido(request):
+        # La proyección de UsuarioResponse excluye el hash de la contraseña
+        usuarios = await db.usuarios.find({}, PROYECCION_USUARIO_RESPUESTA).to_list(100)
+        return respuesta_json(documentos_confiados(usuarios, CAMPOS_USUARIO_RESPUESTA))
+    
     usuarios = await db.usuarios.find().to_list(100)
     return [UsuarioResponse(**usuario) for usuario in usuarios]
 
+# EXPORTACIONES EN STREAMING (NDJSON / CSV)
+EXPORTACION_LOTE = int(os.environ.get('EXPORTACION_LOTE', '500'))
+
+# Solo se proyectan las columnas listadas: el hash de la contraseña nunca sale del servidor
+EXPORTACIONES = {
+    "usuarios": {
+        "coleccion": "usuarios",
+        "columnas": ["id", "nombre", "email", "telefono", "direccion", "ciudad", "codigo_postal", "rol", "activo", "fecha_registro"],
+        "fecha": "fecha_registro",
+        "estado": lambda estado: {"activo": estado == "activo"}
+    },
+    "pedidos": {
+        "coleccion": "pedidos",
+        "columnas": ["id", "carrito_id", "usuario_id", "metodo_pago", "total", "estado", "fecha_pedido", "datos_cliente", "lineas"],
+        "fecha": "fecha_pedido",
+        "estado": lambda estado: {"estado": estado}
+    },
+    "transacciones": {
+        "coleccion": "payment_transactions",
+        "columnas": ["id", "session_id", "usuario_id", "carrito_id", "amount", "currency", "payment_status", "fecha_creacion"],
+        "fecha": "fecha_creacion",
+        "estado": lambda estado: {"payment_status": estado}
+    },
+}
+
+def _valor_exportable(valor: Any) -> Any:
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    if isinstance(valor, (dict, list)):
+        return jsonable_encoder(valor)
+    return valor
+
+async def _generar_exportacion(cursor, columnas: List[str], formato: str):
+    """Emitir el cursor por lotes; cada yield espera a que el cliente consuma (backpressure)"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer) if formato == "csv" else None
+    if escritor:
+        escritor.writerow(columnas)
+    filas = 0
+    async for documento in cursor:
+        if escritor:
+            escritor.writerow([
+                json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else ("" if v is None else v)
+                for v in (_valor_exportable(documento.get(c)) for c in columnas)
+            ])
+        else:
+            fila = {c: _valor_exportable(documento.get(c)) for c in columnas}
+            buffer.write(json.dumps(fila, ensure_ascii=False))
+            buffer.write("\n")
+        filas += 1
+        if filas % EXPORTACION_LOTE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@api_router.get("/admin/exportar/{nombre}")
+async def exportar_coleccion(
+    nombre: str,
+    formato: str = "ndjson",
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    estado: Optional[str] = None,
+    admin_user: Usuario = Depends(get_admin_user)
+):
+    """Exportar usuarios, pedidos o transacciones en NDJSON o CSV (solo administradores)"""
+    config = EXPORTACIONES.get(nombre)
+    if not config:
+        raise HTTPException(status_code=404, detail="Exportación no disponible")
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato no válido (ndjson o csv)")
+    
+    query: Dict[str, Any] = {}
+    if desde or hasta:
+        query[config["fecha"]] = {}
+        if desde:
+            query[config["fecha"]]["$gte"] = desde
+        if hasta:
+            query[config["fecha"]]["$lt"] = hasta
+    if estado:
+        query.update(config["estado"](estado))
+    
+    proyeccion = {"_id": 0, **{c: 1 for c in config["columnas"]}}
+    cursor = db[config["coleccion"]].find(query, proyeccion).sort(config["fecha"], ASCENDING).batch_size(EXPORTACION_LOTE)
+    
+    media_type = "text/csv" if formato == "csv" else "application/x-ndjson"
+    fecha = datetime.utcnow().strftime("%Y%m%d")
+    return StreamingResponse(
+        _generar_exportacion(cursor, config["columnas"], formato),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{nombre}-{fecha}.{formato}"'}
+    )
+
+@api_router.post("/admin/inventario/{producto_id}/fragmentar")
+async def fragmentar_stock(producto_id: str, fragmentos: int = Query(8, ge=2, le=64), admin_user: Usuario = Depends(get_admin_user)):
+    """Repartir el stock de un producto muy disputado en fragmentos (solo administradores)"""
+    producto = await db.productos.find_one_and_update(
+        {"id": producto_id, "stock_fragmentado": {"$ne": True}},
+        {"$set": {"stock_fragmentado": True, "stock": 0}},
+        projection={"_id": 0, "stock": 1}
+    )
+    if producto is None:
+        raise HTTPException(status_code=404, detail="Producto no encontrado o ya fragmentado")
+    # Leer y vaciar el stock en la misma operación: una reserva directa concurrente
+    # falla en su condición en lugar de descontar unidades que ya están en fragmentos
+    await inventario.repartir_fragmentos(producto_id, producto["stock"], fragmentos)
+    catalogo_cache.invalidar(producto_id)
+    return {"producto_id": producto_id, "fragmentos": fragmentos, "stock": producto["stock"]}
+
+@api_router.patch("/admin/usuarios/{usuario_id}", response_model=UsuarioResponse)
+async def actualizar_usuario(usuario_id: str, cambios: UsuarioAdminUpdate, admin_user: Usuario = Depends(get_admin_user)):
+    """Cambiar el rol o activar/desactivar un usuario (solo administradores)"""
+    update = {k: v for k, v in cambios.dict().items() if v is not None}
+    if not update:
+        raise HTTPException(status_code=400, detail="No hay cambios que aplicar")
+    
+    usuario = await db.usuarios.find_one_and_update(
+        {"id": usuario_id},
+        {"$set": update},
+        projection={"_id": 0, "password": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if usuario is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    
+    # Avisar también a los demás workers, que pueden tenerlo en su cache
+    await version_usuarios.publicar(usuario_id)
+    if "activo" in update and update["activo"] != usuario.get("activo", True):
+        await incrementar_contadores(usuarios_activos=1 if update["activo"] else -1)
+    usuario.update(update)
+    return UsuarioResponse(**usuario)
+
 @api_router.get("/admin/estadisticas")
-async def obtener_estadisticas(admin_user: Usuario = Depends(get_admin_user)):
-    """Obtener estadísticas de la tienda"""
-    total_productos = await db.productos.count_documents({"activo": True})
-    total_usuarios = await db.usuarios.count_documents({"activo": True})
-    total_pedidos = await db.pedidos.count_documents({})
+async def obtener_estadisticas(
+    dias: int = Query(30, ge=1, le=3660),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    admin_user: Usuario = Depends(get_admin_user)
+):
+    """Obtener estadísticas de la tienda desde los contadores pre-agregados"""
+    documentos = {d["_id"]: d for d in await db.estadisticas.find({"_id": {"$in": ["contadores", "cobertura"]}}).to_list(2)}
+    contadores = documentos.get("contadores")
+    if contadores is None or "cobertura" not in documentos:
+        contadores = await reconciliar_estadisticas()
+        documentos["cobertura"] = {"desde": await cobertura_estadisticas()}
     
-    # Ventas del último mes
-    fecha_mes = datetime.utcnow() - timedelta(days=30)
-    ventas_mes = await db.pedidos.aggregate([
-        {"$match": {"fecha_pedido": {"$gte": fecha_mes}}},
-        {"$group": {"_id": None, "total": {"$sum": "$total"}}}
-    ]).to_list(1)
+    # Las fechas de Mongo son UTC sin zona: pasar a ese formato las que traen zona ("...Z")
+    desde, hasta = (
+        f.astimezone(timezone.utc).replace(tzinfo=None) if f is not None and f.tzinfo else f for f in (desde, hasta)
+    )
+    
+    # Ventas del periodo (por defecto, el último mes) a partir de los buckets diarios
+    hasta = hasta or datetime.utcnow()
+    desde = desde or hasta - timedelta(days=dias)
+    inicio = desde.replace(hour=0, minute=0, second=0, microsecond=0)
+    cubierto = documentos["cobertura"]["desde"]
+    if inicio < cubierto:
+        # Antes de la cobertura los buckets solo tienen lo registrado en vivo: el total saldría corto
+        raise HTTPException(
+            status_code=400,
+            detail=f"Sin estadísticas completas antes del {cubierto:%Y-%m-%d}; ejecuta 'python manage.py estadisticas --completo'"
+        )
+    buckets = await db.ventas_diarias.find(
+        {"fecha": {"$gte": inicio, "$lte": hasta}}
+    ).sort("fecha", ASCENDING).to_list(None)
     
-    ventas_total = ventas_mes[0]["total"] if ventas_mes else 0
+    por_categoria: Dict[str, float] = {}
+    por_metodo_pago: Dict[str, float] = {}
+    for bucket in buckets:
+        for clave, valor in bucket.get("por_categoria", {}).items():
+            por_categoria[clave] = round(por_categoria.get(clave, 0) + valor, 2)
+        for clave, valor in bucket.get("por_metodo_pago", {}).items():
+            por_metodo_pago[clave] = round(por_metodo_pago.get(clave, 0) + valor, 2)
     
     return {
-        "total_productos": total_productos,
-        "total_usuarios": total_usuarios,
-        "total_pedidos": total_pedidos,
-        "ventas_mes": ventas_total
+        "total_productos": contadores.get("productos_activos", 0),
+        "total_usuarios": contadores.get("usuarios_activos", 0),
+        "total_pedidos": contadores.get("pedidos", 0),
+        "ventas_mes": round(sum(b["total"] for b in buckets), 2),
+        "pedidos_periodo": sum(b["pedidos"] for b in buckets),
+        "ventas_por_dia": [{"dia": b["_id"], "total": round(b["total"], 2), "pedidos": b["pedidos"]} for b in buckets],
+        "ventas_por_categoria": por_categoria,
+        "ventas_por_metodo_pago": por_metodo_pago
+    }
+
+@api_router.get("/admin/rendimiento")
+async def obtener_rendimiento(admin_user: Usuario = Depends(get_admin_user)):
+    """Métricas internas de rendimiento (solo administradores)"""
+    return {
+        "hashing": servicio_hashing.stats(),
+        "usuarios_cache": {**usuarios_cache.stats(), "vaciados_por_cambios": version_usuarios.vaciados},
+        "catalogo_cache": catalogo_cache.stats(),
+        "catalogo_instantaneas": instantaneas_catalogo.stats(),
+        "pagos": cliente_pagos.stats() if cliente_pagos else None,
+        "estado_pagos": estados_pago.stats(),
+        "eventos": centro_eventos.stats(),
+        "idempotencia": idempotencia.stats(),
+        "limites_tasa": limitador.stats(),
+        "webhooks": procesador_webhooks.stats(),
+        "inventario": inventario.stats(),
+        "carritos": compactador_carritos.stats()
     }
 
+@api_router.post("/admin/carritos/compactar")
+async def compactar_carritos(archivar: bool = CARRITOS_ARCHIVAR, admin_user: Usuario = Depends(get_admin_user)):
+    """Compactar ahora los carritos abandonados (solo administradores)"""
+    return await compactador_carritos.compactar(archivar)
+
+@api_router.get("/admin/metrics")
+async def exportar_metricas(admin_user: Usuario = Depends(get_admin_user)):
+    """Métricas HTTP y de Mongo en formato Prometheus (solo administradores)"""
+    return Response(content=metricas.prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# RUTAS DE SALUD (liveness / readiness)
+@api_router.get("/salud/vivo")
+async def salud_vivo():
+    """Liveness: el proceso responde (no consulta dependencias)"""
+    return {"estado": "vivo", "proceso": ID_PROCESO, "segundos_activo": round(time.monotonic() - estado_proceso.inicio)}
+
+@api_router.get("/salud/listo")
+async def salud_listo():
+    """Readiness: arranque terminado y MongoDB accesible"""
+    if not estado_proceso.listo:
+        return JSONResponse(status_code=503, content={"estado": "arrancando", "proceso": ID_PROCESO})
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=SALUD_TIMEOUT)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"estado": "sin_mongo", "proceso": ID_PROCESO, "error": str(e)})
+    return {"estado": "listo", "proceso": ID_PROCESO, "lider_arranque": estado_proceso.lider_arranque}
+
 # Incluir el router en la app principal
 app.include_router(api_router)
 
+@app.middleware("http")
+async def medir_peticion(request: Request, call_next):
+    """Latencia, estado y comandos de Mongo de cada petición, agregados por plantilla de ruta"""
+    consultas = ConsultasPeticion()
+    token = peticion_actual.set(consultas)
+    metricas.en_curso += 1
+    inicio = time.perf_counter()
+    estado = 500
+    try:
+        response = await call_next(request)
+        estado = response.status_code
+    finally:
+        segundos = time.perf_counter() - inicio
+        metricas.en_curso -= 1
+        peticion_actual.reset(token)
+        ruta = request.scope.get("route")
+        # La plantilla (/api/productos/{producto_id}) evita una serie por cada id
+        plantilla = getattr(ruta, "path", None) or "sin_ruta"
+        metricas.observar_peticion(request.method, plantilla, estado, segundos, consultas)
+    if METRICAS_CABECERA_DEBUG:
+        response.headers["X-Mongo-Consultas"] = str(consultas.comandos)
+        response.headers["X-Mongo-Tiempo-Ms"] = f"{consultas.segundos * 1000:.2f}"
+    return response
+
 # Middleware CORS
 app.add_middleware(
     CORSMiddleware,
@@ -529,6 +3555,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Link", "ETag", "Retry-After", "Last-Modified", "X-Mongo-Consultas", "X-Mongo-Tiempo-Ms"],
 )
 
 # Configurar logging
@@ -538,25 +3565,131 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("startup")
-async def startup_event():
-    """Crear usuario admin por defecto"""
-    admin_exists = await db.usuarios.find_one({"email": "admin@fundasdepatin.com"})
-    if not admin_exists:
-        admin_user = Usuario(
-            nombre="Administrador",
-            email="admin@fundasdepatin.com",
-            telefono="",
-            direccion="",
-            ciudad="",
-            codigo_postal="",
-            rol=RolUsuario.ADMIN
+# ARRANQUE COORDINADO ENTRE WORKERS
+# Las tareas de una sola vez (índices y usuario admin) las ejecuta el worker que
+# obtiene el bloqueo de arranque; el bloqueo caduca solo, así que un worker que muera
+# a mitad no impide que el siguiente arranque las repita (son idempotentes).
+ID_PROCESO = f"{socket.gethostname()}:{os.getpid()}"
+ARRANQUE_BLOQUEO_SEGUNDOS = int(os.environ.get('ARRANQUE_BLOQUEO_SEGUNDOS', '60'))
+SALUD_TIMEOUT = float(os.environ.get('SALUD_TIMEOUT', '2'))
+
+class EstadoProceso:
+    """Si el worker terminó de arrancar y si debe recibir tráfico"""
+
+    def __init__(self):
+        self.listo = False
+        self.lider_arranque = False
+        self.inicio = time.monotonic()
+
+estado_proceso = EstadoProceso()
+
+async def adquirir_bloqueo(nombre: str, segundos: int) -> bool:
+    """Bloqueo con caducidad en `bloqueos`: solo un proceso lo obtiene mientras esté vigente"""
+    ahora = datetime.utcnow()
+    try:
+        # Si existe y no ha caducado el filtro no coincide y el upsert choca con el _id;
+        # uno marcado con error queda libre para que otro proceso lo reintente
+        await db.bloqueos.update_one(
+            {"_id": nombre, "$or": [{"expira_en": {"$lt": ahora}}, {"error": {"$exists": True}}]},
+            {"$set": {"titular": ID_PROCESO, "adquirido": ahora, "expira_en": ahora + timedelta(seconds=segundos)},
+             "$unset": {"error": ""}},
+            upsert=True
         )
-        admin_dict = admin_user.dict()
-        admin_dict["password"] = hash_password("admin123")
-        await db.usuarios.insert_one(admin_dict)
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def liberar_bloqueo(nombre: str):
+    """Soltar un bloqueo propio; la caducidad queda solo para procesos que mueren con él"""
+    await db.bloqueos.delete_one({"_id": nombre, "titular": ID_PROCESO})
+
+async def esperar_bloqueo(nombre: str, intervalo: float = 0.5):
+    """Esperar a que el titular suelte el bloqueo (o caduque); RuntimeError si falló"""
+    while True:
+        bloqueo = await db.bloqueos.find_one({"_id": nombre})
+        if bloqueo is None or bloqueo["expira_en"] < datetime.utcnow():
+            return
+        if "error" in bloqueo:
+            raise RuntimeError(f"El arranque falló en {bloqueo['titular']}: {bloqueo['error']}")
+        await asyncio.sleep(intervalo)
+
+def bloqueo_por_intervalo(segundos: int) -> int:
+    # Algo menos que el intervalo: el bloqueo ya ha caducado cuando toca la siguiente vuelta
+    return max(1, int(segundos * 0.9))
+
+async def crear_admin_por_defecto():
+    """Crear el usuario admin si no existe (upsert: seguro con varios workers a la vez)"""
+    # Evitar el coste de bcrypt en cada arranque cuando ya existe
+    if await db.usuarios.find_one({"email": "admin@fundasdepatin.com"}, {"_id": 1}):
+        return
+    admin_user = Usuario(
+        nombre="Administrador",
+        email="admin@fundasdepatin.com",
+        telefono="",
+        direccion="",
+        ciudad="",
+        codigo_postal="",
+        rol=RolUsuario.ADMIN
+    )
+    admin_dict = admin_user.dict()
+    admin_dict["password"] = await hash_password("admin123")
+    resultado = await db.usuarios.update_one(
+        {"email": admin_dict["email"]},
+        {"$setOnInsert": admin_dict},
+        upsert=True
+    )
+    if resultado.upserted_id is not None:
+        await incrementar_contadores(usuarios_activos=1)
         logger.info("Usuario administrador creado: admin@fundasdepatin.com / admin123")
 
+async def calentar_pool_mongo():
+    """Abrir las conexiones mínimas del pool antes de aceptar tráfico"""
+    conexiones = max(1, opciones_pool.get("minPoolSize", 1))
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(conexiones)))
+
+@app.on_event("startup")
+async def startup_event():
+    """Preparar el worker; índices y admin por defecto solo en el que obtiene el bloqueo"""
+    servicio_hashing.iniciar()
+    if PAGOS_BACKEND == "falso" or STRIPE_API_KEY:
+        obtener_cliente_pagos()
+    await calentar_pool_mongo()
+    estado_proceso.lider_arranque = await adquirir_bloqueo("arranque", ARRANQUE_BLOQUEO_SEGUNDOS)
+    if estado_proceso.lider_arranque:
+        try:
+            if os.environ.get('CREAR_INDICES', 'true').lower() == 'true':
+                await asegurar_indices(db)
+            await crear_admin_por_defecto()
+        except Exception as e:
+            # Los workers que esperan también deben fallar, no servir sin los índices
+            await db.bloqueos.update_one({"_id": "arranque", "titular": ID_PROCESO}, {"$set": {"error": str(e)}})
+            raise
+        # Un reinicio inmediato debe poder repetir estas tareas
+        await liberar_bloqueo("arranque")
+    else:
+        # No aceptar tráfico hasta que el líder termine los índices únicos; si muere,
+        # el bloqueo caduca a los ARRANQUE_BLOQUEO_SEGUNDOS y se sigue igualmente
+        await esperar_bloqueo("arranque")
+    tareas_fondo.append(asyncio.create_task(reconciliar_estadisticas_periodicamente()))
+    tareas_fondo.extend(procesador_webhooks.iniciar())
+    tareas_fondo.append(asyncio.create_task(inventario.barrer_periodicamente()))
+    if CARRITOS_COMPACTACION_SEGUNDOS > 0:
+        tareas_fondo.append(asyncio.create_task(compactador_carritos.compactar_periodicamente()))
+    if os.environ.get('CATALOGO_CHANGE_STREAM', 'false').lower() == 'true':
+        tareas_fondo.append(asyncio.create_task(escuchar_cambios_catalogo()))
+    if EVENTOS_CHANGE_STREAM:
+        tareas_fondo.append(asyncio.create_task(escuchar_cambios_estados()))
+    if CATALOGO_INSTANTANEAS:
+        tareas_fondo.append(asyncio.create_task(instantaneas_catalogo.mantener()))
+    estado_proceso.listo = True
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    estado_proceso.listo = False
+    for tarea in tareas_fondo:
+        tarea.cancel()
+    await asyncio.gather(*tareas_fondo, return_exceptions=True)
+    if cliente_pagos is not None:
+        cliente_pagos.cerrar()
+    servicio_hashing.cerrar()
     client.close()
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""Servir la API en producción con varios workers: python servir.py --help"""
+import os
+from pathlib import Path
+
+import typer
+import uvicorn
+
+
+def _nucleos() -> int:
+    # Respeta los límites de CPU del contenedor cuando el sistema los expone
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def main(
+    host: str = typer.Option("0.0.0.0", help="Interfaz de escucha"),
+    port: int = typer.Option(8001, help="Puerto"),
+    workers: int = typer.Option(int(os.environ.get("WEB_CONCURRENCY", "0")), help="Procesos worker (0 = uno por núcleo)"),
+    pool_total: int = typer.Option(int(os.environ.get("MONGO_POOL_TOTAL", "0")), help="Conexiones a Mongo entre todos los workers (0 = por defecto de pymongo por worker)"),
+    timeout_apagado: int = typer.Option(30, help="Segundos para terminar peticiones en curso al apagar"),
+):
+    """Arrancar uvicorn con N workers y repartir pool de Mongo y bcrypt entre ellos"""
+    nucleos = _nucleos()
+    workers = workers or nucleos
+    # Los workers heredan el entorno: fijar aquí el tamaño de sus pools
+    if pool_total and "MONGO_MAX_POOL_SIZE" not in os.environ:
+        os.environ["MONGO_MAX_POOL_SIZE"] = str(max(1, pool_total // workers))
+    # Cada worker tiene su pool de bcrypt: entre todos no deben superar los núcleos
+    os.environ.setdefault("BCRYPT_WORKERS", str(max(1, nucleos // workers)))
+    typer.echo(f"{workers} workers, {nucleos} núcleos, pool Mongo por worker: "
+               f"{os.environ.get('MONGO_MAX_POOL_SIZE', 'por defecto')}, bcrypt por worker: {os.environ['BCRYPT_WORKERS']}")
+    uvicorn.run(
+        "server:app",
+        app_dir=str(Path(__file__).parent),
+        host=host,
+        port=port,
+        workers=workers,
+        proxy_headers=True,
+        timeout_graceful_shutdown=timeout_apagado,
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
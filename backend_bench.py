@@ -0,0 +1,405 @@
+"""Benchmark de carga de la API de Fundas de Patines.
+
+Ejecuta la app FastAPI en el mismo proceso (httpx + ASGITransport) con una base
+de datos en memoria (mongomock-motor) y la pasarela falsa (PAGOS_BACKEND=falso), o contra una
+instancia local de uvicorn con --url. Lanza usuarios concurrentes que mezclan
+navegación, carrito, pedido, checkout y login, y reporta latencias p50/p95/p99,
+throughput y consultas a Mongo por endpoint.
+
+    python backend_bench.py --concurrencia 50 --duracion 20
+    python backend_bench.py --guardar-baseline bench_baseline.json
+    python backend_bench.py --baseline bench_baseline.json --tolerancia 0.25
+    python backend_bench.py --mezcla flash=100   # pedidos concurrentes del mismo producto
+    python backend_bench.py --serializacion 200  # CPU por petición: validación+encode frente a modo rápido
+"""
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import time
+import types
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+import typer
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+# Endpoint que se está midiendo en la tarea actual, para atribuir consultas a Mongo
+endpoint_actual: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("endpoint_actual", default=None)
+
+
+def _registrar_modulo_stripe_falso():
+    """Permitir importar server.py sin el paquete emergentintegrations instalado"""
+    try:
+        import emergentintegrations.payments.stripe.checkout  # noqa: F401
+        return
+    except ImportError:
+        pass
+    from pydantic import BaseModel
+
+    class CheckoutSessionRequest(BaseModel):
+        amount: float
+        currency: str
+        success_url: str
+        cancel_url: str
+        metadata: Optional[Dict[str, str]] = None
+        expires_at: Optional[int] = None
+
+    class CheckoutSessionResponse(BaseModel):
+        url: str
+        session_id: str
+
+    class CheckoutStatusResponse(BaseModel):
+        status: str
+        payment_status: str
+        amount_total: int
+        currency: str
+        metadata: Dict[str, str] = {}
+
+    class StripeCheckout:
+        def __init__(self, *args, **kwargs):
+            raise RuntimeError("emergentintegrations no está instalado; usa PAGOS_BACKEND=falso")
+
+    nombres = ["emergentintegrations", "emergentintegrations.payments",
+               "emergentintegrations.payments.stripe", "emergentintegrations.payments.stripe.checkout"]
+    for nombre in nombres:
+        sys.modules[nombre] = types.ModuleType(nombre)
+    checkout = sys.modules["emergentintegrations.payments.stripe.checkout"]
+    checkout.StripeCheckout = StripeCheckout
+    checkout.CheckoutSessionRequest = CheckoutSessionRequest
+    checkout.CheckoutSessionResponse = CheckoutSessionResponse
+    checkout.CheckoutStatusResponse = CheckoutStatusResponse
+
+
+class Contador:
+    """Consultas a Mongo por endpoint"""
+
+    def __init__(self):
+        self.consultas: Dict[str, int] = {}
+
+    def sumar(self):
+        endpoint = endpoint_actual.get()
+        if endpoint:
+            self.consultas[endpoint] = self.consultas.get(endpoint, 0) + 1
+
+
+class ColeccionContada:
+    OPERACIONES = {
+        "find", "find_one", "insert_one", "insert_many", "update_one", "update_many",
+        "replace_one", "delete_one", "delete_many", "aggregate", "count_documents",
+        "find_one_and_update", "bulk_write", "distinct"
+    }
+
+    def __init__(self, coleccion, contador: Contador):
+        self._coleccion = coleccion
+        self._contador = contador
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._coleccion, nombre)
+        if nombre not in self.OPERACIONES:
+            return atributo
+
+        def contado(*args, **kwargs):
+            self._contador.sumar()
+            return atributo(*args, **kwargs)
+        return contado
+
+
+class BaseDatosContada:
+    def __init__(self, database, contador: Contador):
+        self._database = database
+        self._contador = contador
+
+    def __getitem__(self, nombre):
+        return ColeccionContada(self._database[nombre], self._contador)
+
+    def __getattr__(self, nombre):
+        if nombre.startswith("_"):
+            raise AttributeError(nombre)
+        atributo = getattr(self._database, nombre)
+        if nombre in ("command", "list_collection_names", "client", "name"):
+            return atributo
+        return ColeccionContada(self._database[nombre], self._contador)
+
+
+class Resultados:
+    def __init__(self):
+        self.latencias: Dict[str, List[float]] = {}
+        self.errores: Dict[str, int] = {}
+
+    def registrar(self, endpoint: str, segundos: float, ok: bool):
+        self.latencias.setdefault(endpoint, []).append(segundos)
+        if not ok:
+            self.errores[endpoint] = self.errores.get(endpoint, 0) + 1
+
+
+def percentil(valores: List[float], p: float) -> float:
+    ordenados = sorted(valores)
+    indice = max(int(round(p / 100 * len(ordenados))) - 1, 0)
+    return ordenados[min(indice, len(ordenados) - 1)]
+
+
+class Escenario:
+    """Flujos de usuario contra la API"""
+
+    def __init__(self, cliente: httpx.AsyncClient, resultados: Resultados, productos: List[Dict[str, Any]], usuarios: List[Dict[str, str]]):
+        self.cliente = cliente
+        self.resultados = resultados
+        self.productos = productos
+        self.usuarios = usuarios
+
+    async def peticion(self, endpoint: str, metodo: str, ruta: str, **kwargs) -> Optional[httpx.Response]:
+        token = endpoint_actual.set(endpoint)
+        inicio = time.perf_counter()
+        try:
+            respuesta = await self.cliente.request(metodo, ruta, **kwargs)
+            ok = respuesta.status_code < 400
+        except httpx.HTTPError:
+            respuesta, ok = None, False
+        finally:
+            endpoint_actual.reset(token)
+        self.resultados.registrar(endpoint, time.perf_counter() - inicio, ok)
+        return respuesta if ok else None
+
+    def _items(self, lineas: int) -> List[Dict[str, Any]]:
+        items = []
+        for producto in random.sample(self.productos, min(lineas, len(self.productos))):
+            items.append({
+                "producto_id": producto["id"],
+                "cantidad": 1,
+                "talla": producto["tallas_disponibles"][0],
+                "color": producto["colores_disponibles"][0]
+            })
+        return items
+
+    async def browse(self):
+        categoria = random.choice(["", "artisticos", "hockey", "velocidad", "recreativos"])
+        params = {"categoria": categoria} if categoria else {}
+        await self.peticion("GET /api/productos", "GET", "/api/productos", params=params)
+        producto = random.choice(self.productos)
+        await self.peticion("GET /api/productos/{id}", "GET", f"/api/productos/{producto['id']}")
+        await self.peticion("GET /api/categorias", "GET", "/api/categorias")
+
+    async def cart(self) -> Optional[str]:
+        respuesta = await self.peticion("POST /api/carrito", "POST", "/api/carrito", json={"items": self._items(random.randint(1, 5))})
+        return respuesta.json()["id"] if respuesta else None
+
+    async def order(self):
+        carrito_id = await self.cart()
+        if carrito_id:
+            await self.peticion("POST /api/pedidos", "POST", "/api/pedidos", json={"carrito_id": carrito_id, "metodo_pago": "transferencia"})
+
+    async def flash(self):
+        # Todos los usuarios compiten por el stock del mismo producto
+        producto = self.productos[0]
+        item = {"producto_id": producto["id"], "cantidad": 1, "talla": producto["tallas_disponibles"][0], "color": producto["colores_disponibles"][0]}
+        respuesta = await self.peticion("POST /api/carrito", "POST", "/api/carrito", json={"items": [item]})
+        if respuesta:
+            await self.peticion("POST /api/pedidos (flash)", "POST", "/api/pedidos", json={"carrito_id": respuesta.json()["id"], "metodo_pago": "transferencia"})
+
+    async def checkout(self):
+        carrito_id = await self.cart()
+        if not carrito_id:
+            return
+        respuesta = await self.peticion("POST /api/pagos/checkout", "POST", "/api/pagos/checkout", json={"carrito_id": carrito_id, "metodo": "stripe"})
+        if respuesta:
+            session_id = respuesta.json()["session_id"]
+            await self.peticion("GET /api/pagos/status/{session_id}", "GET", f"/api/pagos/status/{session_id}")
+
+    async def login(self):
+        usuario = random.choice(self.usuarios)
+        await self.peticion("POST /api/auth/login", "POST", "/api/auth/login", json=usuario)
+
+
+async def _sembrar(cliente: httpx.AsyncClient, num_productos: int, num_usuarios: int):
+    categorias = ["artisticos", "hockey", "velocidad", "recreativos"]
+    productos = []
+    for i in range(num_productos):
+        respuesta = await cliente.post("/api/productos", json={
+            "nombre": f"Funda bench {i}",
+            "descripcion": "Funda de patín para benchmark",
+            "precio": round(random.uniform(9, 60), 2),
+            "categoria": categorias[i % len(categorias)],
+            "tallas_disponibles": ["S", "M", "L"],
+            "colores_disponibles": ["negro", "rosa"],
+            "material": random.choice(["neopreno", "lana", "poliester"]),
+            "stock": 1_000_000
+        })
+        respuesta.raise_for_status()
+        productos.append(respuesta.json())
+    usuarios = []
+    for i in range(num_usuarios):
+        credenciales = {"email": f"bench{i}-{uuid.uuid4().hex[:6]}@example.com", "password": "bench-password"}
+        respuesta = await cliente.post("/api/auth/register", json={"nombre": f"Bench {i}", **credenciales})
+        respuesta.raise_for_status()
+        usuarios.append(credenciales)
+    return productos, usuarios
+
+
+async def _usuario_virtual(escenario: Escenario, mezcla: Dict[str, int], fin: float):
+    flujos = list(mezcla)
+    pesos = [mezcla[f] for f in flujos]
+    while time.perf_counter() < fin:
+        await getattr(escenario, random.choices(flujos, pesos)[0])()
+
+
+def _importar_server():
+    _registrar_modulo_stripe_falso()
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "fundas_bench")
+    os.environ["PAGOS_BACKEND"] = "falso"
+    # Todo el tráfico sale de una IP: los límites de tasa medirían el limitador, no la API
+    for variable in ("LIMITE_AUTH_IP", "LIMITE_AUTH_EMAIL", "LIMITE_PEDIDOS_IP"):
+        os.environ.setdefault(variable, "0")
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    return server
+
+
+def _bench_serializacion(tam_pagina: int, repeticiones: int = 200) -> Dict[str, Any]:
+    """Comparar el CPU por petición del camino actual (modelo por documento + validación
+    del response_model + jsonable_encoder + json) con el modo rápido del servidor"""
+    from datetime import datetime
+    from pydantic import TypeAdapter
+    from fastapi.encoders import jsonable_encoder
+
+    server = _importar_server()
+    documentos = [{
+        "_id": uuid.uuid4().hex, "id": str(uuid.uuid4()), "nombre": f"Funda {i}", "descripcion": "Funda de patín " * 5,
+        "precio": 19.99 + i, "categoria": "hockey", "tallas_disponibles": ["S", "M", "L"],
+        "colores_disponibles": ["negro", "rosa"], "material": "neopreno", "stock": 10, "imagen_url": None,
+        "caracteristicas": ["impermeable", "acolchada"], "fecha_creacion": datetime.utcnow(), "activo": True
+    } for i in range(tam_pagina)]
+    response_model = TypeAdapter(List[server.Producto])
+
+    def actual():
+        productos = [server.Producto(**d) for d in documentos]
+        validados = response_model.validate_python(productos, from_attributes=True)
+        return json.dumps(jsonable_encoder(validados), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def rapido():
+        proyectados = [{k: d[k] for k in server.PROYECCION_PRODUCTO if k in d} for d in documentos]
+        return server.codificar_json(server.documentos_confiados(proyectados, server.CAMPOS_PRODUCTO))
+
+    informe = {}
+    for nombre, fn in (("actual", actual), ("rapido", rapido)):
+        fn()
+        inicio = time.process_time()
+        for _ in range(repeticiones):
+            fn()
+        informe[nombre] = round((time.process_time() - inicio) / repeticiones * 1000, 3)
+    informe["aceleracion"] = round(informe["actual"] / informe["rapido"], 2) if informe["rapido"] else None
+    return informe
+
+
+async def _ejecutar(url: Optional[str], concurrencia: int, duracion: float, mezcla: Dict[str, int],
+                    num_productos: int, num_usuarios: int, latencia_stripe: float):
+    contador = Contador()
+    server = None
+    if url:
+        cliente = httpx.AsyncClient(base_url=url, timeout=30, limits=httpx.Limits(max_connections=concurrencia))
+    else:
+        os.environ["PAGOS_FALSO_LATENCIA"] = str(latencia_stripe)
+        import mongomock_motor
+        server = _importar_server()
+        server.client = mongomock_motor.AsyncMongoMockClient()
+        server.db = BaseDatosContada(server.client[os.environ["DB_NAME"]], contador)
+        await server.startup_event()
+        cliente = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench", timeout=30)
+
+    try:
+        productos, usuarios = await _sembrar(cliente, num_productos, num_usuarios)
+        contador.consultas.clear()
+        resultados = Resultados()
+        escenario = Escenario(cliente, resultados, productos, usuarios)
+        inicio = time.perf_counter()
+        fin = inicio + duracion
+        await asyncio.gather(*(_usuario_virtual(escenario, mezcla, fin) for _ in range(concurrencia)))
+        transcurrido = time.perf_counter() - inicio
+    finally:
+        await cliente.aclose()
+        if server is not None:
+            await server.shutdown_db_client()
+
+    informe = {}
+    for endpoint, latencias in sorted(resultados.latencias.items()):
+        informe[endpoint] = {
+            "peticiones": len(latencias),
+            "errores": resultados.errores.get(endpoint, 0),
+            "rps": round(len(latencias) / transcurrido, 2),
+            "p50_ms": round(percentil(latencias, 50) * 1000, 2),
+            "p95_ms": round(percentil(latencias, 95) * 1000, 2),
+            "p99_ms": round(percentil(latencias, 99) * 1000, 2),
+            "consultas_por_peticion": round(contador.consultas.get(endpoint, 0) / len(latencias), 2) if not url else None
+        }
+    return informe
+
+
+def _comparar(informe: Dict[str, Any], baseline: Dict[str, Any], tolerancia: float) -> List[str]:
+    regresiones = []
+    for endpoint, base in baseline.items():
+        actual = informe.get(endpoint)
+        if not actual:
+            continue
+        if actual["p95_ms"] > base["p95_ms"] * (1 + tolerancia):
+            regresiones.append(f"{endpoint}: p95 {actual['p95_ms']} ms > {base['p95_ms']} ms")
+        if base.get("consultas_por_peticion") is not None and actual["consultas_por_peticion"] is not None \
+                and actual["consultas_por_peticion"] > base["consultas_por_peticion"]:
+            regresiones.append(f"{endpoint}: {actual['consultas_por_peticion']} consultas/petición > {base['consultas_por_peticion']}")
+    return regresiones
+
+
+def main(
+    url: Optional[str] = typer.Option(None, help="URL de un uvicorn local; por defecto la app se ejecuta en proceso"),
+    concurrencia: int = typer.Option(20, help="Usuarios virtuales simultáneos"),
+    duracion: float = typer.Option(10.0, help="Segundos de carga"),
+    mezcla: str = typer.Option("browse=60,cart=15,order=10,checkout=10,login=5", help="Pesos de cada flujo"),
+    productos: int = typer.Option(200, help="Productos sembrados"),
+    usuarios: int = typer.Option(10, help="Usuarios sembrados para login"),
+    latencia_stripe: float = typer.Option(0.05, help="Latencia simulada de la pasarela falsa (s)"),
+    salida: Optional[Path] = typer.Option(None, help="Guardar el informe JSON"),
+    guardar_baseline: Optional[Path] = typer.Option(None, help="Guardar el informe como baseline"),
+    baseline: Optional[Path] = typer.Option(None, help="Comparar con un baseline y fallar si hay regresiones"),
+    tolerancia: float = typer.Option(0.25, help="Margen de p95 permitido frente al baseline"),
+    serializacion: int = typer.Option(0, help="Solo comparar CPU de serialización para páginas de N productos"),
+):
+    if serializacion:
+        informe = _bench_serializacion(serializacion)
+        typer.echo(f"CPU por petición ({serializacion} productos): actual {informe['actual']} ms, "
+                   f"rápido {informe['rapido']} ms, x{informe['aceleracion']}")
+        return
+
+    pesos = {}
+    for parte in mezcla.split(","):
+        flujo, peso = parte.split("=")
+        if flujo not in ("browse", "cart", "order", "checkout", "login", "flash"):
+            raise typer.BadParameter(f"Flujo desconocido: {flujo}")
+        pesos[flujo] = int(peso)
+
+    informe = asyncio.run(_ejecutar(url, concurrencia, duracion, pesos, productos, usuarios, latencia_stripe))
+
+    typer.echo(f"{'endpoint':42} {'n':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'q/req':>6}")
+    for endpoint, datos in informe.items():
+        consultas = datos["consultas_por_peticion"]
+        typer.echo(f"{endpoint:42} {datos['peticiones']:>7} {datos['errores']:>5} {datos['rps']:>8} "
+                   f"{datos['p50_ms']:>8} {datos['p95_ms']:>8} {datos['p99_ms']:>8} {'-' if consultas is None else consultas:>6}")
+
+    if salida:
+        salida.write_text(json.dumps(informe, indent=2))
+    if guardar_baseline:
+        guardar_baseline.write_text(json.dumps(informe, indent=2))
+    if baseline:
+        regresiones = _comparar(informe, json.loads(baseline.read_text()), tolerancia)
+        for regresion in regresiones:
+            typer.echo(f"REGRESIÓN {regresion}", err=True)
+        if regresiones:
+            raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,99 @@
+"""Arnés de las pruebas: la API sobre ASGI con Mongo en memoria (mongomock-motor)"""
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("JWT_SECRET", "clave-de-pruebas-de-al-menos-32-bytes")
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "fundas_tests")
+os.environ["PAGOS_BACKEND"] = "falso"
+os.environ["CREAR_INDICES"] = "true"
+
+import backend_bench  # noqa: E402
+
+server = backend_bench._importar_server()
+
+import httpx  # noqa: E402
+import mongomock_motor  # noqa: E402
+
+server.client = mongomock_motor.AsyncMongoMockClient()
+
+ADMIN = {"email": "admin@fundasdepatin.com", "password": "admin123"}
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def api():
+    """Base de datos vacía por prueba, arranque del servidor y cliente HTTP"""
+    server.db = server.client[f"t_{uuid.uuid4().hex[:12]}"]
+    server.catalogo_cache.invalidar()
+    server.usuarios_cache.limpiar()
+    server.version_usuarios.version = None
+    server.version_usuarios.revisado = 0.0
+    server.limitador = server.LimitadorTasa(server.CubosMemoria(), server.LIMITES_TASA)
+    server.tareas_fondo.clear()
+    await server.startup_event()
+    transporte = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://test") as cliente:
+        yield cliente
+    for tarea in server.tareas_fondo:
+        tarea.cancel()
+    server.tareas_fondo.clear()
+    server.servicio_hashing.cerrar()
+
+
+@pytest.fixture
+async def admin(api):
+    r = await api.post("/api/auth/login", json=ADMIN)
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+@pytest.fixture
+def crear_producto(api, admin):
+    async def crear(stock: int = 5, precio: float = 10.0) -> str:
+        r = await api.post("/api/productos", headers=admin, json={
+            "nombre": "Funda", "descripcion": "Funda de patín", "precio": precio, "categoria": "hockey",
+            "tallas_disponibles": ["M"], "colores_disponibles": ["rojo"], "material": "neopreno", "stock": stock
+        })
+        assert r.status_code == 200, r.text
+        return r.json()["id"]
+    return crear
+
+
+@pytest.fixture
+def crear_carrito(api):
+    async def crear(producto_id: str, cantidad: int = 1) -> dict:
+        r = await api.post("/api/carrito", json={
+            "items": [{"producto_id": producto_id, "cantidad": cantidad, "talla": "M", "color": "rojo"}]
+        })
+        assert r.status_code == 200, r.text
+        return r.json()
+    return crear
+
+
+@pytest.fixture
+def crear_checkout(api, crear_producto, crear_carrito):
+    """Pedido con pago por Stripe y su sesión de checkout; devuelve el session_id"""
+    async def crear(**cabeceras) -> str:
+        carrito = await crear_carrito(await crear_producto())
+        await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})
+        r = await api.post("/api/pagos/checkout", json={"carrito_id": carrito["id"], "metodo": "stripe"}, headers=cabeceras)
+        assert r.status_code == 200, r.text
+        return r.json()["session_id"]
+    return crear
+
+
+async def stock(producto_id: str) -> int:
+    return (await server.db.productos.find_one({"id": producto_id}))["stock"]
@@ -0,0 +1,63 @@
+"""Arranque coordinado entre workers y tareas de un solo worker"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_arranque_suelta_su_bloqueo(api):
+    assert server.estado_proceso.lider_arranque
+    assert await server.db.bloqueos.find_one({"_id": "arranque"}) is None
+    r = await api.get("/api/salud/listo")
+    assert r.status_code == 200
+
+
+async def test_bloqueo_vigente_excluye_a_otros_procesos(api, monkeypatch):
+    assert await server.adquirir_bloqueo("tarea", 60)
+    monkeypatch.setattr(server, "ID_PROCESO", "otro-host:1")
+    assert not await server.adquirir_bloqueo("tarea", 60)
+    # Solo el titular puede soltarlo
+    await server.liberar_bloqueo("tarea")
+    assert await server.db.bloqueos.find_one({"_id": "tarea"})
+
+
+async def test_reconciliacion_periodica_la_hace_un_solo_worker(api, monkeypatch):
+    llamadas = []
+
+    async def reconciliar(dias):
+        llamadas.append(dias)
+        # Salir del bucle tras la primera vuelta
+        raise server.asyncio.CancelledError
+
+    monkeypatch.setattr(server, "reconciliar_estadisticas", reconciliar)
+    await server.db.bloqueos.delete_many({})
+    monkeypatch.setattr(server, "ID_PROCESO", "a:1")
+    with pytest.raises(server.asyncio.CancelledError):
+        await server.reconciliar_estadisticas_periodicamente()
+    # El segundo worker no obtiene el bloqueo y se queda esperando a la siguiente vuelta
+    monkeypatch.setattr(server, "ID_PROCESO", "b:2")
+    with pytest.raises(server.asyncio.TimeoutError):
+        await server.asyncio.wait_for(server.reconciliar_estadisticas_periodicamente(), 0.1)
+    assert len(llamadas) == 1
+
+
+async def test_worker_no_lider_espera_al_lider(api, monkeypatch):
+    monkeypatch.setattr(server, "ID_PROCESO", "otro-host:1")
+    assert await server.adquirir_bloqueo("arranque", 60)
+    espera = server.asyncio.create_task(server.esperar_bloqueo("arranque", intervalo=0.01))
+    await server.asyncio.sleep(0.05)
+    assert not espera.done()
+    await server.liberar_bloqueo("arranque")
+    await server.asyncio.wait_for(espera, 1)
+
+
+async def test_fallo_del_lider_hace_fallar_a_los_demas(api, monkeypatch):
+    monkeypatch.setattr(server, "ID_PROCESO", "otro-host:1")
+    assert await server.adquirir_bloqueo("arranque", 60)
+    await server.db.bloqueos.update_one({"_id": "arranque"}, {"$set": {"error": "Índices sin crear: pedidos.carrito_id_unico"}})
+    with pytest.raises(RuntimeError, match="carrito_id_unico"):
+        await server.esperar_bloqueo("arranque", intervalo=0.01)
+    # Un bloqueo con error queda libre para reintentar el arranque
+    monkeypatch.setattr(server, "ID_PROCESO", "tercero:2")
+    assert await server.adquirir_bloqueo("arranque", 60)
@@ -0,0 +1,28 @@
+"""Índice de texto de la búsqueda y su verificación"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_verificar_indices_con_la_especificacion_completa(api, monkeypatch):
+    # mongomock no implementa explain: solo se comprueban los índices declarados
+    monkeypatch.setattr(server, "CONSULTAS_RUTAS", [])
+    informe = await server.verificar_indices(server.db)
+    assert informe["indices_faltantes"] == []
+    await server.db.productos.drop_index("busqueda_texto")
+    informe = await server.verificar_indices(server.db)
+    assert [f["nombre"] for f in informe["indices_faltantes"]] == ["busqueda_texto"]
+
+
+async def test_indice_de_texto_con_formato_de_mongo(api):
+    # Mongo informa los índices de texto como _fts/_ftsx con los campos en weights
+    existente = {"key": [("_fts", "text"), ("_ftsx", 1)],
+                 "weights": {"nombre": 10, "material": 5, "caracteristicas": 3, "descripcion": 1}}
+    declarado = next(m.document for m in server.INDICES["productos"] if m.document["name"] == "busqueda_texto")
+    assert server._firma_indice(existente["key"], existente["weights"]) == \
+        server._firma_indice(list(declarado["key"].items()), declarado.get("weights"))
+    otro = {"nombre": 1, "descripcion": 1}
+    assert server._firma_indice(existente["key"], otro) != \
+        server._firma_indice(list(declarado["key"].items()), declarado.get("weights"))
@@ -0,0 +1,67 @@
+"""Modificación incremental de carritos con control de versiones"""
+import asyncio
+
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+def operacion(producto_id: str, op: str, cantidad: int = 1) -> dict:
+    return {"op": op, "producto_id": producto_id, "talla": "M", "color": "rojo", "cantidad": cantidad}
+
+
+async def test_operaciones_actualizan_total_y_version(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=10, precio=10)
+    otro = await crear_producto(stock=10, precio=5)
+    carrito = await crear_carrito(producto)
+    r = await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "agregar", 2))
+    assert r.json()["total"] == 30 and r.headers["ETag"] == '"1"'
+    r = await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(otro, "agregar"))
+    assert r.json()["total"] == 35
+    r = await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "quitar"))
+    assert r.json()["total"] == 5 and r.json()["version"] == 3
+
+
+async def test_if_match_obsoleto_devuelve_412(api, crear_producto, crear_carrito):
+    producto = await crear_producto()
+    carrito = await crear_carrito(producto)
+    await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "cantidad", 2))
+    r = await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "cantidad", 3), headers={"If-Match": '"0"'})
+    assert r.status_code == 412
+
+
+async def test_modificaciones_concurrentes_no_se_pierden(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=50)
+    carrito = await crear_carrito(producto)
+    codigos = await asyncio.gather(*(
+        api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "agregar")) for _ in range(4)
+    ))
+    exitos = sum(r.status_code == 200 for r in codigos)
+    guardado = await server.db.carritos.find_one({"id": carrito["id"]})
+    assert guardado["items"][0]["cantidad"] == 1 + exitos
+    assert guardado["total"] == 10 * (1 + exitos) and guardado["version"] == exitos
+
+
+async def test_carrito_convertido_no_se_modifica(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=10, precio=10)
+    carrito = await crear_carrito(producto)
+    assert (await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})).status_code == 200
+    r = await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "cantidad", 4))
+    assert r.status_code == 409
+    r = await api.post("/api/pagos/checkout", json={"carrito_id": carrito["id"], "metodo": "stripe"})
+    transaccion = await server.db.payment_transactions.find_one({"session_id": r.json()["session_id"]})
+    assert transaccion["amount"] == 10
+
+
+async def test_quitar_en_carrito_antiguo_recotiza(api, crear_producto, crear_carrito):
+    producto = await crear_producto(precio=10)
+    otro = await crear_producto(precio=5)
+    carrito = await crear_carrito(producto)
+    await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(otro, "agregar", 2))
+    # Carrito guardado antes de las líneas y la versión
+    await server.db.carritos.update_one({"id": carrito["id"]}, {"$unset": {"lineas": "", "version": ""}})
+    r = await api.patch(f"/api/carrito/{carrito['id']}", json=operacion(producto, "quitar"))
+    assert r.status_code == 200
+    assert r.json()["total"] == 10 and len(r.json()["lineas"]) == 1
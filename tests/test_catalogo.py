@@ -0,0 +1,24 @@
+"""Cache del catálogo e invalidación por change streams"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+def test_cambios_de_stock_no_invalidan_el_catalogo():
+    reserva = {"operationType": "update", "updateDescription": {"updatedFields": {"stock": 3}, "removedFields": []}}
+    precio = {"operationType": "update", "updateDescription": {"updatedFields": {"stock": 3, "precio": 9.5}, "removedFields": []}}
+    assert server.cambio_solo_stock(reserva)
+    assert not server.cambio_solo_stock(precio)
+    assert not server.cambio_solo_stock({"operationType": "insert", "fullDocument": {"id": "p"}})
+
+
+def test_cambio_invalida_solo_su_producto():
+    server.catalogo_cache.productos.set("a", {"id": "a"})
+    server.catalogo_cache.productos.set("b", {"id": "b"})
+    cambio = {"operationType": "replace", "documentKey": {"_id": 1}, "fullDocument": {"id": "a"}}
+    server.catalogo_cache.invalidar(server.producto_de_cambio(cambio))
+    assert server.catalogo_cache.productos.get("a") is None
+    assert server.catalogo_cache.productos.get("b") == {"id": "b"}
+    assert server.producto_de_cambio({"operationType": "delete", "documentKey": {"_id": 1}}) is None
@@ -0,0 +1,20 @@
+"""Cliente de pagos: URL del webhook y clientes por URL"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_hosts_arbitrarios_no_hacen_crecer_los_clientes(api, crear_checkout):
+    for i in range(server.PAGOS_CHECKOUTS_MAX + 4):
+        await crear_checkout(Host=f"h{i}.example")
+    assert len(server.obtener_cliente_pagos()._checkouts._datos) <= server.PAGOS_CHECKOUTS_MAX
+
+
+async def test_url_de_webhook_configurada_ignora_el_host(api, crear_checkout, monkeypatch):
+    monkeypatch.setattr(server, "PAGOS_WEBHOOK_URL", "https://api.tienda.test/api/webhook/stripe")
+    pagos = server.obtener_cliente_pagos()
+    pagos._checkouts.limpiar()
+    await crear_checkout(Host="atacante.example")
+    assert list(pagos._checkouts._datos) == ["https://api.tienda.test/api/webhook/stripe"]
@@ -0,0 +1,37 @@
+"""Estadísticas pre-agregadas y su cobertura"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_ventana_sin_cobertura_se_rechaza_hasta_reconstruir(api, admin, crear_producto, crear_carrito):
+    carrito = await crear_carrito(await crear_producto(precio=10))
+    await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "transferencia"})
+    antiguo = server.datetime.utcnow() - server.timedelta(days=200)
+    await server.db.pedidos.update_one({"carrito_id": carrito["id"]}, {"$set": {"fecha_pedido": antiguo}})
+    await server.reconciliar_estadisticas(90)
+    # Como tras desplegar sobre una base con histórico: solo los últimos 90 días
+    await server.db.estadisticas.update_one({"_id": "cobertura"}, {"$set": {"desde": antiguo + server.timedelta(days=110)}})
+
+    r = await api.get("/api/admin/estadisticas?dias=365", headers=admin)
+    assert r.status_code == 400
+    assert (await api.get("/api/admin/estadisticas?dias=30", headers=admin)).status_code == 200
+
+    await server.reconciliar_estadisticas(None)
+    r = await api.get("/api/admin/estadisticas?dias=365", headers=admin)
+    assert r.status_code == 200
+    assert r.json()["ventas_mes"] == 10 and r.json()["pedidos_periodo"] == 1
+
+
+async def test_fechas_con_zona_horaria(api, admin):
+    hoy = server.datetime.utcnow().date()
+    r = await api.get("/api/admin/estadisticas", headers=admin,
+                      params={"desde": f"{hoy - server.timedelta(days=7)}T00:00:00Z", "hasta": f"{hoy}T23:59:59+02:00"})
+    assert r.status_code == 200
+    await server.db.estadisticas.update_one({"_id": "cobertura"}, {"$set": {"desde": server.datetime(2020, 1, 1)}}, upsert=True)
+    r = await api.get("/api/admin/estadisticas", headers=admin, params={"desde": "2019-12-31T23:00:00-02:00"})
+    assert r.status_code == 200
+    r = await api.get("/api/admin/estadisticas", headers=admin, params={"desde": "2019-12-31T23:00:00Z"})
+    assert r.status_code == 400
@@ -0,0 +1,51 @@
+"""Eventos SSE de pagos y pedidos"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def checkout_pagado(api, crear_producto, crear_carrito) -> str:
+    carrito = await crear_carrito(await crear_producto())
+    r = await api.post("/api/pagos/checkout", json={"carrito_id": carrito["id"], "metodo": "stripe"})
+    session_id = r.json()["session_id"]
+    await server.actualizar_estado_transaccion(session_id, "paid", {"status": "complete"})
+    return session_id
+
+
+async def test_pago_final_envia_estado_y_cierra(api, crear_producto, crear_carrito):
+    session_id = await checkout_pagado(api, crear_producto, crear_carrito)
+    r = await api.get(f"/api/eventos/pagos/{session_id}")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/event-stream")
+    assert b"event: pago" in r.content and b'"paid"' in r.content
+    assert server.centro_eventos.conexiones == 0
+
+
+async def test_sin_capacidad_devuelve_503(api, crear_producto, crear_carrito, monkeypatch):
+    session_id = await checkout_pagado(api, crear_producto, crear_carrito)
+    monkeypatch.setattr(server.centro_eventos, "max_conexiones", 0)
+    r = await api.get(f"/api/eventos/pagos/{session_id}")
+    assert r.status_code == 503
+
+
+async def test_pedido_inexistente_devuelve_404_sin_dejar_suscripcion(api):
+    r = await api.get("/api/eventos/pedidos/no-existe")
+    assert r.status_code == 404
+    assert server.centro_eventos.conexiones == 0
+
+
+async def test_aviso_publicado_llega_al_flujo(api):
+    estados = iter([{"estado": "pendiente"}, {"estado": "pagado"}])
+    aviso = server.centro_eventos.suscribir("pedido:x")
+    flujo = server.flujo_eventos("pedido:x", aviso, "pedido", next(estados),
+                                 lambda: _valor(next(estados)), lambda estado: estado["estado"] == "pagado")
+    recibidos = [await flujo.__anext__(), await flujo.__anext__()]
+    server.centro_eventos.publicar("pedido:x")
+    recibidos += [trozo async for trozo in flujo]
+    assert b'"pagado"' in recibidos[-1]
+    assert server.centro_eventos.conexiones == 0
+
+
+async def _valor(valor):
+    return valor
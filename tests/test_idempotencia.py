@@ -0,0 +1,51 @@
+"""Claves de idempotencia en pedidos y checkout"""
+import asyncio
+import uuid
+
+import pytest
+
+from tests.conftest import server, stock
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_reintento_devuelve_la_misma_respuesta(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=5)
+    carrito = await crear_carrito(producto)
+    cabeceras = {"Idempotency-Key": str(uuid.uuid4())}
+    datos = {"carrito_id": carrito["id"], "metodo_pago": "stripe"}
+    primera = await api.post("/api/pedidos", json=datos, headers=cabeceras)
+    segunda = await api.post("/api/pedidos", json=datos, headers=cabeceras)
+    assert primera.status_code == segunda.status_code == 200
+    assert segunda.json() == primera.json() and segunda.headers["Idempotent-Replayed"] == "true"
+    assert await server.db.pedidos.count_documents({}) == 1
+    assert await stock(producto) == 4
+
+
+async def test_reintentos_simultaneos_crean_una_sola_sesion(api, crear_producto, crear_carrito):
+    carrito = await crear_carrito(await crear_producto())
+    cabeceras = {"Idempotency-Key": str(uuid.uuid4())}
+    respuestas = await asyncio.gather(*(
+        api.post("/api/pagos/checkout", json={"carrito_id": carrito["id"], "metodo": "stripe"}, headers=cabeceras)
+        for _ in range(4)
+    ))
+    assert {r.json()["session_id"] for r in respuestas} == {respuestas[0].json()["session_id"]}
+    assert await server.db.payment_transactions.count_documents({}) == 1
+
+
+async def test_misma_clave_con_otros_datos_devuelve_422(api, crear_producto, crear_carrito):
+    producto = await crear_producto()
+    cabeceras = {"Idempotency-Key": str(uuid.uuid4())}
+    primero = await crear_carrito(producto)
+    segundo = await crear_carrito(producto)
+    await api.post("/api/pedidos", json={"carrito_id": primero["id"], "metodo_pago": "stripe"}, headers=cabeceras)
+    r = await api.post("/api/pedidos", json={"carrito_id": segundo["id"], "metodo_pago": "stripe"}, headers=cabeceras)
+    assert r.status_code == 422
+    assert await server.db.pedidos.count_documents({"carrito_id": segundo["id"]}) == 0
+
+
+async def test_fallo_no_guarda_la_clave(api, crear_producto, crear_carrito):
+    cabeceras = {"Idempotency-Key": str(uuid.uuid4())}
+    r = await api.post("/api/pedidos", json={"carrito_id": "no-existe", "metodo_pago": "stripe"}, headers=cabeceras)
+    assert r.status_code == 404
+    assert await server.db.idempotencia.count_documents({}) == 0
@@ -0,0 +1,36 @@
+"""Importación masiva en streaming"""
+import json
+
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def trozos(datos: bytes, tamano: int):
+    for inicio in range(0, len(datos), tamano):
+        yield datos[inicio:inicio + tamano]
+
+
+async def test_caracteres_multibyte_partidos_entre_trozos():
+    texto = "Funda ñandú\nPatín rosa €\n"
+    lineas = [linea async for linea in server.lineas_de_bytes(trozos(texto.encode("utf-8"), 1))]
+    assert lineas == ["Funda ñandú", "Patín rosa €"]
+
+
+async def test_importar_ndjson_con_acentos(api, admin):
+    producto = {
+        "nombre": "Funda Año Nuevo", "descripcion": "Edición señal €", "precio": 12.5, "categoria": "hockey",
+        "tallas_disponibles": ["M"], "colores_disponibles": ["rojo"], "material": "neopreno", "stock": 3
+    }
+    cuerpo = (json.dumps(producto, ensure_ascii=False) + "\n").encode("utf-8")
+    r = await api.post("/api/admin/productos/importar", headers=admin, content=trozos(cuerpo, 3))
+    assert r.status_code == 200, r.text
+    assert r.json()["insertadas"] == 1
+    assert await server.db.productos.find_one({"nombre": "Funda Año Nuevo"})
+
+
+async def test_cuerpo_que_no_es_utf8_devuelve_400(api, admin):
+    r = await api.post("/api/admin/productos/importar", headers=admin, content=b'{"nombre": "\xff"}\n')
+    assert r.status_code == 400
@@ -0,0 +1,29 @@
+"""Índices declarados y pedidos duplicados por carrito"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_duplicados_solo_impiden_su_indice(api):
+    base = server.client["t_indices_duplicados"]
+    await base.drop_collection("pedidos")
+    await base.pedidos.insert_many([
+        {"id": "p1", "carrito_id": "c1", "estado": "pendiente", "fecha_pedido": server.datetime(2024, 1, 1)},
+        {"id": "p2", "carrito_id": "c1", "estado": "pagado", "fecha_pedido": server.datetime(2024, 1, 2)},
+    ])
+    with pytest.raises(RuntimeError, match="pedidos.carrito_id_unico"):
+        await server.asegurar_indices(base)
+    indices = await base.pedidos.index_information()
+    assert "usuario_fecha" in indices and "fecha_pedido" in indices
+    assert "carrito_id_unico" not in indices
+
+    informe = await server.deduplicar_pedidos(base)
+    assert informe["sobrantes"] == 1 and await base.pedidos.count_documents({}) == 2
+    informe = await server.deduplicar_pedidos(base, archivar=True)
+    # Se conserva el pagado aunque sea posterior
+    assert informe["detalle"][0]["conservado"] == "p2"
+    assert await base.pedidos_duplicados.find_one({"id": "p1"})
+    await server.asegurar_indices(base)
+    assert "carrito_id_unico" in await base.pedidos.index_information()
@@ -0,0 +1,37 @@
+"""Límites de tasa con cubos de tokens"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def limites(monkeypatch):
+    """Límites bajos en auth y pedidos (el arnés arranca con ellos desactivados)"""
+    configuracion = {"auth": {"ip": (20, 20 / 60), "email": (3, 3 / 60)}, "pedidos": {"ip": (2, 2 / 60)}}
+    monkeypatch.setattr(server, "limitador", server.LimitadorTasa(server.CubosMemoria(), configuracion))
+
+
+async def test_login_por_email_agota_el_cubo(api, limites):
+    datos = {"email": "nadie@example.com", "password": "incorrecta"}
+    codigos = [(await api.post("/api/auth/login", json=datos)).status_code for _ in range(4)]
+    assert codigos == [401, 401, 401, 429]
+    r = await api.post("/api/auth/login", json={**datos, "email": "NADIE@example.com"})
+    assert r.status_code == 429 and int(r.headers["Retry-After"]) >= 1
+    # Otro email sigue teniendo tokens
+    assert (await api.post("/api/auth/login", json={**datos, "email": "otro@example.com"})).status_code == 401
+
+
+async def test_pedidos_por_ip(api, limites):
+    codigos = [(await api.post("/api/pedidos", json={"carrito_id": "x", "metodo_pago": "stripe"})).status_code for _ in range(3)]
+    assert codigos == [404, 404, 429]
+
+
+async def test_cubo_se_recarga_con_el_tiempo():
+    cubos = server.CubosMemoria()
+    assert await cubos.consumir("lento", 1, 0.001) == 0
+    assert await cubos.consumir("lento", 1, 0.001) == pytest.approx(1000, rel=0.01)
+    assert await cubos.consumir("rapido", 1, 1000) == 0
+    await server.asyncio.sleep(0.01)
+    assert await cubos.consumir("rapido", 1, 1000) == 0
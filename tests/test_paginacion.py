@@ -0,0 +1,45 @@
+"""Paginación por cursor del catálogo"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+def cursor(datos: dict) -> str:
+    return server.base64.urlsafe_b64encode(server.json.dumps(datos).encode()).decode().rstrip("=")
+
+
+async def test_pagina_por_defecto_y_cursor(api):
+    await server.db.productos.insert_many([
+        {"id": f"p{i:03d}", "nombre": f"Funda {i}", "descripcion": "d", "precio": 10 + i, "categoria": "hockey",
+         "tallas_disponibles": ["M"], "colores_disponibles": ["rojo"], "material": "neopreno", "stock": 1,
+         "caracteristicas": [], "activo": True, "fecha_creacion": server.datetime(2024, 1, 1) + server.timedelta(minutes=i)}
+        for i in range(120)
+    ])
+    server.catalogo_cache.invalidar()
+    r = await api.get("/api/productos?categoria=hockey")
+    assert len(r.json()) == 100
+    r = await api.get("/api/productos", params={"categoria": "hockey", "cursor": r.headers["X-Next-Cursor"]})
+    assert len(r.json()) == 20 and r.json()[0]["id"] == "p100"
+
+
+@pytest.mark.parametrize("datos", [
+    {"o": "precio", "v": {"$gt": 0}, "id": "x"},
+    {"o": "precio", "v": 10, "id": {"$ne": None}},
+    {"o": "precio", "v": True, "id": "x"},
+    {"o": "nombre", "v": ["a"], "id": "x"},
+    ["precio", 10, "x"],
+])
+async def test_cursor_con_tipos_no_validos_devuelve_400(api, datos):
+    orden = datos["o"] if isinstance(datos, dict) else "precio"
+    r = await api.get("/api/productos", params={"orden": orden, "cursor": cursor(datos)})
+    assert r.status_code == 400
+
+
+def test_cada_filtro_y_orden_tiene_indice():
+    claves = [list(m.document["key"]) for m in server.INDICES["productos"]]
+    for filtro in (None, "categoria", "tallas_disponibles", "colores_disponibles", "material"):
+        for campo in server.ORDENES_PRODUCTOS.values():
+            esperada = ["activo"] + ([filtro] if filtro else []) + [campo, "id"]
+            assert esperada in claves, (filtro, campo)
@@ -0,0 +1,26 @@
+"""Estado de las sesiones de pago"""
+import asyncio
+
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_consultas_simultaneas_hacen_una_sola_llamada(api, crear_checkout):
+    session_id = await crear_checkout()
+    antes = server.estados_pago.consultas_stripe
+    respuestas = await asyncio.gather(*(api.get(f"/api/pagos/status/{session_id}") for _ in range(5)))
+    assert {r.json()["payment_status"] for r in respuestas} == {"paid"}
+    assert server.estados_pago.consultas_stripe == antes + 1
+    # Estado final: ya no se vuelve a consultar a Stripe
+    await api.get(f"/api/pagos/status/{session_id}")
+    assert server.estados_pago.consultas_stripe == antes + 1
+    pedido = await server.db.pedidos.find_one({"carrito_id": (await server.db.payment_transactions.find_one({"session_id": session_id}))["carrito_id"]})
+    assert pedido["estado"] == "pagado"
+
+
+async def test_sesion_desconocida_devuelve_404(api):
+    r = await api.get("/api/pagos/status/cs_no_existe")
+    assert r.status_code == 404
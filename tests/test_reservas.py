@@ -0,0 +1,107 @@
+"""Reservas de stock: rollback, expiración y confirmación de pagos"""
+import asyncio
+
+import pytest
+
+from tests.conftest import server, stock
+
+pytestmark = pytest.mark.anyio
+
+
+async def caducar_reservas():
+    await server.db.reservas_stock.update_many({"estado": "activa"}, {"$set": {"expira_en": server.datetime(2000, 1, 1)}})
+    return await server.inventario.expirar_vencidas()
+
+
+async def test_sin_stock_no_deja_descuentos_a_medias(api, crear_producto, monkeypatch):
+    con_stock = await crear_producto(stock=5)
+    agotado = await crear_producto(stock=2)
+    r = await api.post("/api/carrito", json={"items": [
+        {"producto_id": con_stock, "cantidad": 2, "talla": "M", "color": "rojo"},
+        {"producto_id": agotado, "cantidad": 2, "talla": "M", "color": "rojo"},
+    ]})
+    # El stock se agota entre la cotización y el descuento
+    original = server.inventario._descontar
+
+    async def descontar(producto_id, cantidad, fragmentado):
+        if producto_id == agotado:
+            return False
+        return await original(producto_id, cantidad, fragmentado)
+
+    monkeypatch.setattr(server.inventario, "_descontar", descontar)
+    r = await api.post("/api/pedidos", json={"carrito_id": r.json()["id"], "metodo_pago": "stripe"})
+    assert r.status_code == 409
+    assert await stock(con_stock) == 5
+    assert await stock(agotado) == 2
+
+
+async def test_compras_concurrentes_no_venden_de_mas(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=3)
+
+    async def comprar():
+        carrito = await crear_carrito(producto)
+        r = await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})
+        return r.status_code
+
+    codigos = await asyncio.gather(*(comprar() for _ in range(6)))
+    assert sorted(codigos) == [200] * 3 + [409] * 3
+    assert await stock(producto) == 0
+
+
+async def test_reserva_sin_pagar_expira_y_devuelve_stock(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=2)
+    carrito = await crear_carrito(producto, cantidad=2)
+    r = await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})
+    assert r.status_code == 200
+    assert await stock(producto) == 0
+    assert await caducar_reservas() == 1
+    assert await stock(producto) == 2
+
+
+async def test_pedido_sin_pasarela_confirma_la_reserva(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=2)
+    carrito = await crear_carrito(producto)
+    r = await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "transferencia"})
+    assert r.status_code == 200
+    assert await caducar_reservas() == 0
+    assert await stock(producto) == 1
+
+
+async def test_checkout_retiene_el_stock_mientras_dura_la_sesion(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=2)
+    carrito = await crear_carrito(producto)
+    await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})
+    r = await api.post("/api/pagos/checkout", json={"carrito_id": carrito["id"], "metodo": "stripe"})
+    assert r.status_code == 200, r.text
+    reserva = await server.db.reservas_stock.find_one({"carrito_id": carrito["id"]})
+    margen = reserva["expira_en"] - server.datetime.utcnow()
+    assert margen.total_seconds() > server.PAGOS_SESION_TTL
+
+
+async def test_pago_tras_expirar_vuelve_a_reservar(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=2)
+    carrito = await crear_carrito(producto)
+    await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})
+    await caducar_reservas()
+    assert await server.inventario.confirmar(carrito["id"]) is True
+    assert await stock(producto) == 1
+    pedido = await server.db.pedidos.find_one({"carrito_id": carrito["id"]})
+    reserva = await server.db.reservas_stock.find_one({"carrito_id": carrito["id"], "vigente": True})
+    assert reserva["estado"] == "confirmada" and pedido["reserva_id"] == reserva["id"]
+
+
+async def test_pago_tras_expirar_sin_stock_marca_incidencia(api, crear_producto, crear_carrito):
+    producto = await crear_producto(stock=1)
+    carrito = await crear_carrito(producto)
+    await api.post("/api/pedidos", json={"carrito_id": carrito["id"], "metodo_pago": "stripe"})
+    r = await api.post("/api/pagos/checkout", json={"carrito_id": carrito["id"], "metodo": "stripe"})
+    assert r.status_code == 200, r.text
+    session_id = r.json()["session_id"]
+    await caducar_reservas()
+    # Otro cliente se lleva la última unidad mientras tanto
+    otro = await crear_carrito(producto)
+    assert (await api.post("/api/pedidos", json={"carrito_id": otro["id"], "metodo_pago": "transferencia"})).status_code == 200
+    await server.actualizar_estado_transaccion(session_id, "paid", {"status": "complete"})
+    pedido = await server.db.pedidos.find_one({"carrito_id": carrito["id"]})
+    assert pedido["estado"] == "pagado" and pedido["incidencia_stock"] is True
+    assert await stock(producto) == 0
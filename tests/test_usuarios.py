@@ -0,0 +1,33 @@
+"""Cache de usuarios autenticados entre workers"""
+import pytest
+
+from tests.conftest import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_desactivar_en_otro_worker_revoca_el_acceso(api, admin, monkeypatch):
+    datos = {"nombre": "Ana", "email": "ana@example.com", "password": "secreta123", "telefono": "600000000",
+             "direccion": "Calle 1", "ciudad": "Madrid", "codigo_postal": "28001"}
+    usuario = (await api.post("/api/auth/register", json=datos)).json()
+    r = await api.post("/api/auth/login", json={"email": datos["email"], "password": datos["password"]})
+    cabeceras = {"Authorization": f"Bearer {r.json()['access_token']}"}
+    assert (await api.get("/api/auth/me", headers=cabeceras)).status_code == 200
+
+    # Otro worker desactiva al usuario: este solo ve el contador en Mongo
+    await server.db.usuarios.update_one({"id": usuario["id"]}, {"$set": {"activo": False}})
+    await server.db.invalidaciones.update_one({"_id": "usuarios"}, {"$inc": {"version": 1}}, upsert=True)
+    # Dentro del intervalo de revisión sigue sirviendo el cache
+    monkeypatch.setattr(server.version_usuarios, "revisado", server.time.monotonic())
+    assert (await api.get("/api/auth/me", headers=cabeceras)).status_code == 200
+    monkeypatch.setattr(server.version_usuarios, "revisado", 0.0)
+    assert (await api.get("/api/auth/me", headers=cabeceras)).status_code == 401
+
+
+async def test_cambio_de_rol_publica_la_invalidacion(api, admin):
+    usuarios = (await api.get("/api/admin/usuarios", headers=admin)).json()
+    antes = await server.db.invalidaciones.find_one({"_id": "usuarios"})
+    r = await api.patch(f"/api/admin/usuarios/{usuarios[0]['id']}", headers=admin, json={"activo": True})
+    assert r.status_code == 200
+    despues = await server.db.invalidaciones.find_one({"_id": "usuarios"})
+    assert despues["version"] == (antes["version"] if antes else 0) + 1